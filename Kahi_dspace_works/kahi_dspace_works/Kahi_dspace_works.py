@@ -3,6 +3,7 @@ from pymongo import MongoClient
 from mohan.Similarity import Similarity
 from kahi_dspace_works.utils import get_doi, process_affiliation, is_similarity_reg, thesis_types
 from kahi_dspace_works.process_one import process_one
+from kahi_entity_resolver.resolver import resolver_from_config, set_resolver
 from joblib import Parallel, delayed
 
 
@@ -76,6 +77,9 @@ class Kahi_dspace_works(KahiBase):
         print("INFO: Creating index for full_name in person collection")
         self.db["person"].create_index("full_name")
 
+        self.resolver = resolver_from_config(
+            self.db, config["dspace_works"], ["sources", "affiliations"])
+
     def process_repository(self, affiliation, base_url, dspace_collection):
         if self.task == "doi":
             # the thesis with doi will be processed with elastic, we can't trust the doi from dspace for thesis.
@@ -138,6 +142,7 @@ class Kahi_dspace_works(KahiBase):
     def run(self):
         print(
             f"INFO: Running dspace works with num_jobs = {self.n_jobs} task = {self.task}")
+        set_resolver(self.resolver)
         dsapce_db_client = MongoClient(
             self.config["dspace_works"]["database_url"])
         dsapce_db = dsapce_db_client[self.config["dspace_works"]
@@ -153,5 +158,8 @@ class Kahi_dspace_works(KahiBase):
             base_url = repository["repository_url"]
             dspace_collection = dsapce_db[repository["collection_name"]]
             self.process_repository(affiliation, base_url, dspace_collection)
+        set_resolver(None)
+        if self.resolver:
+            self.resolver.report()
 
         return 0
@@ -1,4 +1,5 @@
 from kahi_impactu_utils.Utils import doi_processor
+from kahi_entity_resolver.resolver import find_one
 from thefuzz import process, fuzz
 from unidecode import unidecode
 
@@ -45,7 +46,7 @@ def set_source(reg, db):
     """
     if reg["source"] != {}:
         for source in reg["source"]["external_ids"]:
-            found = db["sources"].find_one({"external_ids.id": source["id"]})
+            found = find_one(db, "sources", {"external_ids.id": source["id"]})
             if found:
                 del reg["source"]["external_ids"]
                 reg["source"]["id"] = found["_id"]
@@ -70,7 +71,7 @@ def process_affiliation(ror_id, db):
     dict | None
         affiliation processed or None if affiliation is not found.
     """
-    aff_rec = db["affiliations"].find_one({"external_ids.id": ror_id})
+    aff_rec = find_one(db, "affiliations", {"external_ids.id": ror_id})
     if aff_rec is None:
         return None
     aff = {}
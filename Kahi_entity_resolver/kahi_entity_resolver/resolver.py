@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from time import monotonic
+
+RESOLVER_CACHE_SIZE = 200000
+RESOLVER_TTL = 3600
+
+_MISSING = object()
+
+
+def project(doc, projection=None):
+    """
+    Applies a find projection to a document in memory.
+
+    Only the top level fields are projected, a dotted field like "names.name" keeps the whole "names" field.
+
+    Parameters:
+    ----------
+    doc : dict
+        The document, None for the lookups without result.
+    projection : dict
+        The projection, None for the whole document.
+
+    Returns:
+    -------
+    dict
+        The projected document (a new dict, the values are shared with doc).
+    """
+    if doc is None or not projection:
+        return doc
+    fields = {field.split(".")[0]: value for field, value in projection.items()}
+    included = {field for field, value in fields.items() if value}
+    if included:
+        if fields.get("_id", 1):
+            included.add("_id")
+        return {field: value for field, value in doc.items() if field in included}
+    return {field: value for field, value in doc.items() if field not in fields}
+
+
+class EntityResolver:
+    """
+    Thread-safe LRU/TTL cache of the lookups done against the entities collections
+    (affiliations, sources, subjects, ...) while the works are processed.
+
+    The key of every entry is (collection, query, projection) and only the projected fields are cached.
+    The whole documents (lookups without projection and warmed documents) serve the lookups
+    with any projection of the same query, the projection is applied in memory.
+    Lookups without result are cached as well (negative caching)
+    and the documents returned are copies, the cached ones are never exposed to the caller.
+    """
+
+    def __init__(self, maxsize=RESOLVER_CACHE_SIZE, ttl=RESOLVER_TTL):
+        """
+        Parameters:
+        ----------
+        maxsize : int
+            Maximum number of entries in the cache, the least recently used ones are evicted first.
+        ttl : int
+            Time to live of every entry in seconds, 0 or None to keep the entries until evicted.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.counters = {}
+
+    @staticmethod
+    def key(collection, query, projection=None):
+        return (collection, repr(query), repr(sorted(projection.items())) if projection else None)
+
+    def _count(self, collection, counter):
+        stats = self.counters.setdefault(
+            collection, {"hits": 0, "negative_hits": 0, "misses": 0})
+        stats[counter] += 1
+
+    def get(self, collection, query, projection=None):
+        """
+        Get a cached lookup, returns _MISSING if the entry is not cached or expired.
+
+        The entry of the whole document is used first, then the entry of the projection.
+        """
+        keys = [self.key(collection, query)]
+        if projection:
+            keys.append(self.key(collection, query, projection))
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key, _MISSING)
+                if entry is not _MISSING and self.ttl and entry[1] < monotonic():
+                    del self.entries[key]
+                    entry = _MISSING
+                if entry is not _MISSING:
+                    break
+            if entry is _MISSING:
+                self._count(collection, "misses")
+                return _MISSING
+            self.entries.move_to_end(key)
+            counter = "hits" if entry[0] is not None else "negative_hits"
+            self._count(collection, counter)
+            doc = project(entry[0], projection)
+        return deepcopy(doc)
+
+    def put(self, collection, query, doc, projection=None, overwrite=True):
+        """
+        Store the result of a lookup, doc is the document returned with the projection or None for the lookups without result.
+        """
+        key = self.key(collection, query, projection)
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            if not overwrite and key in self.entries:
+                return
+            self.entries[key] = (deepcopy(doc), expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def find_one(self, db, collection, query, projection=None):
+        """
+        Same as db[collection].find_one(query, projection) using the cache.
+
+        On a miss only the projected fields are fetched and cached.
+        """
+        doc = self.get(collection, query, projection)
+        if doc is not _MISSING:
+            return doc
+        doc = db[collection].find_one(query, projection)
+        self.put(collection, query, doc, projection)
+        return doc
+
+    def warm(self, db, collection, field="external_ids.id"):
+        """
+        Preload the cache with the documents of a collection, one entry per value of field,
+        as if the query {field: value} was already done. When several documents share a value
+        the first one found is kept.
+
+        Parameters:
+        ----------
+        db : pymongo.database.Database
+            The kahi database.
+        collection : str
+            The collection to load.
+        field : str
+            The field used in the lookups, only "external_ids.id" and top level fields are supported.
+
+        Returns:
+        -------
+        int
+            Number of documents loaded.
+        """
+        count = 0
+        for doc in db[collection].find({}):
+            if field == "external_ids.id":
+                values = [ext["id"] for ext in doc.get("external_ids", [])]
+            else:
+                values = [doc.get(field)]
+            for value in values:
+                self.put(collection, {field: value}, doc, overwrite=False)
+            count += 1
+        return count
+
+    def stats(self):
+        with self.lock:
+            return {collection: dict(counters) for collection, counters in self.counters.items()}
+
+    def report(self):
+        """
+        Print the hit rate of the cache per collection.
+        """
+        for collection, counters in sorted(self.stats().items()):
+            found = counters["hits"] + counters["negative_hits"]
+            total = found + counters["misses"]
+            rate = 100 * found / total if total else 0
+            print(f"INFO: resolver cache {collection}: {counters['hits']} hits, {counters['negative_hits']} negative hits, "
+                  f"{counters['misses']} misses ({rate:.1f}% hit rate)")
+
+
+_resolver = None
+
+
+def set_resolver(resolver):
+    """
+    Set the resolver shared by the lookups of the running plugin, None to disable the cache.
+    """
+    global _resolver
+    _resolver = resolver
+
+
+def get_resolver():
+    return _resolver
+
+
+def find_one(db, collection, query, projection=None):
+    """
+    Lookup in an entities collection, cached if a resolver was set with set_resolver.
+
+    With the multiprocessing backends the resolver is not shared with the workers
+    and the lookups are done directly against the database.
+    """
+    if _resolver is None:
+        return db[collection].find_one(query, projection)
+    return _resolver.find_one(db, collection, query, projection)
+
+
+def resolver_from_config(db, config, collections=()):
+    """
+    Create the resolver from the plugin configuration, returns None if the cache is not enabled.
+
+    Parameters:
+    ----------
+    db : pymongo.database.Database
+        The kahi database.
+    config : dict
+        The configuration of the plugin, the keys used are resolver_cache (default False),
+        resolver_cache_size, resolver_ttl and resolver_warm (default False).
+    collections : list
+        Collections loaded in the cache if resolver_warm is enabled.
+    """
+    if not config.get("resolver_cache", False):
+        return None
+    resolver = EntityResolver(
+        config["resolver_cache_size"] if "resolver_cache_size" in config.keys(
+        ) else RESOLVER_CACHE_SIZE,
+        config["resolver_ttl"] if "resolver_ttl" in config.keys() else RESOLVER_TTL)
+    if config.get("resolver_warm", False):
+        for collection in collections:
+            count = resolver.warm(db, collection)
+            print(
+                f"INFO: resolver cache warmed with {count} documents from {collection}")
+    return resolver
@@ -1,6 +1,54 @@
 from kahi.KahiBase import KahiBase
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from joblib import Parallel, delayed
+from time import time
+
+CITES_BULK_SIZE = 500
+
+
+def work_citations(work):
+    """
+    Get the (source, count) pairs of the citations count of a work,
+    with the same values that $unwind and $sum give in the aggregation.
+    """
+    citations = work.get("citations_count")
+    if citations is None:
+        return []
+    if not isinstance(citations, list):
+        citations = [citations]
+    pairs = []
+    for cites in citations:
+        if not isinstance(cites, dict):
+            continue
+        count = cites.get("count")
+        if isinstance(count, bool) or not isinstance(count, (int, float)):
+            count = 0
+        pairs.append((cites.get("source"), count))
+    return pairs
+
+
+def work_entities(work):
+    """
+    Get the distinct person, affiliation and source ids of a work.
+    """
+    authors = work.get("authors") or []
+    person = set()
+    affiliations = set()
+    for author in authors:
+        if author.get("id"):
+            person.add(author["id"])
+        for aff in author.get("affiliations") or []:
+            if aff.get("id"):
+                affiliations.add(aff["id"])
+    source = work.get("source")
+    sources = set()
+    if isinstance(source, dict) and source.get("id"):
+        # some works have a list of source ids
+        if isinstance(source["id"], list):
+            sources.update(sid for sid in source["id"] if sid)
+        else:
+            sources.add(source["id"])
+    return {"person": person, "affiliations": affiliations, "sources": sources}
 
 
 class Kahi_impactu_post_cites_count(KahiBase):
@@ -26,6 +74,9 @@ class Kahi_impactu_post_cites_count(KahiBase):
             impactu_post_cites_count:
                 num_jobs: 20
                 verbose: 5
+                mode: global # global (default), per_entity or incremental
+                batch_size: 500
+                watermark_collection: post_cites_count_watermark
         ```
         """
         self.config = config
@@ -34,6 +85,14 @@ class Kahi_impactu_post_cites_count(KahiBase):
 
         self.n_jobs = self.config["impactu_post_cites_count"]["num_jobs"]
         self.verbose = self.config["impactu_post_cites_count"]["verbose"]
+        self.mode = self.config["impactu_post_cites_count"][
+            "mode"] if "mode" in self.config["impactu_post_cites_count"] else "global"
+        self.batch_size = self.config["impactu_post_cites_count"][
+            "batch_size"] if "batch_size" in self.config["impactu_post_cites_count"] else CITES_BULK_SIZE
+
+        self.log_database = config["log_database"] if "log_database" in config else self.database_name
+        self.watermark_collection = self.config["impactu_post_cites_count"][
+            "watermark_collection"] if "watermark_collection" in self.config["impactu_post_cites_count"] else "post_cites_count_watermark"
 
         self.client = MongoClient(self.mongodb_url)
         self.db = self.client[self.database_name]
@@ -186,13 +245,15 @@ class Kahi_impactu_post_cites_count(KahiBase):
         self.sources_collection.update_one(
             {"_id": sid["_id"]}, {"$set": rec}, upsert=True)
 
-    def run_cites_count(self):
+    def run_cites_count(self, person_ids=None, institutions_ids=None, units_ids=None, sources_ids=None):
         """
         Method to run the cites and products count calculation for each person, institution, faculty, department and group.
+        The ids lists allow to recompute only the given entities (list of {"_id": id}), all the entities are computed by default.
         """
 
         # Count cites for each author
-        person_ids = list(self.person_collection.find({}, {"_id"}))
+        if person_ids is None:
+            person_ids = list(self.person_collection.find({}, {"_id"}))
         if self.verbose > 0:
             print("Calculating cites and products count for {} authors".format(
                 len(person_ids)))
@@ -208,8 +269,10 @@ class Kahi_impactu_post_cites_count(KahiBase):
             client.close()
 
         # Count cites for each institution
-        aff_ids = list(self.affiliations_collection.find(
-            {"types.type": {"$nin": ["department", "faculty", "group"]}}, {"_id"}))
+        aff_ids = institutions_ids
+        if aff_ids is None:
+            aff_ids = list(self.affiliations_collection.find(
+                {"types.type": {"$nin": ["department", "faculty", "group"]}}, {"_id"}))
         if self.verbose > 0:
             print("Calculating cites count and products for {} institutions".format(
                 len(aff_ids)))
@@ -225,8 +288,10 @@ class Kahi_impactu_post_cites_count(KahiBase):
             client.close()
 
         # Count cites for each faculty, department and group
-        aff_ids = list(self.affiliations_collection.find(
-            {"types.type": {"$in": ["department", "faculty", "group"]}}, {"_id"}))
+        aff_ids = units_ids
+        if aff_ids is None:
+            aff_ids = list(self.affiliations_collection.find(
+                {"types.type": {"$in": ["department", "faculty", "group"]}}, {"_id"}))
         if self.verbose > 0:
             print("Calculating cites and products count for {} faculties, departments and groups".format(
                 len(aff_ids)))
@@ -242,7 +307,9 @@ class Kahi_impactu_post_cites_count(KahiBase):
             client.close()
 
         # Count cites and products for sources
-        souces_ids = list(self.sources_collection.find({}, {"_id"}))
+        souces_ids = sources_ids
+        if souces_ids is None:
+            souces_ids = list(self.sources_collection.find({}, {"_id"}))
         if self.verbose > 0:
             print("Calculating cites and products count for {} sources".format(
                 len(souces_ids)))
@@ -257,7 +324,196 @@ class Kahi_impactu_post_cites_count(KahiBase):
             )
             client.close()
 
+    def person_units_map(self, units_ids):
+        """
+        Method to build the map from every person to the faculties, departments and groups in its affiliations.
+        """
+        units = set(reg["_id"] for reg in units_ids)
+        person_units = {}
+        for person in self.person_collection.find({"affiliations.id": {"$in": list(units)}}, {"affiliations.id": 1}):
+            person_units[person["_id"]] = frozenset(
+                aff["id"] for aff in person["affiliations"] if aff.get("id") in units)
+        return person_units
+
+    def count_cites_products_global(self, person_units=None):
+        """
+        Method to calculate the citation and product count for every author, institution and source
+        streaming the works collection only once.
+
+        If the person_units map is given, the citations of every work are also attributed once
+        to the distinct faculties, departments and groups of its authors.
+
+        Returns a dictionary with the counts for "person", "affiliations", "sources" and "units",
+        every entity id has [products_count, {citations source: count}].
+        """
+        if person_units is None:
+            person_units = {}
+        counts = {"person": {}, "affiliations": {},
+                  "sources": {}, "units": {}}
+        projection = {"_id": 0, "authors.id": 1, "authors.affiliations.id": 1,
+                      "source.id": 1, "citations_count": 1}
+        nworks = 0
+        for work in self.works_collection.find({}, projection):
+            citations = work_citations(work)
+            entities = work_entities(work)
+            entities["units"] = set()
+            for pid in entities["person"]:
+                entities["units"].update(person_units.get(pid, ()))
+            for entity, ids in entities.items():
+                entity_counts = counts[entity]
+                for idx in ids:
+                    rec = entity_counts.get(idx)
+                    if rec is None:
+                        rec = [0, {}]
+                        entity_counts[idx] = rec
+                    rec[0] += 1
+                    for source, count in citations:
+                        rec[1][source] = rec[1].get(source, 0) + count
+            nworks += 1
+        if self.verbose > 0:
+            print("Counted cites and products of {} works for {} authors, {} affiliations and {} sources".format(
+                nworks, len(counts["person"]), len(counts["affiliations"]), len(counts["sources"])))
+        return counts
+
+    def bulk_update(self, collection, operations):
+        """
+        Method to write a batch of updates.
+        """
+        collection.bulk_write(operations, ordered=False)
+
+    def write_cites_count(self, collection, ids, counts):
+        """
+        Method to set the citations and products count of the given entities,
+        the entities without works get an empty citations count and zero products.
+        """
+        def batches():
+            operations = []
+            for reg in ids:
+                count = counts.get(reg["_id"], [0, {}])
+                rec = {"citations_count": [{"source": source, "count": cites} for source, cites in count[1].items()],
+                       "products_count": count[0]}
+                operations.append(
+                    UpdateOne({"_id": reg["_id"]}, {"$set": rec}, upsert=True))
+                if len(operations) >= self.batch_size:
+                    yield operations
+                    operations = []
+            if operations:
+                yield operations
+
+        Parallel(
+            n_jobs=self.n_jobs,
+            verbose=self.verbose,
+            backend="threading")(
+            delayed(self.bulk_update)(
+                collection,
+                operations,
+            ) for operations in batches()
+        )
+
+    def run_global_cites_count(self):
+        """
+        Method to run the cites and products count calculation with a single pass over the works
+        for each person, institution, faculty, department, group and source, and write the results with bulk updates.
+        """
+        units_ids = list(self.affiliations_collection.find(
+            {"types.type": {"$in": ["department", "faculty", "group"]}}, {"_id"}))
+        person_units = self.person_units_map(units_ids)
+        if self.verbose > 0:
+            print("Found {} authors in {} faculties, departments and groups".format(
+                len(person_units), len(units_ids)))
+        counts = self.count_cites_products_global(person_units)
+
+        if self.verbose > 0:
+            print("Writing cites and products count for authors")
+        self.write_cites_count(self.person_collection, self.person_collection.find(
+            {}, {"_id"}), counts["person"])
+
+        if self.verbose > 0:
+            print("Writing cites and products count for institutions")
+        self.write_cites_count(self.affiliations_collection, self.affiliations_collection.find(
+            {"types.type": {"$nin": ["department", "faculty", "group"]}}, {"_id"}), counts["affiliations"])
+
+        if self.verbose > 0:
+            print("Writing cites and products count for sources")
+        self.write_cites_count(self.sources_collection, self.sources_collection.find(
+            {}, {"_id"}), counts["sources"])
+
+        # The citations of faculties, departments and groups come from the works of their members,
+        # the products count from the works with the unit in the authors affiliations.
+        units_counts = {}
+        for reg in units_ids:
+            products = counts["affiliations"].get(reg["_id"], [0, {}])[0]
+            citations = counts["units"].get(reg["_id"], [0, {}])[1]
+            units_counts[reg["_id"]] = [products, citations]
+        if self.verbose > 0:
+            print("Writing cites and products count for {} faculties, departments and groups".format(
+                len(units_ids)))
+        self.write_cites_count(self.affiliations_collection,
+                               units_ids, units_counts)
+
+    def get_watermark(self):
+        """
+        Method to get the updated time of the last run from the log database, None if there is no previous run.
+        """
+        reg = self.client[self.log_database][self.watermark_collection].find_one(
+            {"_id": "impactu_post_cites_count"})
+        return reg["time"] if reg else None
+
+    def set_watermark(self, watermark):
+        """
+        Method to save the updated time of the current run in the log database.
+        """
+        self.client[self.log_database][self.watermark_collection].update_one(
+            {"_id": "impactu_post_cites_count"}, {"$set": {"time": watermark}}, upsert=True)
+
+    def run_incremental_cites_count(self, watermark):
+        """
+        Method to recompute the cites and products count only for the entities of the works updated after the watermark
+        (any updated.time greater than the watermark).
+        """
+        projection = {"_id": 0, "authors.id": 1,
+                      "authors.affiliations.id": 1, "source.id": 1}
+        touched = {"person": set(), "affiliations": set(), "sources": set()}
+        nworks = 0
+        for work in self.works_collection.find({"updated.time": {"$gt": watermark}}, projection):
+            for entity, ids in work_entities(work).items():
+                touched[entity].update(ids)
+            nworks += 1
+        if self.verbose > 0:
+            print("Found {} works updated since {}".format(nworks, watermark))
+        if nworks == 0:
+            return
+
+        units = set()
+        for reg in self.affiliations_collection.find(
+                {"types.type": {"$in": ["department", "faculty", "group"]}}, {"_id"}):
+            units.add(reg["_id"])
+        # the units of the authors of the updated works change their citations count
+        units_ids = set(idx for idx in touched["affiliations"] if idx in units)
+        for person in self.person_collection.find({"_id": {"$in": list(touched["person"])}}, {"affiliations.id": 1}):
+            units_ids.update(aff["id"] for aff in person.get(
+                "affiliations", []) if aff.get("id") in units)
+        institutions_ids = [{"_id": idx} for idx in touched["affiliations"] if idx not in units]
+        self.run_cites_count(
+            person_ids=[{"_id": idx} for idx in touched["person"]],
+            institutions_ids=institutions_ids,
+            units_ids=[{"_id": idx} for idx in units_ids],
+            sources_ids=[{"_id": idx} for idx in touched["sources"]],
+        )
+
     def run(self):
-        self.run_cites_count()
+        start = int(time())
+        if self.mode == "incremental":
+            watermark = self.get_watermark()
+            if watermark is None:
+                print("INFO: no watermark found for the incremental cites count, running the global count")
+                self.run_global_cites_count()
+            else:
+                self.run_incremental_cites_count(watermark)
+        elif self.mode == "per_entity":
+            self.run_cites_count()
+        else:
+            self.run_global_cites_count()
+        self.set_watermark(start)
         self.client.close()
         return 0
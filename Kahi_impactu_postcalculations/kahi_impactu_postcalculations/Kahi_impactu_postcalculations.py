@@ -5,13 +5,17 @@ import subprocess
 from spacy import cli, load
 from kahi_impactu_postcalculations.process_one import network_creation_process_one, top_words_process_one, count_works_one, load_nlp_models
 from kahi_impactu_postcalculations.indexes import create_indexes
-from kahi_impactu_postcalculations.denormalization import denormalize
-from kahi_impactu_postcalculations.typing import process_type
-from kahi_impactu_postcalculations.topics import process_topic
-from kahi_impactu_postcalculations.person_persistent_ids import process_person_id
+from kahi_impactu_postcalculations.denormalization import denormalize, WORKS_DENORMALIZATION_BATCH_SIZE, DENORMALIZATION_WATERMARK_COLLECTION
+from kahi_impactu_postcalculations.denormalization import add_denormalization_pending, require_full_denormalization, denormalization_pending, clear_denormalization_pending
+from kahi_impactu_postcalculations.typing import process_types, compile_types, TYPES_BULK_SIZE
+from kahi_impactu_postcalculations.topics import process_topics, INFERENCE_BATCH_SIZE, INFERENCE_CONCURRENCY, INFERENCE_RETRIES, PREDICTIONS_COLLECTION
+from kahi_impactu_postcalculations.person_persistent_ids import process_person_id, compute_person_ids_mapping, apply_person_ids_mapping, rollback_person_ids, MAPPING_COLLECTION, MAPPING_BATCH_SIZE
+from kahi_impactu_postcalculations.networks import create_networks, NETWORK_BULK_SIZE
+from kahi_impactu_postcalculations.top_words import create_top_words, create_top_words_incremental, NLP_BATCH_SIZE
 from pathlib import Path
 import pandas as pd
 import gc
+from time import time
 
 
 class Kahi_impactu_postcalculations(KahiBase):
@@ -43,9 +47,47 @@ class Kahi_impactu_postcalculations(KahiBase):
         self.inference_endpoint = self.config["impactu_postcalculations"]["inference_endpoint"]
         self.parallel_collections = True
         self.collection_jobs = 3
+        self.denormalization_engine = self.config["impactu_postcalculations"][
+            "denormalization_engine"] if "denormalization_engine" in self.config["impactu_postcalculations"] else "single_pass"
+        self.denormalization_batch_size = self.config["impactu_postcalculations"][
+            "denormalization_batch_size"] if "denormalization_batch_size" in self.config["impactu_postcalculations"] else WORKS_DENORMALIZATION_BATCH_SIZE
+        self.denormalization_chunks = self.config["impactu_postcalculations"][
+            "denormalization_chunks"] if "denormalization_chunks" in self.config["impactu_postcalculations"] else {}
+        self.denormalization_mode = self.config["impactu_postcalculations"][
+            "denormalization_mode"] if "denormalization_mode" in self.config["impactu_postcalculations"] else "full"
 
         self.author_count = self.config["impactu_postcalculations"][
             "author_count"] if "author_count" in self.config["impactu_postcalculations"] else 6
+        self.network_engine = self.config["impactu_postcalculations"][
+            "network_engine"] if "network_engine" in self.config["impactu_postcalculations"] else "single_pass"
+        self.network_batch_size = self.config["impactu_postcalculations"][
+            "network_batch_size"] if "network_batch_size" in self.config["impactu_postcalculations"] else NETWORK_BULK_SIZE
+        self.top_words_engine = self.config["impactu_postcalculations"][
+            "top_words_engine"] if "top_words_engine" in self.config["impactu_postcalculations"] else "bulk"
+        self.nlp_batch_size = self.config["impactu_postcalculations"][
+            "nlp_batch_size"] if "nlp_batch_size" in self.config["impactu_postcalculations"] else NLP_BATCH_SIZE
+        self.nlp_n_process = self.config["impactu_postcalculations"][
+            "nlp_n_process"] if "nlp_n_process" in self.config["impactu_postcalculations"] else 1
+        self.inference_batch_size = self.config["impactu_postcalculations"][
+            "inference_batch_size"] if "inference_batch_size" in self.config["impactu_postcalculations"] else INFERENCE_BATCH_SIZE
+        self.inference_concurrency = self.config["impactu_postcalculations"][
+            "inference_concurrency"] if "inference_concurrency" in self.config["impactu_postcalculations"] else INFERENCE_CONCURRENCY
+        self.inference_retries = self.config["impactu_postcalculations"][
+            "inference_retries"] if "inference_retries" in self.config["impactu_postcalculations"] else INFERENCE_RETRIES
+        self.inference_cache = self.config["impactu_postcalculations"][
+            "inference_cache"] if "inference_cache" in self.config["impactu_postcalculations"] else True
+        self.inference_model_version = self.config["impactu_postcalculations"][
+            "inference_model_version"] if "inference_model_version" in self.config["impactu_postcalculations"] else ""
+        self.types_batch_size = self.config["impactu_postcalculations"][
+            "types_batch_size"] if "types_batch_size" in self.config["impactu_postcalculations"] else TYPES_BULK_SIZE
+        self.types_dry_run = self.config["impactu_postcalculations"][
+            "types_dry_run"] if "types_dry_run" in self.config["impactu_postcalculations"] else False
+        self.person_ids_mode = self.config["impactu_postcalculations"][
+            "person_ids_mode"] if "person_ids_mode" in self.config["impactu_postcalculations"] else "bulk"
+        self.person_ids_batch_size = self.config["impactu_postcalculations"][
+            "person_ids_batch_size"] if "person_ids_batch_size" in self.config["impactu_postcalculations"] else MAPPING_BATCH_SIZE
+        self.person_ids_rollback = self.config["impactu_postcalculations"][
+            "person_ids_rollback"] if "person_ids_rollback" in self.config["impactu_postcalculations"] else False
         self._check_and_install_spacy_models()
         self.types_file = str(
             Path(__file__).parent.resolve()) + "/Tipos_ImpactU_Definitivo.xlsx"
@@ -78,6 +120,7 @@ class Kahi_impactu_postcalculations(KahiBase):
 
         self.types["Tipo"] = self.types["Tipo"].apply(
             lambda x: " ".join(x.split()).strip() if isinstance(x, str) else x)
+        self.types = compile_types(self.types)
 
     def _check_and_install_spacy_models(self):
         """
@@ -113,24 +156,9 @@ class Kahi_impactu_postcalculations(KahiBase):
                        "download", "es_core_news_sm"])
 
     def process_types(self, db):
-        for source in self.types_priority:
-            print(f"INFO: processing types for {source}")
-            pipe = [{"$match": {"types.source": {"$ne": "impactu"}}},
-                    {"$match": {"types.source": source}},
-                    {"$unwind": "$types"},
-                    {"$match": {"types.source": source}},
-                    {"$group": {"_id": "$_id", "types": {"$push": "$types"}}},
-                    {"$set": {
-                        "types": {
-                            "$sortArray": {"input": "$types", "sortBy": {"level": 1}}
-                        }
-                    }
-            },
-                {"$project": {"types": 1}},
-            ]
-            data = db["works"].aggregate(pipe)
-            Parallel(n_jobs=self.n_jobs, verbose=10, backend="threading")(delayed(process_type)(db, work, source, self.types
-                                                                                                ) for work in data)
+        print("INFO: processing types for " + ", ".join(self.types_priority))
+        process_types(db, self.types, self.types_priority,
+                      batch_size=self.types_batch_size, dry_run=self.types_dry_run, verbose=self.verbose)
 
     def process_person_ids(self, client):
         db = client[self.database_name]
@@ -140,6 +168,26 @@ class Kahi_impactu_postcalculations(KahiBase):
             db["events"],
             db["projects"],
         ]
+        # authors.id is rewritten without updating updated.time, the changed persons (old and new ids)
+        # are recorded for the next incremental denormalization
+        if self.person_ids_rollback:
+            print("INFO: Restoring the original ids of the authors")
+            if rollback_person_ids(db, product_cols, db[MAPPING_COLLECTION],
+                                   batch_size=self.person_ids_batch_size):
+                require_full_denormalization(db)
+            return
+        if self.person_ids_mode == "bulk":
+            mapped = compute_person_ids_mapping(
+                db, self.person_priority, db[MAPPING_COLLECTION], batch_size=self.person_ids_batch_size)
+            print(f"INFO: {mapped} authors mapped to persistent ids")
+            for product_col in product_cols:
+                product_col.create_index("authors.id")
+            add_denormalization_pending(db, "person", [
+                idx for reg in db[MAPPING_COLLECTION].find({"applied": False}, {"new_id": 1})
+                for idx in (reg["_id"], reg["new_id"])])
+            apply_person_ids_mapping(
+                db, product_cols, db[MAPPING_COLLECTION], batch_size=self.person_ids_batch_size)
+            return
         for source in self.person_priority:
             print("INFO: PERSISTENT ID SOURCE  ", source)
             # Paso 1: Buscar todos los documentos 'person' (con o sin COD_RH)
@@ -153,67 +201,18 @@ class Kahi_impactu_postcalculations(KahiBase):
                 cursor = db["person"].find(
                     {"_id_old": {"$exists": False}, "external_ids.source": source})
 
-            Parallel(n_jobs=self.n_jobs, backend="threading", verbose=10)(
+            processed = Parallel(n_jobs=self.n_jobs, backend="threading", verbose=10)(
                 delayed(process_person_id)(client, db["person"], product_cols, person, source) for person in cursor
             )
+            if processed:
+                require_full_denormalization(db)
 
-    def run(self):
+    def process_networks(self, client, impactu_client):
         """
-        Execute the plugin to create co-authorship networks and extract top words.
+        Create the co-authorship networks running the queries for every affiliation and author.
         """
-
-        client = MongoClient(self.mongodb_url)
         db = client[self.database_name]
 
-        impactu_client = MongoClient(self.impactu_database_url)
-
-        openalex_client = MongoClient(self.openalex_database_url)
-        openalex_db = openalex_client[self.openalex_database_name]
-
-        print("INFO: Setting up persistent ids for authors")
-        self.process_person_ids(client)
-
-        print("INFO: Setting up impactu types for works")
-        self.process_types(db)
-        print(f"INFO: Denormalizing data in {self.database_name}")
-        denormalize(
-            db,
-            parallel_collections=self.parallel_collections,
-            max_parallel_jobs=self.collection_jobs,
-        )
-
-        print(f"INFO: Creating indexes in db {self.database_name} for backend")
-        db["works"].create_index("authors.id")
-        db["patents"].create_index("authors.id")
-        db["events"].create_index("authors.id")
-        db["projects"].create_index("authors.id")
-        create_indexes(db)
-
-        print("INFO: Setting up topics for works")
-        works_cursor = db["works"].find(
-            {"primary_topic": {}},
-            {
-                "titles": 1,
-                "abstracts": 1,
-                "source": 1,
-                "primary_topic": 1,
-                "topics": 1,
-            },
-        )
-        Parallel(
-            n_jobs=self.n_jobs,
-            verbose=10,
-            backend="threading",
-        )(
-            delayed(process_topic)(
-                db["works"],
-                openalex_db["topics"],
-                work,
-                self.inference_endpoint,
-            )
-            for work in works_cursor
-        )
-
         print("INFO: Getting authors and affiliations ids")
         institutions_ids = []
         for aff in db["affiliations"].find(
@@ -228,7 +227,7 @@ class Kahi_impactu_postcalculations(KahiBase):
 
         print("INFO: Creating affiliations networks")
         if institutions_ids:
-            Parallel(
+            stats = Parallel(
                 n_jobs=self.n_jobs,
                 verbose=10,
                 backend=self.backend,
@@ -244,6 +243,7 @@ class Kahi_impactu_postcalculations(KahiBase):
                 )
                 for idx in institutions_ids
             )
+            self._print_expansion_stats("affiliations", stats)
 
         print("INFO: Checking authors with works")
         authors_ids = [x["_id"] for x in db["person"].find({}, {"_id": 1})]
@@ -262,7 +262,7 @@ class Kahi_impactu_postcalculations(KahiBase):
         print(f"INFO: total authors {len(authors_ids)}")
         print("INFO: Creating authors networks")
         if authors_ids:
-            Parallel(
+            stats = Parallel(
                 n_jobs=self.n_jobs,
                 verbose=10,
                 backend=self.backend,
@@ -278,6 +278,23 @@ class Kahi_impactu_postcalculations(KahiBase):
                 )
                 for idx in authors_ids
             )
+            self._print_expansion_stats("person", stats)
+
+    def _print_expansion_stats(self, net, stats):
+        """
+        Print the total of round-trips saved by the batched neighbour expansion.
+        """
+        stats = [s for s in stats if s]
+        queries = sum(s["queries"] for s in stats)
+        saved = sum(s["saved"] for s in stats)
+        print(
+            f"INFO: {net} networks: {len(stats)} networks, {queries} neighbour queries, {saved} round-trips saved")
+
+    def process_top_words(self, client, impactu_client):
+        """
+        Create the top words running the queries and the NLP for every affiliation and author.
+        """
+        db = client[self.database_name]
 
         print("INFO: Creating top words for institutions")
         affiliations_cursor = list(db["affiliations"].find({}, {"_id": 1}))
@@ -342,3 +359,135 @@ class Kahi_impactu_postcalculations(KahiBase):
             )
             for author in authors_cursor
         )
+
+    def get_denormalization_watermark(self, impactu_client):
+        """
+        Get the start time of the last denormalization of the database, None if there is no previous run.
+        """
+        reg = impactu_client[self.impactu_database_name][DENORMALIZATION_WATERMARK_COLLECTION].find_one(
+            {"_id": self.database_name})
+        return reg["time"] if reg else None
+
+    def set_denormalization_watermark(self, impactu_client, watermark):
+        """
+        Save the start time of the current denormalization of the database.
+        """
+        impactu_client[self.impactu_database_name][DENORMALIZATION_WATERMARK_COLLECTION].update_one(
+            {"_id": self.database_name}, {"$set": {"time": watermark}}, upsert=True)
+
+    def run(self):
+        """
+        Execute the plugin to create co-authorship networks and extract top words.
+        """
+
+        client = MongoClient(self.mongodb_url)
+        db = client[self.database_name]
+
+        impactu_client = MongoClient(self.impactu_database_url)
+
+        openalex_client = MongoClient(self.openalex_database_url)
+        openalex_db = openalex_client[self.openalex_database_name]
+
+        print("INFO: Setting up persistent ids for authors")
+        self.process_person_ids(client)
+
+        print("INFO: Setting up impactu types for works")
+        self.process_types(db)
+        print(f"INFO: Denormalizing data in {self.database_name}")
+        denormalization_start = int(time())
+        since = None
+        changed_ids = None
+        if self.denormalization_mode == "incremental":
+            since = self.get_denormalization_watermark(impactu_client)
+            changed_ids = denormalization_pending(db)
+            if since is None:
+                print("INFO: no denormalization watermark found, running the full denormalization")
+            elif changed_ids is None:
+                print("INFO: too many changes without updated.time, running the full denormalization")
+                since = None
+        denormalize(
+            db,
+            parallel_collections=self.parallel_collections,
+            max_parallel_jobs=self.collection_jobs,
+            works_engine=self.denormalization_engine,
+            works_batch_size=self.denormalization_batch_size,
+            chunk_settings=self.denormalization_chunks,
+            changed_ids=changed_ids if since is not None else None,
+            since=since,
+            save_entities=self.denormalization_mode == "incremental",
+        )
+        if self.denormalization_mode == "incremental":
+            # the watermark, the pending ids and the entities of the works are only kept by the incremental runs
+            clear_denormalization_pending(db)
+            self.set_denormalization_watermark(
+                impactu_client, denormalization_start)
+
+        print(f"INFO: Creating indexes in db {self.database_name} for backend")
+        db["works"].create_index("authors.id")
+        db["patents"].create_index("authors.id")
+        db["events"].create_index("authors.id")
+        db["projects"].create_index("authors.id")
+        create_indexes(db)
+
+        print("INFO: Setting up topics for works")
+        works_cursor = db["works"].find(
+            {"primary_topic": {}},
+            {
+                "titles": 1,
+                "abstracts": 1,
+                "source": 1,
+                "primary_topic": 1,
+                "topics": 1,
+            },
+        )
+        topics_stats = process_topics(
+            db["works"],
+            openalex_db["topics"],
+            works_cursor,
+            self.inference_endpoint,
+            batch_size=self.inference_batch_size,
+            concurrency=self.inference_concurrency,
+            retries=self.inference_retries,
+            cache=impactu_client[self.impactu_database_name][PREDICTIONS_COLLECTION] if self.inference_cache else None,
+            model_version=self.inference_model_version,
+            verbose=self.verbose,
+        )
+        # the topics are set after the denormalization without updating updated.time,
+        # the works updated are recorded for the next incremental denormalization (normalize_source_topics)
+        add_denormalization_pending(db, "works", topics_stats["ids"])
+
+        if self.network_engine == "single_pass":
+            create_networks(
+                db,
+                impactu_client[self.impactu_database_name],
+                self.author_count,
+                batch_size=self.network_batch_size,
+                verbose=self.verbose,
+            )
+        else:
+            self.process_networks(client, impactu_client)
+
+        if self.top_words_engine == "bulk":
+            create_top_words(
+                db,
+                impactu_client[self.impactu_database_name],
+                self.es_model,
+                self.en_model,
+                self.stopwords,
+                batch_size=self.nlp_batch_size,
+                n_process=self.nlp_n_process,
+                verbose=self.verbose,
+            )
+        elif self.top_words_engine == "incremental":
+            create_top_words_incremental(
+                db,
+                impactu_client[self.impactu_database_name],
+                self.es_model,
+                self.en_model,
+                self.stopwords,
+                batch_size=self.nlp_batch_size,
+                n_process=self.nlp_n_process,
+                verbose=self.verbose,
+            )
+        else:
+            self.process_top_words(client, impactu_client)
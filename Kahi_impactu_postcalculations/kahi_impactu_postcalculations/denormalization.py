@@ -1,11 +1,23 @@
 from joblib import Parallel, delayed
+from functools import partial, update_wrapper
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from array import array
+from time import time
 from pymongo import UpdateOne
+import numpy as np
 
-PARALLEL_SAFE_COLLECTIONS = {"sources", "person", "affiliations"}
-WORKS_DATES_CHUNK_BUCKETS = 16
-WORKS_DATES_CHUNK_WORKERS = 4
-WORKS_DATES_MIN_DOCS_TO_CHUNK = 100000
+WORKS_CHUNK_BUCKETS = 16
+WORKS_CHUNK_WORKERS = 4
+WORKS_MIN_DOCS_TO_CHUNK = 100000
+WORKS_DENORMALIZATION_BATCH_SIZE = 1000
+H_INDEX_BULK_SIZE = 500
+INCREMENTAL_MAX_IDS = 200000
+SCOPE_QUERY_SIZE = 10000
+DENORMALIZATION_WATERMARK_COLLECTION = "denormalization_watermark"
+DENORMALIZATION_PENDING_COLLECTION = "denormalization_pending"
+DENORMALIZATION_ENTITIES_COLLECTION = "denormalization_entities"
+SCOPE_ENTITIES = ("person", "affiliations", "sources")
 
 
 def _build_objectid_ranges(collection, match_query, buckets):
@@ -40,30 +52,33 @@ def _build_objectid_ranges(collection, match_query, buckets):
     ))
 
 
-def _run_chunked_aggregate_by_id(
+def _run_chunked_by_id(
     collection,
     base_match,
-    pipeline_tail,
+    run,
     pipeline_name,
     chunk_buckets,
     chunk_workers,
     min_docs_to_chunk,
+    ids=None,
 ):
     """
-    Run one aggregation pipeline in parallel chunks over non-overlapping _id ranges.
+    Call run(match) in parallel chunks over non-overlapping _id ranges of the documents matching base_match,
+    restricted to ids if they are given.
     """
+    if ids is not None:
+        base_match = {"$and": [base_match, {"_id": {"$in": list(ids)}}]}
     docs_to_process = collection.count_documents(base_match)
     if docs_to_process == 0:
         print(f"INFO: {pipeline_name}: no matching docs")
         return
 
-    full_pipeline = [{"$match": base_match}] + pipeline_tail
     if docs_to_process < min_docs_to_chunk or chunk_buckets <= 1 or chunk_workers <= 1:
         print(
             f"INFO: {pipeline_name}: running sequentially "
             f"for {docs_to_process} docs"
         )
-        collection.aggregate(full_pipeline, allowDiskUse=True)
+        run(base_match)
         return
 
     ranges = _build_objectid_ranges(collection, base_match, chunk_buckets)
@@ -72,7 +87,7 @@ def _run_chunked_aggregate_by_id(
             f"INFO: {pipeline_name}: single range detected, "
             "running sequentially"
         )
-        collection.aggregate(full_pipeline, allowDiskUse=True)
+        run(base_match)
         return
 
     workers = min(chunk_workers, len(ranges))
@@ -93,10 +108,7 @@ def _run_chunked_aggregate_by_id(
                 },
             ]
         }
-        collection.aggregate(
-            [{"$match": range_match}] + pipeline_tail,
-            allowDiskUse=True,
-        )
+        run(range_match)
 
     Parallel(n_jobs=workers, prefer="threads", backend="threading")(
         delayed(_run_one_range)(range_info)
@@ -104,93 +116,196 @@ def _run_chunked_aggregate_by_id(
     )
 
 
-def _compute_h_index(citations: list[int]) -> int:
+def _run_chunked_aggregate_by_id(
+    collection,
+    base_match,
+    pipeline_tail,
+    pipeline_name,
+    chunk_buckets,
+    chunk_workers,
+    min_docs_to_chunk,
+    ids=None,
+):
     """
-    Compute the h-index given a list of citation counts.
+    Run one aggregation pipeline in parallel chunks over non-overlapping _id ranges.
     """
-    sorted_cits = sorted((c for c in citations if c is not None), reverse=True)
-    return sum(1 for i, c in enumerate(sorted_cits, 1) if c >= i)
+    _run_chunked_by_id(
+        collection,
+        base_match,
+        lambda match: collection.aggregate(
+            [{"$match": match}] + pipeline_tail,
+            allowDiskUse=True,
+        ),
+        pipeline_name,
+        chunk_buckets,
+        chunk_workers,
+        min_docs_to_chunk,
+        ids,
+    )
 
 
-def _build_citations_pipeline(local_field: str, h5_start_year: int, h5_end_year: int) -> list:
+def _run_chunked_update_by_id(
+    collection,
+    base_match,
+    update,
+    pipeline_name,
+    chunk_buckets,
+    chunk_workers,
+    min_docs_to_chunk,
+    ids=None,
+):
     """
-    Build the aggregation pipeline to compute h-index and h5-index.
+    Run one update_many in parallel chunks over non-overlapping _id ranges.
     """
-    return [
-        {
-            "$lookup": {
-                "from": "works",
-                "localField": "_id",
-                "foreignField": local_field,
-                "as": "work",
-                "pipeline": [
-                    {
-                        "$project": {
-                            "_id": 0,
-                            "year_published": 1,
-                            "citations_count_openalex": 1
-                        }
-                    }
-                ]
-            }
-        },
-        {
-            "$project": {
-                "_id": 1,
-                "all_citations": "$work.citations_count_openalex",
-                "h5_citations": {
-                    "$map": {
-                        "input": {
-                            "$filter": {
-                                "input": "$work",
-                                "as": "w",
-                                "cond": {
-                                    "$and": [
-                                        {"$gte": ["$$w.year_published", h5_start_year]},
-                                        {"$lte": ["$$w.year_published", h5_end_year]}
-                                    ]
-                                }
-                            }
-                        },
-                        "as": "w",
-                        "in": "$$w.citations_count_openalex"
-                    }
-                }
-            }
-        }
-    ]
+    _run_chunked_by_id(
+        collection,
+        base_match,
+        lambda match: collection.update_many(match, update),
+        pipeline_name,
+        chunk_buckets,
+        chunk_workers,
+        min_docs_to_chunk,
+        ids,
+    )
 
 
-def _set_h_index_metrics(collection, into_collection_name, local_field) -> None:
+def _field_values(doc, path):
+    """
+    Get the values of a dotted path in a document, going through the arrays like a MongoDB query.
     """
-    Set h-index and h5-index for documents in the collection based on citations.
+    values = [doc]
+    for key in path.split("."):
+        next_values = []
+        for value in values:
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict) and key in item:
+                    next_values.append(item[key])
+        values = next_values
+    flat = []
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _compute_h_indexes(entities, citations, size):
+    """
+    Compute the h-index of many entities at once.
+
+    Parameters
+    ----------
+    entities : array.array
+        Position of the entity of every citation count
+    citations : array.array
+        Citation counts of the works of the entities
+    size : int
+        Number of entities
+
+    Returns
+    -------
+    numpy.ndarray
+        h-index of every entity position
+    """
+    if len(citations) == 0:
+        return np.zeros(size, dtype=np.int64)
+    entities = np.frombuffer(entities, dtype=np.int64)
+    citations = np.frombuffer(citations, dtype=np.float64)
+    # citations sorted in descending order inside every entity, the rank is the position inside the entity
+    order = np.lexsort((-citations, entities))
+    entities = entities[order]
+    citations = citations[order]
+    rank = np.arange(1, len(entities) + 1) - \
+        np.searchsorted(entities, entities, side="left")
+    return np.bincount(entities[citations >= rank], minlength=size)
+
+
+def _set_h_index_metrics(database, targets, batch_size=H_INDEX_BULK_SIZE) -> None:
+    """
+    Set h-index and h5-index for the entities of one or several collections based on citations.
+
+    The works are read once, projected to the entity fields of all the targets, year_published and
+    citations_count_openalex, the citations of every entity are accumulated in flat arrays and the indexes
+    are computed with numpy. Every work is counted once per entity, also when the entity appears several times in the work.
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+        Database with the works and the entities
+    targets : list
+        (into_collection_name, local_field, ids) for every collection of entities: the collection where the indexes
+        are written, the field of the works with the _id of the entities and the _id of the entities to process
+        (None for all the entities)
+    batch_size : int
+        Number of updates per bulk write
     """
     current_year = datetime.now().year
     h5_start_year = current_year - 5
     h5_end_year = current_year - 1
 
-    pipeline = _build_citations_pipeline(local_field, h5_start_year, h5_end_year)
-    cursor = collection.aggregate(pipeline, allowDiskUse=True)
-
-    bulk_ops = []
-    for doc in cursor:
-        h_index = _compute_h_index(doc.get("all_citations") or [])
-        h5_index = _compute_h_index(doc.get("h5_citations") or [])
-        bulk_ops.append(
-            UpdateOne(
-                {"_id": doc["_id"]},
-                {"$set": {"h_index": h_index, "h5_index": h5_index}}
+    buffers = []
+    for _, local_field, ids in targets:
+        buffers.append({
+            "field": local_field,
+            "allowed": set(ids) if ids is not None else None,
+            "positions": {},
+            "all": (array("q"), array("d")),
+            "h5": (array("q"), array("d")),
+        })
+    if any(ids is None for _, _, ids in targets):
+        query = {}
+    else:
+        query = {"$or": [{local_field: {"$in": list(ids)}} for _, local_field, ids in targets]}
+    projection = {"_id": 0, "year_published": 1, "citations_count_openalex": 1}
+    projection.update({local_field: 1 for _, local_field, _ in targets})
+    for work in database["works"].find(query, projection):
+        citations = work.get("citations_count_openalex")
+        if not _is_number(citations):
+            continue
+        year = work.get("year_published")
+        in_h5 = _is_number(year) and h5_start_year <= year <= h5_end_year
+        for buffer in buffers:
+            for idx in set(value for value in _field_values(work, buffer["field"]) if _hashable(value)):
+                if buffer["allowed"] is not None and idx not in buffer["allowed"]:
+                    continue
+                position = buffer["positions"].setdefault(idx, len(buffer["positions"]))
+                buffer["all"][0].append(position)
+                buffer["all"][1].append(citations)
+                if in_h5:
+                    buffer["h5"][0].append(position)
+                    buffer["h5"][1].append(citations)
+
+    for (into_collection_name, _, ids), buffer in zip(targets, buffers):
+        positions = buffer["positions"]
+        h_indexes = _compute_h_indexes(*buffer["all"], len(positions))
+        h5_indexes = _compute_h_indexes(*buffer["h5"], len(positions))
+
+        into_collection = database[into_collection_name]
+        entities_query = {"_id": {"$in": list(ids)}} if ids is not None else {}
+        bulk_ops = []
+        for doc in into_collection.find(entities_query, {"_id": 1}):
+            position = positions.get(doc["_id"])
+            bulk_ops.append(
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {
+                        "h_index": int(h_indexes[position]) if position is not None else 0,
+                        "h5_index": int(h5_indexes[position]) if position is not None else 0,
+                    }}
+                )
             )
-        )
-        if len(bulk_ops) >= 500:
-            collection.database[into_collection_name].bulk_write(bulk_ops, ordered=False)
-            bulk_ops = []
+            if len(bulk_ops) >= batch_size:
+                into_collection.bulk_write(bulk_ops, ordered=False)
+                bulk_ops = []
 
-    if bulk_ops:
-        collection.database[into_collection_name].bulk_write(bulk_ops, ordered=False)
+        if bulk_ops:
+            into_collection.bulk_write(bulk_ops, ordered=False)
 
 
-def set_works_authors_affiliations_country(collection) -> None:
+def set_works_authors_affiliations_country(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                           min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Method to set the country of the affiliations of the authors of the works
 
@@ -198,13 +313,19 @@ def set_works_authors_affiliations_country(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "authors.affiliations.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "authors.affiliations.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "affiliations",
@@ -287,10 +408,20 @@ def set_works_authors_affiliations_country(collection) -> None:
             }
         },
     ]
-    collection.aggregate(pipeline)  # works collections
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_authors_affiliations_country",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_authors_affiliations_country_code(collection) -> None:
+def set_works_authors_affiliations_country_code(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                                min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Method to set the country code of the affiliations of the authors of the works
 
@@ -298,13 +429,19 @@ def set_works_authors_affiliations_country_code(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "authors.affiliations.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "authors.affiliations.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "affiliations",
@@ -387,10 +524,20 @@ def set_works_authors_affiliations_country_code(collection) -> None:
             }
         },
     ]
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_authors_affiliations_country_code",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_groups_ranking(collection) -> None:
+def set_works_groups_ranking(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                             min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to set the ranking of the groups of the works
 
@@ -398,13 +545,19 @@ def set_works_groups_ranking(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "groups.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "groups.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "affiliations",
@@ -491,10 +644,20 @@ def set_works_groups_ranking(collection) -> None:
             }
         },
     ]
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_groups_ranking",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_authors_ranking(collection) -> None:
+def set_works_authors_ranking(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                              min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to set the ranking of the authors
 
@@ -502,13 +665,19 @@ def set_works_authors_ranking(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "authors.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "authors.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "person",
@@ -595,10 +764,20 @@ def set_works_authors_ranking(collection) -> None:
             }
         },
     ]
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_authors_ranking",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_citations_count_openalex(collection) -> None:
+def set_works_citations_count_openalex(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                       min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to set the OpenAlex citations count in works
 
@@ -606,6 +785,14 @@ def set_works_citations_count_openalex(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
     pipeline = [
         {
@@ -635,18 +822,25 @@ def set_works_citations_count_openalex(collection) -> None:
         }
     ]
 
-    collection.update_many(
-        {
+    _run_chunked_update_by_id(
+        collection=collection,
+        base_match={
             "$or": [
                 {"citations_count.source": "openalex"},
                 {"citations_count_openalex": {"$exists": False}},
             ]
         },
-        pipeline,
+        update=pipeline,
+        pipeline_name="set_works_citations_count_openalex",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
     )
 
 
-def set_works_authors_full_data(collection) -> None:
+def set_works_authors_full_data(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to enrich works authors with full person data
 
@@ -654,13 +848,19 @@ def set_works_authors_full_data(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "authors.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "authors.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "person",
@@ -733,10 +933,20 @@ def set_works_authors_full_data(collection) -> None:
         },
     ]
 
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_authors_full_data",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_authors_affiliations_dates(collection) -> None:
+def set_works_authors_affiliations_dates(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                         min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to set authors affiliations start and end dates in works
 
@@ -744,6 +954,14 @@ def set_works_authors_affiliations_dates(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
     base_match = {
         "authors.affiliations.id": {"$exists": True}
@@ -886,13 +1104,15 @@ def set_works_authors_affiliations_dates(collection) -> None:
         base_match=base_match,
         pipeline_tail=pipeline_tail,
         pipeline_name="set_works_authors_affiliations_dates",
-        chunk_buckets=WORKS_DATES_CHUNK_BUCKETS,
-        chunk_workers=WORKS_DATES_CHUNK_WORKERS,
-        min_docs_to_chunk=WORKS_DATES_MIN_DOCS_TO_CHUNK,
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
     )
 
 
-def set_works_source_full_data(collection) -> None:
+def set_works_source_full_data(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                               min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to enrich works source with full source data
 
@@ -900,13 +1120,19 @@ def set_works_source_full_data(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "source.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "source.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "sources",
@@ -948,7 +1174,16 @@ def set_works_source_full_data(collection) -> None:
         },
     ]
 
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_source_full_data",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
 def set_person_affiliations_relations(collection) -> None:
@@ -1054,7 +1289,8 @@ def set_person_affiliations_relations(collection) -> None:
     collection.aggregate(pipeline)
 
 
-def set_works_authors_affiliations_external_data(collection) -> None:
+def set_works_authors_affiliations_external_data(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                                 min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to enrich works authors affiliations with external_ids and addresses data
 
@@ -1062,13 +1298,19 @@ def set_works_authors_affiliations_external_data(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "authors.affiliations.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "authors.affiliations.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "affiliations",
@@ -1206,10 +1448,20 @@ def set_works_authors_affiliations_external_data(collection) -> None:
         },
     ]
 
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_authors_affiliations_external_data",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_groups_citations_count(collection) -> None:
+def set_works_groups_citations_count(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                     min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to set citations count for groups inside works
 
@@ -1217,16 +1469,22 @@ def set_works_groups_citations_count(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "groups": {
-                    "$exists": True,
-                    "$ne": [],
-                }
-            }
-        },
+    base_match = {
+        "groups": {
+            "$exists": True,
+            "$ne": [],
+        }
+    }
+    pipeline_tail = [
         {"$unwind": "$groups"},
         {
             "$lookup": {
@@ -1299,10 +1557,20 @@ def set_works_groups_citations_count(collection) -> None:
         },
     ]
 
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_groups_citations_count",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def set_works_groups_ranking_to_works_collection(collection) -> None:
+def set_works_groups_ranking_to_works_collection(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                                 min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to set ranking data for groups inside works
 
@@ -1310,13 +1578,19 @@ def set_works_groups_ranking_to_works_collection(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
-    pipeline = [
-        {
-            "$match": {
-                "groups.id": {"$exists": True}
-            }
-        },
+    base_match = {
+        "groups.id": {"$exists": True}
+    }
+    pipeline_tail = [
         {
             "$lookup": {
                 "from": "affiliations",
@@ -1408,10 +1682,20 @@ def set_works_groups_ranking_to_works_collection(collection) -> None:
         },
     ]
 
-    collection.aggregate(pipeline)
+    _run_chunked_aggregate_by_id(
+        collection=collection,
+        base_match=base_match,
+        pipeline_tail=pipeline_tail,
+        pipeline_name="set_works_groups_ranking_to_works_collection",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
+    )
 
 
-def clean_works_authors_affiliations_country_fields(collection) -> None:
+def clean_works_authors_affiliations_country_fields(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                                    min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to remove country and country_code fields from authors affiliations in works
 
@@ -1419,6 +1703,14 @@ def clean_works_authors_affiliations_country_fields(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
     pipeline = [
         {
@@ -1472,18 +1764,25 @@ def clean_works_authors_affiliations_country_fields(collection) -> None:
         }
     ]
 
-    collection.update_many(
-        {
+    _run_chunked_update_by_id(
+        collection=collection,
+        base_match={
             "$or": [
                 {"authors.affiliations.country": {"$exists": True}},
                 {"authors.affiliations.country_code": {"$exists": True}},
             ]
         },
-        pipeline,
+        update=pipeline,
+        pipeline_name="clean_works_authors_affiliations_country_fields",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
     )
 
 
-def normalize_works_authors_ranking_empty_list(collection) -> None:
+def normalize_works_authors_ranking_empty_list(collection, chunk_buckets=WORKS_CHUNK_BUCKETS, chunk_workers=WORKS_CHUNK_WORKERS,
+                                               min_docs_to_chunk=WORKS_MIN_DOCS_TO_CHUNK, ids=None) -> None:
     """
     Function to replace null authors ranking with empty list in works
 
@@ -1491,6 +1790,14 @@ def normalize_works_authors_ranking_empty_list(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Collection where the works are stored
+    chunk_buckets : int
+        Number of _id ranges the works are split in
+    chunk_workers : int
+        Number of ranges processed at the same time
+    min_docs_to_chunk : int
+        Minimum number of matching works to run in chunks
+    ids : list
+        _id of the works to process, None for all the works
     """
     pipeline = [
         {
@@ -1524,12 +1831,331 @@ def normalize_works_authors_ranking_empty_list(collection) -> None:
         }
     ]
 
-    collection.update_many(
-        {"authors.ranking": None},
-        pipeline,
+    _run_chunked_update_by_id(
+        collection=collection,
+        base_match={"authors.ranking": None},
+        update=pipeline,
+        pipeline_name="normalize_works_authors_ranking_empty_list",
+        chunk_buckets=chunk_buckets,
+        chunk_workers=chunk_workers,
+        min_docs_to_chunk=min_docs_to_chunk,
+        ids=ids,
     )
 
 
+AFFILIATION_ADDRESS_FIELDS = (
+    ("lat", "latitude"),
+    ("lng", "longitude"),
+    ("city", "city"),
+    ("country", "country"),
+    ("country_code", "country_code"),
+)
+PERSON_FULL_DATA_FIELDS = ("sex", "full_name", "first_names",
+                           "last_names", "ranking", "external_ids")
+SOURCE_FULL_DATA_FIELDS = ("names", "types", "external_ids", "updated",
+                           "publisher", "ranking", "apc", "external_urls")
+WORKS_DENORMALIZED_FIELDS = ("authors", "groups", "source",
+                             "citations_count", "citations_count_openalex")
+
+
+def load_affiliations_table(db):
+    """
+    Load the affiliations data used to denormalize the works in a hash map keyed by _id.
+
+    Every entry has the ranking, the citations_count (only for groups), the external_ids
+    and the addresses with the same fields set by set_works_authors_affiliations_external_data.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database with the affiliations collection
+
+    Returns
+    -------
+    dict
+        _id -> affiliation data
+    """
+    table = {}
+    projection = {"ranking": 1, "types.type": 1,
+                  "citations_count": 1, "external_ids": 1, "addresses": 1}
+    for aff in db["affiliations"].find({}, projection):
+        data = {
+            "ranking": aff.get("ranking"),
+            "addresses": [
+                {new: addr[old]
+                    for old, new in AFFILIATION_ADDRESS_FIELDS if old in addr}
+                for addr in aff.get("addresses") or []
+            ],
+        }
+        if aff.get("external_ids") is not None:
+            data["external_ids"] = aff["external_ids"]
+        if "citations_count" in aff and any(t.get("type") == "group" for t in aff.get("types") or []):
+            data["citations_count"] = aff["citations_count"]
+        table[aff["_id"]] = data
+    return table
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _work_lookup_ids(work):
+    """
+    Get the person and source ids of a work needed to denormalize it.
+    """
+    person_ids = set()
+    for author in work.get("authors") or []:
+        if isinstance(author, dict) and _hashable(author.get("id")):
+            person_ids.add(author.get("id"))
+    source = work.get("source")
+    source_ids = []
+    if isinstance(source, dict) and "id" in source:
+        source_ids = source["id"] if isinstance(
+            source["id"], list) else [source["id"]]
+    return person_ids, set(idx for idx in source_ids if _hashable(idx))
+
+
+def _denormalized_affiliation(aff, person_affiliations, affiliations):
+    """
+    Affiliation of an author with the dates of the person affiliation and the external data of the affiliation,
+    the country fields are removed.
+    """
+    aff = {k: v for k, v in aff.items() if k not in (
+        "country", "country_code")}
+    match = None
+    for person_aff in person_affiliations:
+        if person_aff.get("id") == aff.get("id"):
+            match = person_aff
+            break
+    for field in ("start_date", "end_date"):
+        value = match.get(field) if match else None
+        if value is not None:
+            aff[field] = value
+    data = affiliations.get(aff.get("id")) if _hashable(
+        aff.get("id")) else None
+    for field in ("external_ids", "addresses"):
+        value = data.get(field) if data else None
+        if value is not None:
+            aff[field] = value
+    return aff
+
+
+def denormalize_work(work, affiliations, persons, sources):
+    """
+    Compute the denormalized fields of a work in memory, with the same result of running
+    the works pipelines of DENORMALIZATION_PIPELINES one after another.
+
+    The country and country_code of the affiliations are not computed because
+    clean_works_authors_affiliations_country_fields removes them at the end.
+
+    Parameters
+    ----------
+    work : dict
+        Work document with the fields in WORKS_DENORMALIZED_FIELDS
+    affiliations : dict
+        Affiliations table built by load_affiliations_table
+    persons : dict
+        _id -> person document with the fields in PERSON_FULL_DATA_FIELDS and the affiliations dates
+    sources : dict
+        _id -> source document with the fields in SOURCE_FULL_DATA_FIELDS
+
+    Returns
+    -------
+    dict
+        Fields of the work that changed with the new values.
+    """
+    updates = {}
+
+    authors = work.get("authors")
+    if isinstance(authors, list):
+        author_docs = [a for a in authors if isinstance(a, dict)]
+        has_author_ids = any("id" in a for a in author_docs)
+        has_affiliation_ids = False
+        has_country = False
+        for author in author_docs:
+            affs = author.get("affiliations")
+            for aff in affs if isinstance(affs, list) else [affs]:
+                if isinstance(aff, dict):
+                    has_affiliation_ids |= "id" in aff
+                    has_country |= "country" in aff or "country_code" in aff
+        new_authors = []
+        for author in authors:
+            if not isinstance(author, dict):
+                new_authors.append(author)
+                continue
+            author = dict(author)
+            person = persons.get(author.get("id")) if _hashable(
+                author.get("id")) else None
+            if has_affiliation_ids:
+                person_affiliations = person.get(
+                    "affiliations") or [] if person else []
+                author["affiliations"] = [
+                    _denormalized_affiliation(
+                        aff, person_affiliations, affiliations)
+                    for aff in author.get("affiliations") or []
+                ]
+            elif has_country:
+                author["affiliations"] = [
+                    {k: v for k, v in aff.items() if k not in (
+                        "country", "country_code")}
+                    for aff in author.get("affiliations") or []
+                ]
+            if has_author_ids:
+                author["ranking"] = None
+                if person:
+                    author["id"] = person["_id"]
+                    for field in PERSON_FULL_DATA_FIELDS:
+                        if field in person:
+                            author[field] = person[field]
+            if "ranking" in author and author["ranking"] is None:
+                author["ranking"] = []
+            new_authors.append(author)
+        if new_authors != authors:
+            updates["authors"] = new_authors
+
+    groups = work.get("groups")
+    if isinstance(groups, list) and groups:
+        has_group_ids = any(isinstance(g, dict) and "id" in g for g in groups)
+        new_groups = []
+        for group in groups:
+            if not isinstance(group, dict):
+                new_groups.append(group)
+                continue
+            group = dict(group)
+            data = affiliations.get(group.get("id")) if _hashable(
+                group.get("id")) else None
+            if has_group_ids:
+                group["ranking"] = data["ranking"] if data and data["ranking"] is not None else []
+            if data and "citations_count" in data:
+                group["citations_count"] = data["citations_count"]
+            else:
+                group.pop("citations_count", None)
+            new_groups.append(group)
+        if new_groups != groups:
+            updates["groups"] = new_groups
+
+    source = work.get("source")
+    if isinstance(source, dict) and "id" in source:
+        source_ids = source["id"] if isinstance(
+            source["id"], list) else [source["id"]]
+        source_data = None
+        for idx in source_ids:
+            if _hashable(idx) and sources.get(idx) is not None:
+                source_data = sources[idx]
+        if source_data is not None:
+            new_source = dict(source)
+            for field in SOURCE_FULL_DATA_FIELDS:
+                if field in source_data:
+                    new_source[field] = source_data[field]
+            if new_source != source:
+                updates["source"] = new_source
+
+    citations_count = work.get("citations_count")
+    openalex = None
+    for count in citations_count if isinstance(citations_count, list) else []:
+        if isinstance(count, dict) and count.get("source") == "openalex":
+            openalex = count
+            break
+    if openalex is not None:
+        value = openalex.get("count")
+        value = 0 if value is None else value
+        if work.get("citations_count_openalex", object()) != value:
+            updates["citations_count_openalex"] = value
+    elif "citations_count_openalex" not in work:
+        updates["citations_count_openalex"] = 0
+
+    return updates
+
+
+def _denormalize_works_batch(collection, batch, affiliations, sources):
+    """
+    Denormalize a batch of works, the persons and the missing sources are fetched with one query each.
+
+    Returns
+    -------
+    int
+        Number of works updated.
+    """
+    db = collection.database
+    person_ids = set()
+    source_ids = set()
+    for work in batch:
+        work_person_ids, work_source_ids = _work_lookup_ids(work)
+        person_ids.update(work_person_ids)
+        source_ids.update(work_source_ids)
+
+    person_projection = {field: 1 for field in PERSON_FULL_DATA_FIELDS}
+    person_projection.update({
+        "affiliations.id": 1,
+        "affiliations.start_date": 1,
+        "affiliations.end_date": 1,
+    })
+    persons = {
+        person["_id"]: person
+        for person in db["person"].find({"_id": {"$in": list(person_ids)}}, person_projection)
+    } if person_ids else {}
+
+    missing = [idx for idx in source_ids if idx not in sources]
+    if missing:
+        for idx in missing:
+            sources[idx] = None
+        for source in db["sources"].find(
+                {"_id": {"$in": missing}}, {field: 1 for field in SOURCE_FULL_DATA_FIELDS}):
+            sources[source.pop("_id")] = source
+
+    operations = []
+    for work in batch:
+        updates = denormalize_work(work, affiliations, persons, sources)
+        if updates:
+            operations.append(UpdateOne({"_id": work["_id"]}, {"$set": updates}))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def set_works_denormalized_data(collection, batch_size=WORKS_DENORMALIZATION_BATCH_SIZE, ids=None) -> None:
+    """
+    Denormalize the works in a single pass, same result of the works pipelines of DENORMALIZATION_PIPELINES.
+
+    The affiliations are loaded in memory before the pass, the persons and sources are fetched for every
+    batch of works (the sources are kept for the next batches) and only the works with changes are written
+    with unordered bulk writes.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection where the works are stored
+    batch_size : int
+        Number of works processed and written per batch
+    ids : list
+        _id of the works to process, None for all the works
+    """
+    affiliations = load_affiliations_table(collection.database)
+    sources = {}
+    projection = {field: 1 for field in WORKS_DENORMALIZED_FIELDS}
+    processed = 0
+    updated = 0
+    batch = []
+    query = {"_id": {"$in": list(ids)}} if ids is not None else {}
+    for work in collection.find(query, projection):
+        batch.append(work)
+        if len(batch) >= batch_size:
+            updated += _denormalize_works_batch(collection,
+                                                batch, affiliations, sources)
+            processed += len(batch)
+            batch = []
+    if batch:
+        updated += _denormalize_works_batch(collection,
+                                            batch, affiliations, sources)
+        processed += len(batch)
+    print(
+        f"INFO: set_works_denormalized_data: {updated} of {processed} works updated")
+
+
 def set_affiliations_citations_count_openalex(collection) -> None:
     """
     Function to set the OpenAlex citations count in affiliations
@@ -1573,7 +2199,7 @@ def set_affiliations_citations_count_openalex(collection) -> None:
     collection.update_many({}, pipeline)
 
 
-def set_sources_products_count(collection) -> None:
+def set_sources_products_count(collection, ids=None) -> None:
     """
     Function to set products count in sources from works
 
@@ -1581,6 +2207,8 @@ def set_sources_products_count(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Sources collection
+    ids : list
+        _id of the sources to process, None for all the sources
     """
     works_collection = (
         collection.database["works"]
@@ -1625,6 +2253,13 @@ def set_sources_products_count(collection) -> None:
             }
         },
     ]
+    if ids is not None:
+        ids = list(ids)
+        pipeline.insert(0, {"$match": {"source.id": {"$in": ids}}})
+        # the works with several sources are counted only for the sources in ids,
+        # the others would be merged with a partial count
+        unwind = pipeline.index({"$unwind": "$_source_ids"})
+        pipeline.insert(unwind + 1, {"$match": {"_source_ids": {"$in": ids}}})
 
     works_collection.aggregate(pipeline)
 
@@ -1644,7 +2279,7 @@ def normalize_sources_products_count(collection) -> None:
     )
 
 
-def set_sources_citations_count_openalex(collection) -> None:
+def set_sources_citations_count_openalex(collection, ids=None) -> None:
     """
     Function to set total OpenAlex citations count in sources
 
@@ -1652,6 +2287,8 @@ def set_sources_citations_count_openalex(collection) -> None:
     ----------
     collection : pymongo.collection.Collection
         Sources collection
+    ids : list
+        _id of the sources to process, None for all the sources
     """
     works_collection = (
         collection.database["works"]
@@ -1728,6 +2365,13 @@ def set_sources_citations_count_openalex(collection) -> None:
             }
         },
     ]
+    if ids is not None:
+        ids = list(ids)
+        pipeline.insert(0, {"$match": {"source.id": {"$in": ids}}})
+        # the works with several sources are counted only for the sources in ids,
+        # the others would be merged with a partial count
+        unwind = pipeline.index({"$unwind": "$_source_ids"})
+        pipeline.insert(unwind + 1, {"$match": {"_source_ids": {"$in": ids}}})
 
     works_collection.aggregate(pipeline)
 
@@ -2529,9 +3173,9 @@ def normalize_source_open_access_status(collection) -> None:
     ], allowDiskUse=True)
 
 
-def normalize_source_topics(collection) -> None:
+def normalize_source_topics(collection, ids=None) -> None:
     collection.aggregate(
-        [
+        ([{"$match": {"_id": {"$in": list(ids)}}}] if ids is not None else []) + [
             {
                 "$project": {
                     "_id": 1,
@@ -2665,22 +3309,50 @@ def normalize_source_topics(collection) -> None:
     )
 
 
-def set_person_h_index_metrics(collection) -> None:
-    target = collection.database["person"] if collection.name in ("works", "person") else collection
-    _set_h_index_metrics(
-        collection=target,
-        into_collection_name="person",
-        local_field="authors.id"
-    )
+def set_person_h_index_metrics(collection, ids=None) -> None:
+    """
+    Set h-index and h5-index of persons from the citations count of their works.
 
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection of the persons
+    ids : list
+        _id of the persons to process, None for all the persons
+    """
+    _set_h_index_metrics(collection.database, [("person", "authors.id", ids)])
 
-def set_affiliations_h_index_metrics(collection) -> None:
-    target = collection.database["affiliations"] if collection.name in ("works", "affiliations") else collection
-    _set_h_index_metrics(
-        collection=target,
-        into_collection_name="affiliations",
-        local_field="authors.affiliations.id"
-    )
+
+def set_affiliations_h_index_metrics(collection, ids=None) -> None:
+    """
+    Set h-index and h5-index of affiliations from the citations count of their works.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Collection of the affiliations
+    ids : list
+        _id of the affiliations to process, None for all the affiliations
+    """
+    _set_h_index_metrics(collection.database, [("affiliations", "authors.affiliations.id", ids)])
+
+
+def set_h_index_metrics(collection, ids=None) -> None:
+    """
+    Set h-index and h5-index of persons and affiliations reading the works only once.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Any collection of the database
+    ids : dict
+        {"person": list of _id, "affiliations": list of _id} of the entities to process, None for all the entities
+    """
+    ids = ids or {}
+    _set_h_index_metrics(collection.database, [
+        ("person", "authors.id", ids.get("person")),
+        ("affiliations", "authors.affiliations.id", ids.get("affiliations")),
+    ])
 
 
 DENORMALIZATION_PIPELINES = {
@@ -2713,79 +3385,547 @@ DENORMALIZATION_PIPELINES = {
     "person": [
         set_person_affiliations_relations,
         clean_person_empty_affiliations_array,
-        set_person_h_index_metrics,
     ],
     "affiliations": [
         set_affiliations_citations_count_openalex,
-        set_affiliations_h_index_metrics,
+        set_h_index_metrics,
     ],
 }
 
 
-def _run_collection_pipelines(db, collection_name, pipelines):
-    collection = db[collection_name]
-    print(f"INFO: Denormalizing data in {collection_name}")
-    for pipeline_func in pipelines:
-        print(f"INFO: Running pipeline {pipeline_func.__name__}")
-        pipeline_func(collection)
+# Collections and fields read and written by every pipeline ("collection" or "collection.field").
+# The pipelines that $merge whole documents read the whole collection, because the fields they do not
+# change are written back as they were read. Pipelines not declared here conflict with all the others.
+PIPELINE_ACCESS = {
+    "set_works_authors_affiliations_country": {
+        "reads": ["works", "affiliations.addresses"],
+        "writes": ["works.authors"],
+    },
+    "set_works_authors_affiliations_country_code": {
+        "reads": ["works", "affiliations.addresses"],
+        "writes": ["works.authors"],
+    },
+    "set_works_groups_ranking": {
+        "reads": ["works", "affiliations.ranking"],
+        "writes": ["works.groups"],
+    },
+    "set_works_authors_ranking": {
+        "reads": ["works", "person.ranking"],
+        "writes": ["works.authors"],
+    },
+    "set_works_citations_count_openalex": {
+        "reads": ["works.citations_count", "works.citations_count_openalex"],
+        "writes": ["works.citations_count_openalex"],
+    },
+    "set_works_authors_full_data": {
+        "reads": ["works"] + [f"person.{field}" for field in PERSON_FULL_DATA_FIELDS],
+        "writes": ["works.authors"],
+    },
+    "set_works_authors_affiliations_dates": {
+        "reads": ["works", "person.affiliations"],
+        "writes": ["works.authors"],
+    },
+    "set_works_source_full_data": {
+        "reads": ["works"] + [f"sources.{field}" for field in SOURCE_FULL_DATA_FIELDS],
+        "writes": ["works.source"],
+    },
+    "set_works_authors_affiliations_external_data": {
+        "reads": ["works", "affiliations.external_ids", "affiliations.addresses"],
+        "writes": ["works.authors"],
+    },
+    "set_works_groups_citations_count": {
+        "reads": ["works", "affiliations.types", "affiliations.citations_count"],
+        "writes": ["works.groups"],
+    },
+    "set_works_groups_ranking_to_works_collection": {
+        "reads": ["works", "affiliations.ranking"],
+        "writes": ["works.groups"],
+    },
+    "clean_works_authors_affiliations_country_fields": {
+        "reads": ["works.authors"],
+        "writes": ["works.authors"],
+    },
+    "normalize_works_authors_ranking_empty_list": {
+        "reads": ["works.authors"],
+        "writes": ["works.authors"],
+    },
+    "set_works_denormalized_data": {
+        "reads": [*(f"works.{field}" for field in WORKS_DENORMALIZED_FIELDS),
+                  "affiliations.ranking", "affiliations.types", "affiliations.citations_count",
+                  "affiliations.external_ids", "affiliations.addresses", "person.affiliations",
+                  *(f"person.{field}" for field in PERSON_FULL_DATA_FIELDS),
+                  *(f"sources.{field}" for field in SOURCE_FULL_DATA_FIELDS)],
+        "writes": ["works.authors", "works.groups", "works.source", "works.citations_count_openalex"],
+    },
+    "set_sources_products_count": {
+        "reads": ["works.source"],
+        "writes": ["sources.products_count"],
+    },
+    "normalize_sources_products_count": {
+        "reads": ["sources.products_count"],
+        "writes": ["sources.products_count"],
+    },
+    "set_sources_citations_count_openalex": {
+        "reads": ["works.source", "works.citations_count"],
+        "writes": ["sources.citations_count"],
+    },
+    "normalize_sources_citations_count": {
+        "reads": ["sources.citations_count"],
+        "writes": ["sources.citations_count"],
+    },
+    "normalize_sources_global_counts": {
+        "reads": ["sources.global_products_count", "sources.global_citations_count"],
+        "writes": ["sources.global_products_count", "sources.global_citations_count"],
+    },
+    "normalize_source_apc_usd": {
+        "reads": ["sources"],
+        "writes": ["sources.apc"],
+    },
+    "normalize_source_scimago_best_quartile": {
+        "reads": ["sources.ranking"],
+        "writes": ["sources.scimago_best_quartile"],
+    },
+    "normalize_source_open_access_status": {
+        "reads": ["sources.open_access_start_year", "sources.apc", "sources.open_access"],
+        "writes": ["sources.open_access_status"],
+    },
+    "normalize_source_topics": {
+        "reads": ["works.source", "works.primary_topic"],
+        "writes": ["sources.works_count_result", "sources.works_count", "sources.topics_threshold",
+                   "sources.all_topics", "sources.topics"],
+    },
+    "set_person_affiliations_relations": {
+        "reads": ["person", "affiliations.relations"],
+        "writes": ["person.affiliations"],
+    },
+    "clean_person_empty_affiliations_array": {
+        "reads": ["person.affiliations"],
+        "writes": ["person.affiliations"],
+    },
+    "set_affiliations_citations_count_openalex": {
+        "reads": ["affiliations.citations_count"],
+        "writes": ["affiliations.citations_count_openalex"],
+    },
+    "set_h_index_metrics": {
+        "reads": ["person._id", "affiliations._id", "works.authors", "works.year_published", "works.citations_count_openalex"],
+        "writes": ["person.h_index", "person.h5_index", "affiliations.h_index", "affiliations.h5_index"],
+    },
+}
 
 
-def denormalize(db, parallel_collections=None, max_parallel_jobs=None):
+def _overlap(path, other):
     """
-    Denormalize the data in all configured collections
+    Check if two paths (collection or collection.field) refer to the same data.
+    """
+    return path == other or path.startswith(other + ".") or other.startswith(path + ".")
+
+
+def _conflict(access, other):
+    """
+    Check if two pipelines can not run at the same time, one of them writes data read or written by the other.
+    """
+    if access is None or other is None:
+        return True
+    for write in access["writes"]:
+        if any(_overlap(write, path) for path in other["reads"] + other["writes"]):
+            return True
+    for write in other["writes"]:
+        if any(_overlap(write, path) for path in access["reads"]):
+            return True
+    return False
+
+
+def build_pipelines_dag(steps):
+    """
+    Build the dependencies between the pipelines given in the serial order.
+
+    A pipeline depends on every previous pipeline in conflict with it (PIPELINE_ACCESS), so running
+    the pipelines in any order that respects the dependencies gives the same result of the serial order.
+
+    Parameters
+    ----------
+    steps : list
+        List of (collection_name, pipeline_func) in serial order
+
+    Returns
+    -------
+    list
+        For every step, the set of positions of the steps it depends on.
+    """
+    accesses = [PIPELINE_ACCESS.get(func.__name__) for _, func in steps]
+    return [
+        set(i for i in range(j) if _conflict(accesses[i], accesses[j]))
+        for j in range(len(steps))
+    ]
+
+
+def _run_pipeline(db, collection_name, pipeline_func):
+    print(f"INFO: Running pipeline {pipeline_func.__name__} on {collection_name}")
+    start = time()
+    pipeline_func(db[collection_name])
+    return time() - start
+
+
+def run_pipelines_dag(db, steps, max_workers=1):
+    """
+    Run the denormalization pipelines with at most max_workers at the same time,
+    a pipeline starts when all the pipelines it depends on are done.
+
+    At the end the duration of every pipeline and the critical path are printed.
 
     Parameters
     ----------
     db : pymongo.database.Database
         Database object to denormalize
+    steps : list
+        List of (collection_name, pipeline_func) in serial order
+    max_workers : int
+        Maximum number of pipelines running at the same time, 1 runs them in serial order
     """
-    if parallel_collections is None:
-        parallel_collections = False
-    if max_parallel_jobs is None:
-        max_parallel_jobs = 2
-    max_parallel_jobs = max(1, max_parallel_jobs)
+    deps = build_pipelines_dag(steps)
+    dependents = [[] for _ in steps]
+    pending = [len(d) for d in deps]
+    for j, d in enumerate(deps):
+        for i in d:
+            dependents[i].append(j)
+
+    ready = [j for j in range(len(steps)) if not deps[j]]
+    running = {}
+    durations = {}
+    start = time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            while ready and len(running) < max_workers:
+                j = ready.pop(0)
+                running[executor.submit(_run_pipeline, db, *steps[j])] = j
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                j = running.pop(future)
+                durations[j] = future.result()
+                for k in dependents[j]:
+                    pending[k] -= 1
+                    if pending[k] == 0:
+                        ready.append(k)
+            ready.sort()
+    wall_time = time() - start
+
+    finish = {}
+    previous = {}
+    for j in range(len(steps)):
+        previous[j] = max(deps[j], key=lambda i: finish[i], default=None)
+        finish[j] = durations[j] + \
+            (finish[previous[j]] if previous[j] is not None else 0)
+    path = []
+    j = max(finish, key=finish.get, default=None)
+    while j is not None:
+        path.append(j)
+        j = previous[j]
+    path.reverse()
+
+    print("INFO: Denormalization pipelines durations")
+    for j, (collection_name, pipeline_func) in enumerate(steps):
+        print(
+            f"INFO:     {collection_name}.{pipeline_func.__name__}: {durations[j]:.1f} s")
+    if path:
+        critical_path = " -> ".join(steps[j][1].__name__ for j in path)
+        print(
+            f"INFO: Denormalization critical path ({finish[path[-1]]:.1f} s of {wall_time:.1f} s wall time): {critical_path}")
 
-    collection_runs = list(DENORMALIZATION_PIPELINES.items())
 
-    if not parallel_collections:
-        for collection_name, pipelines in collection_runs:
-            _run_collection_pipelines(db, collection_name, pipelines)
+def _chunk_options(pipeline_name, chunk_settings):
+    """
+    Chunking options of a works pipeline, the settings of the pipeline name override the "default" ones,
+    and these override the module constants.
+    """
+    settings = {
+        "buckets": WORKS_CHUNK_BUCKETS,
+        "workers": WORKS_CHUNK_WORKERS,
+        "min_docs": WORKS_MIN_DOCS_TO_CHUNK,
+    }
+    settings.update(chunk_settings.get("default") or {})
+    settings.update(chunk_settings.get(pipeline_name) or {})
+    return {
+        "chunk_buckets": settings["buckets"],
+        "chunk_workers": settings["workers"],
+        "min_docs_to_chunk": settings["min_docs"],
+    }
+
+
+# pipelines that can be restricted to the _ids of the documents affected by the changed works,
+# the other pipelines only read their own collection and always run over all the documents
+SCOPED_PIPELINES = {pipeline_func.__name__ for pipeline_func in DENORMALIZATION_PIPELINES["works"]} | {
+    "set_works_denormalized_data",
+    "set_sources_products_count",
+    "set_sources_citations_count_openalex",
+    "normalize_source_topics",
+    "set_h_index_metrics",
+}
+
+
+def _id_chunks(ids, size=SCOPE_QUERY_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def add_denormalization_pending(db, collection_name, ids, max_ids=INCREMENTAL_MAX_IDS):
+    """
+    Record the _ids of documents changed without updating updated.time, the next incremental
+    denormalization includes them (see denormalization_pending). If more than max_ids _ids are pending
+    the next denormalization is a full one.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database object to denormalize
+    collection_name : str
+        works, person, affiliations or sources
+    ids : list
+        _id of the changed documents, for the entities also the _id they had before the change
+    max_ids : int
+        Maximum number of pending _ids
+    """
+    ids = list(ids)
+    if not ids:
+        return
+    pending = db[DENORMALIZATION_PENDING_COLLECTION]
+    if pending.estimated_document_count() + len(ids) > max_ids:
+        require_full_denormalization(db)
         return
+    for chunk in _id_chunks(ids):
+        pending.bulk_write([UpdateOne({"_id": {"collection": collection_name, "id": idx}},
+                                      {"$setOnInsert": {"collection": collection_name}}, upsert=True)
+                            for idx in chunk], ordered=False)
 
-    print(
-        "INFO: Collection-level parallelization enabled "
-        f"(max workers: {max_parallel_jobs})"
-    )
 
-    index = 0
-    while index < len(collection_runs):
-        collection_name, pipelines = collection_runs[index]
-        if collection_name not in PARALLEL_SAFE_COLLECTIONS:
-            _run_collection_pipelines(db, collection_name, pipelines)
-            index += 1
-            continue
+def require_full_denormalization(db):
+    """
+    Make the next denormalization a full one, for the changes whose _ids are not known.
+    """
+    db[DENORMALIZATION_PENDING_COLLECTION].update_one(
+        {"_id": "full"}, {"$set": {"full": True}}, upsert=True)
 
-        batch_end = index
-        while batch_end < len(collection_runs) and (
-            collection_runs[batch_end][0] in PARALLEL_SAFE_COLLECTIONS
-        ):
-            batch_end += 1
 
-        batch = collection_runs[index:batch_end]
-        if len(batch) == 1:
-            _run_collection_pipelines(db, batch[0][0], batch[0][1])
-            index = batch_end
-            continue
+def denormalization_pending(db):
+    """
+    Get the _ids recorded with add_denormalization_pending.
+
+    Returns
+    -------
+    dict
+        {collection_name: list of _id} or None if the next denormalization has to be a full one.
+    """
+    changed = {}
+    for reg in db[DENORMALIZATION_PENDING_COLLECTION].find():
+        if reg["_id"] == "full":
+            return None
+        changed.setdefault(reg["_id"]["collection"], []).append(reg["_id"]["id"])
+    return changed
+
+
+def clear_denormalization_pending(db):
+    """
+    Remove the pending _ids, called after every denormalization (incremental or full).
+    """
+    db[DENORMALIZATION_PENDING_COLLECTION].delete_many({})
+
+
+def _flatten_ids(value):
+    """
+    The hashable ids of a field that can be a single id or nested lists of ids.
+    """
+    if isinstance(value, list):
+        return [idx for item in value for idx in _flatten_ids(item)]
+    return [value] if value is not None and _hashable(value) else []
+
+
+def save_denormalization_entities(db, ids=None):
+    """
+    Store the persons, affiliations and sources of the works in DENORMALIZATION_ENTITIES_COLLECTION.
+    The next incremental denormalization uses them to find the entities a work left.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database object to denormalize
+    ids : list
+        _id of the works denormalized, None to rebuild the collection with all the works
+    """
+    pipeline = [
+        {"$project": {
+            "person": "$authors.id",
+            "affiliations": "$authors.affiliations.id",
+            "sources": "$source.id",
+        }},
+    ]
+    if ids is None:
+        db["works"].aggregate(pipeline + [{"$out": DENORMALIZATION_ENTITIES_COLLECTION}], allowDiskUse=True)
+        return
+    for chunk in _id_chunks(ids):
+        db["works"].aggregate([{"$match": {"_id": {"$in": chunk}}}] + pipeline + [
+            {"$merge": {"into": DENORMALIZATION_ENTITIES_COLLECTION, "on": "_id",
+                        "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ])
+        present = set(reg["_id"] for reg in db["works"].find({"_id": {"$in": chunk}}, {"_id": 1}))
+        deleted = [idx for idx in chunk if idx not in present]
+        if deleted:
+            db[DENORMALIZATION_ENTITIES_COLLECTION].delete_many({"_id": {"$in": deleted}})
+
+
+def denormalization_scope(db, changed_ids=None, since=None, max_ids=INCREMENTAL_MAX_IDS):
+    """
+    Compute the documents to denormalize in an incremental run.
+
+    The works are the changed works, the works with updated.time greater than since and the works of the
+    changed persons, affiliations and sources and of the ones with updated.time greater than since.
+    The persons, affiliations and sources are the changed ones, the entities of those works and the entities
+    the works had in the previous denormalization (DENORMALIZATION_ENTITIES_COLLECTION), so an entity a work
+    left is processed too.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database object to denormalize
+    changed_ids : list or dict
+        _id of the works changed, or {collection_name: list of _id} with the works, person, affiliations
+        and sources changed (see denormalization_pending)
+    since : int
+        Timestamp of the previous run
+    max_ids : int
+        Maximum number of _ids per collection, the full denormalization is preferred over bigger scopes
+
+    Returns
+    -------
+    dict
+        {collection_name: list of _id} or None if the scope is bigger than max_ids.
+    """
+    if not isinstance(changed_ids, dict):
+        changed_ids = {"works": changed_ids or []}
+    works_ids = set(changed_ids.get("works") or [])
+    entities = {collection_name: set(changed_ids.get(collection_name) or [])
+                for collection_name in SCOPE_ENTITIES}
+    expanded = {collection_name: set(ids) for collection_name, ids in entities.items()}
+    if since is not None:
+        updated = {"updated.time": {"$gt": since}}
+        works_ids.update(reg["_id"]
+                         for reg in db["works"].find(updated, {"_id": 1}))
+        for collection_name in SCOPE_ENTITIES:
+            expanded[collection_name].update(reg["_id"]
+                                             for reg in db[collection_name].find(updated, {"_id": 1}))
+    for collection_name, fields in (
+            ("person", ["authors.id"]),
+            ("affiliations", ["authors.affiliations.id", "groups.id"]),
+            ("sources", ["source.id"])):
+        for chunk in _id_chunks(expanded[collection_name]):
+            query = {"$or": [{field: {"$in": chunk}} for field in fields]}
+            works_ids.update(reg["_id"]
+                             for reg in db["works"].find(query, {"_id": 1}))
+            if len(works_ids) > max_ids:
+                return None
+    if len(works_ids) > max_ids:
+        return None
+
+    projection = {"_id": 0, "authors.id": 1,
+                  "authors.affiliations.id": 1, "source.id": 1}
+    for chunk in _id_chunks(works_ids):
+        for work in db["works"].find({"_id": {"$in": chunk}}, projection):
+            for author in work.get("authors") or []:
+                if author.get("id"):
+                    entities["person"].add(author["id"])
+                for aff in author.get("affiliations") or []:
+                    if aff.get("id"):
+                        entities["affiliations"].add(aff["id"])
+            _, source_ids = _work_lookup_ids(work)
+            entities["sources"].update(idx for idx in source_ids if idx)
+        for reg in db[DENORMALIZATION_ENTITIES_COLLECTION].find({"_id": {"$in": chunk}}):
+            for collection_name in SCOPE_ENTITIES:
+                entities[collection_name].update(_flatten_ids(reg.get(collection_name)))
+    if any(len(ids) > max_ids for ids in entities.values()):
+        return None
+
+    scope = {"works": list(works_ids)}
+    for collection_name, ids in entities.items():
+        scope[collection_name] = list(ids)
+    return scope
+
+
+def denormalize(db, parallel_collections=None, max_parallel_jobs=None, works_engine="single_pass",
+                works_batch_size=WORKS_DENORMALIZATION_BATCH_SIZE, chunk_settings=None,
+                changed_ids=None, since=None, max_scope_ids=INCREMENTAL_MAX_IDS, save_entities=False):
+    """
+    Denormalize the data in all configured collections
 
-        workers = min(max_parallel_jobs, len(batch))
-        batch_names = [name for name, _ in batch]
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database object to denormalize
+    parallel_collections : bool
+        Run the pipelines without conflicts (PIPELINE_ACCESS) at the same time, of the same or different collections
+    max_parallel_jobs : int
+        Maximum number of pipelines running at the same time
+    works_engine : str
+        "single_pass" to denormalize the works with set_works_denormalized_data,
+        "pipelines" to run the works pipelines of DENORMALIZATION_PIPELINES one after another
+    works_batch_size : int
+        Number of works per batch of the single_pass engine
+    chunk_settings : dict
+        Chunking of the works pipelines over _id ranges, {pipeline_name or "default": {"buckets": int,
+        "workers": int, "min_docs": int}}, the module constants are used for the missing values
+    changed_ids : list or dict
+        _id of the works, or {collection_name: list of _id} of the works and entities, changed since the previous run
+        without updating updated.time, see denormalization_scope
+    since : int
+        Timestamp of the previous run, see denormalization_scope.
+        If changed_ids and since are None all the documents are denormalized.
+    max_scope_ids : int
+        Maximum number of _ids per collection of an incremental run, bigger scopes run the full denormalization
+    save_entities : bool
+        Save the entities of the works denormalized with save_denormalization_entities,
+        only needed by the next incremental runs
+    """
+    if parallel_collections is None:
+        parallel_collections = False
+    if max_parallel_jobs is None:
+        max_parallel_jobs = 2
+    max_parallel_jobs = max(1, max_parallel_jobs)
+
+    scope = None
+    if changed_ids is not None or since is not None:
+        scope = denormalization_scope(db, changed_ids, since, max_scope_ids)
+        if scope is None:
+            print(
+                f"INFO: more than {max_scope_ids} documents to denormalize, running the full denormalization")
+        else:
+            print("INFO: Incremental denormalization of " + ", ".join(
+                f"{len(ids)} {collection_name}" for collection_name, ids in scope.items()))
+
+    pipelines_map = dict(DENORMALIZATION_PIPELINES)
+    if works_engine == "single_pass":
+        pipelines_map["works"] = [set_works_denormalized_data]
+    steps = []
+    for collection_name, pipelines in pipelines_map.items():
+        for pipeline_func in pipelines:
+            kwargs = {}
+            if pipeline_func is set_works_denormalized_data:
+                kwargs["batch_size"] = works_batch_size
+            elif collection_name == "works":
+                kwargs.update(_chunk_options(
+                    pipeline_func.__name__, chunk_settings or {}))
+            if scope is not None and pipeline_func is set_h_index_metrics:
+                kwargs["ids"] = {"person": scope["person"], "affiliations": scope["affiliations"]}
+            elif scope is not None and pipeline_func.__name__ in SCOPED_PIPELINES:
+                kwargs["ids"] = scope[collection_name]
+            if kwargs:
+                pipeline_func = update_wrapper(
+                    partial(pipeline_func, **kwargs), pipeline_func)
+            steps.append((collection_name, pipeline_func))
+
+    workers = max_parallel_jobs if parallel_collections else 1
+    if workers > 1:
         print(
-            "INFO: Running collections in parallel: "
-            f"{batch_names} with {workers} workers"
+            "INFO: Pipeline-level parallelization enabled "
+            f"(max workers: {workers})"
         )
-        Parallel(n_jobs=workers, prefer="threads", backend="threading")(
-            delayed(_run_collection_pipelines)(db, name, run_pipelines)
-            for name, run_pipelines in batch
-        )
-
-        index = batch_end
+    run_pipelines_dag(db, steps, workers)
+    if save_entities:
+        save_denormalization_entities(db, scope["works"] if scope is not None else None)
@@ -0,0 +1,141 @@
+from math import log, exp
+import numpy as np
+
+
+class CoauthorshipGraph:
+    """
+    Compact undirected graph used to build the coauthorship networks.
+
+    Node identifiers are interned as consecutive integers (the entity owning the network is 0),
+    edges are counted in a hash map keyed on the ordered pair of positions and
+    the degree of every node is updated when a new edge is created.
+    The creation order of nodes and edges is kept because it is the order stored in the database.
+    """
+
+    def __init__(self, idx, label):
+        """
+        Parameters:
+        ----------
+        idx : str
+            The affiliation or author identifier owning the network.
+        label : str
+            The label of the entity.
+        """
+        self.nodes = [idx]
+        self.labels = [label]
+        self.degrees = [0]
+        self.positions = {idx: 0}
+        self.edges = {}
+        self.sources = []
+        self.targets = []
+        self.coauthorships = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def position(self, node):
+        """
+        Get the interned position of a node, None if the node is not in the graph.
+        """
+        return self.positions.get(node)
+
+    def add_node(self, node, label):
+        """
+        Add a node to the graph if it is not already there, the first label is kept.
+
+        Returns:
+        -------
+        int
+            The interned position of the node.
+        """
+        pos = self.positions.get(node)
+        if pos is None:
+            pos = len(self.nodes)
+            self.positions[node] = pos
+            self.nodes.append(node)
+            self.labels.append(label)
+            self.degrees.append(0)
+        return pos
+
+    def add_edge(self, posa, posb, count=1):
+        """
+        Add coauthorships between two nodes given their positions.
+        If the edge is new it is stored with the orientation (posa, posb).
+        """
+        key = (posa, posb) if posa < posb else (posb, posa)
+        edge = self.edges.get(key)
+        if edge is None:
+            self.edges[key] = len(self.coauthorships)
+            self.sources.append(posa)
+            self.targets.append(posb)
+            self.coauthorships.append(count)
+            self.degrees[posa] += 1
+            self.degrees[posb] += 1
+        else:
+            self.coauthorships[edge] += count
+
+    def _node_sizes(self):
+        """
+        Size of every node, 50 * log2(1 + degree / (num_nodes - 1)).
+        The size is computed once per distinct degree and spread with numpy.
+        """
+        num_nodes = len(self.nodes)
+        if num_nodes <= 1:
+            return [1] * num_nodes
+        values, inverse = np.unique(
+            np.asarray(self.degrees, dtype=np.int64), return_inverse=True)
+        sizes = [50 * log(1 + degree / (num_nodes - 1), 2)
+                 for degree in values.tolist()]
+        return [sizes[i] for i in inverse.tolist()]
+
+    def _edge_sizes(self):
+        """
+        Size of every edge, 10 for the strongest edges, 1 for the weakest
+        and a sigmoid of the coauthorships in between.
+        The size is computed once per distinct number of coauthorships and spread with numpy.
+        """
+        if not self.coauthorships:
+            return []
+        values, inverse = np.unique(
+            np.asarray(self.coauthorships, dtype=np.int64), return_inverse=True)
+        top = values[-1].item()
+        bot = values[0].item()
+        sizes = []
+        for coauthorships in values.tolist():
+            if abs(top - coauthorships) < 0.01:
+                sizes.append(10)
+            elif abs(bot - coauthorships) < 0.01:
+                sizes.append(1)
+            else:
+                size = 10 / (1 + exp(6 - 10 * coauthorships / top))
+                sizes.append(size if size >= 1 else 1)
+        return [sizes[i] for i in inverse.tolist()]
+
+    def records(self):
+        """
+        Build the nodes and edges records of the network as they are stored in the calculations database.
+
+        Returns:
+        -------
+        tuple
+            (nodes_db, edges_db) lists ready to be inserted in the database.
+        """
+        nodes_db = [
+            {
+                "id": str(node),
+                "label": label,
+                "degree": degree,
+                "size": size
+            }
+            for node, label, degree, size in zip(self.nodes, self.labels, self.degrees, self._node_sizes())
+        ]
+        edges_db = [
+            {
+                "source": str(self.nodes[posa]),
+                "target": str(self.nodes[posb]),
+                "coauthorships": coauthorships,
+                "size": size,
+            }
+            for posa, posb, coauthorships, size in zip(self.sources, self.targets, self.coauthorships, self._edge_sizes())
+        ]
+        return nodes_db, edges_db
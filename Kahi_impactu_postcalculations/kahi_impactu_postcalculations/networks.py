@@ -0,0 +1,290 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from kahi_impactu_postcalculations.graph import CoauthorshipGraph
+
+NETWORK_BULK_SIZE = 500
+
+
+def affiliation_network_records(nodes_db, edges_db):
+    """
+    Split an affiliation network in the records stored in the affiliations and affiliations_edges collections.
+
+    Parameters:
+    ----------
+    nodes_db : list
+        The nodes records of the network.
+    edges_db : list
+        The edges records of the network.
+
+    Returns:
+    -------
+    tuple
+        (record, record_edges) documents to set in affiliations and affiliations_edges.
+    """
+    record = {
+        "coauthorship_network": {
+            "nodes": nodes_db,
+            "edges": edges_db
+        }
+    }
+    record_edges = {
+        "coauthorship_network": {
+            "edges": edges_db
+        }
+    }
+    nedges = int(len(record["coauthorship_network"]["edges"]) / 2)
+
+    record["coauthorship_network"]["edges"] = record["coauthorship_network"]["edges"][0:nedges]
+
+    record_edges["coauthorship_network"]["edges"] = record["coauthorship_network"]["edges"][nedges:]
+    return record, record_edges
+
+
+def affiliation_name(aff_info):
+    """
+    Get the name of an affiliation, spanish name is preferred over english one.
+
+    Parameters:
+    ----------
+    aff_info : dict
+        The affiliation document with the names field.
+
+    Returns:
+    -------
+    str
+        The name of the affiliation.
+    """
+    name = aff_info["names"][0]["name"]
+    for n in aff_info["names"]:
+        if n["lang"] == "es":
+            name = n["name"]
+            break
+        elif n["lang"] == "en":
+            name = n["name"]
+    return name
+
+
+def _within_author_count(work, author_count):
+    """
+    Check the same condition of the query {"author_count": {"$lte": author_count}}.
+    """
+    count = work.get("author_count")
+    if isinstance(count, bool) or not isinstance(count, (int, float)):
+        return False
+    return count <= author_count
+
+
+def _add_work(table, work_nodes):
+    """
+    Add the nodes of one work to a coauthorship table.
+
+    Only works with at least two different nodes are stored, the others can not produce edges.
+    """
+    table["present"].update(node for node, _ in work_nodes)
+    if len(work_nodes) < 2:
+        return
+    distinct = set(node for node, _ in work_nodes)
+    if len(distinct) < 2:
+        return
+    position = len(table["works"])
+    table["works"].append(tuple(work_nodes))
+    for node in distinct:
+        table["index"].setdefault(node, []).append(position)
+
+
+def load_coauthorship_tables(db_in, author_count):
+    """
+    Stream the works collection once and build the global coauthorship tables for person and affiliations.
+
+    Every table has:
+    - works: list of tuples (node, label) for every work with author_count lower or equal than author_count,
+      in the order returned by the collection scan (empty ids are removed, repeated ones are kept).
+    - index: hash map node -> positions in works where the node appears (adjacency node-work).
+    - present: set of nodes that appear in at least one work (without author_count restriction).
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    author_count : int
+        The maximum number of authors in a work to consider.
+
+    Returns:
+    -------
+    dict
+        {"person": table, "affiliations": table}
+    """
+    tables = {
+        "person": {"works": [], "index": {}, "present": set()},
+        "affiliations": {"works": [], "index": {}, "present": set()},
+    }
+    labels = {}
+    projection = {
+        "_id": 0,
+        "author_count": 1,
+        "authors.id": 1,
+        "authors.full_name": 1,
+        "authors.affiliations.id": 1,
+        "authors.affiliations.name": 1,
+    }
+    for work in db_in["works"].find({}, projection):
+        within = _within_author_count(work, author_count)
+        authors_nodes = []
+        affiliations_nodes = []
+        for author in work.get("authors", []):
+            if author.get("id"):
+                label = author.get("full_name")
+                authors_nodes.append(
+                    (author["id"], labels.setdefault(label, label)))
+            for aff in author.get("affiliations", []):
+                if not aff.get("id"):
+                    continue
+                label = aff.get("name")
+                affiliations_nodes.append(
+                    (aff["id"], labels.setdefault(label, label)))
+        if within:
+            _add_work(tables["person"], authors_nodes)
+            _add_work(tables["affiliations"], affiliations_nodes)
+        else:
+            tables["person"]["present"].update(
+                node for node, _ in authors_nodes)
+            tables["affiliations"]["present"].update(
+                node for node, _ in affiliations_nodes)
+    return tables
+
+
+def build_ego_network(table, idx, label):
+    """
+    Build the coauthorship network of one entity from a coauthorship table.
+
+    The result is the same of querying the works of the entity (first level)
+    and the works of every neighbour without the entity (second level).
+
+    Parameters:
+    ----------
+    table : dict
+        The coauthorship table built by load_coauthorship_tables.
+    idx : str
+        The affiliation or author identifier.
+    label : str
+        The label of the entity.
+
+    Returns:
+    -------
+    CoauthorshipGraph
+        The coauthorship network of the entity.
+    """
+    works = table["works"]
+    index = table["index"]
+    graph = CoauthorshipGraph(idx, label)
+
+    ego_works = index.get(idx, [])
+    for position in ego_works:
+        work_nodes = set()
+        for node, node_label in works[position]:
+            if node == idx:
+                continue
+            pos = graph.add_node(node, node_label)
+            if pos not in work_nodes:
+                work_nodes.add(pos)
+                graph.add_edge(0, pos)
+
+    ego_works = set(ego_works)
+    for pos in range(1, len(graph)):
+        for position in index.get(graph.nodes[pos], []):
+            if position in ego_works:
+                continue
+            for node, _ in works[position]:
+                other = graph.position(node)
+                if other is None or other == pos:
+                    continue
+                graph.add_edge(pos, other)
+    return graph
+
+
+def _flush(db_out, operations, batch_size, force=False):
+    """
+    Write the pending bulk operations per collection.
+    """
+    for collection_name, ops in operations.items():
+        if not ops or (len(ops) < batch_size and not force):
+            continue
+        try:
+            db_out[collection_name].bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                idx = error.get("op", {}).get("q", {}).get("_id")
+                print(f"too big network for id {idx}", error.get("errmsg"))
+        operations[collection_name] = []
+
+
+def create_networks(db_in, db_out, author_count, batch_size=NETWORK_BULK_SIZE, verbose=0):
+    """
+    Create the coauthorship networks of all the affiliations (institutions) and persons with works,
+    reading the works collection only once.
+
+    The networks already available in the calculations database are not recomputed.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the information will be stored.
+    author_count : int
+        The maximum number of authors in a work to consider.
+    batch_size : int
+        Number of upserts per bulk write.
+    verbose : int
+        Verbosity level.
+    """
+    print("INFO: Loading coauthorship tables from works")
+    tables = load_coauthorship_tables(db_in, author_count)
+    if verbose > 0:
+        for net, table in tables.items():
+            print(
+                f"INFO: {net} table with {len(table['works'])} works and {len(table['index'])} nodes")
+
+    operations = {"affiliations": [], "affiliations_edges": [], "person": []}
+
+    print("INFO: Creating affiliations networks")
+    table = tables["affiliations"]
+    done = set(reg["_id"] for reg in db_out["affiliations"].find(
+        {"coauthorship_network": {"$exists": True}}, {"_id": 1}))
+    count = 0
+    for aff in db_in["affiliations"].find(
+            {"types.type": {"$nin": ["faculty", "department", "group"]}}, {"names": 1}):
+        idx = aff["_id"]
+        if idx not in table["present"] or idx in done:
+            continue
+        graph = build_ego_network(table, idx, affiliation_name(aff))
+        record, record_edges = affiliation_network_records(*graph.records())
+        operations["affiliations"].append(
+            UpdateOne({"_id": idx}, {"$set": record}, upsert=True))
+        operations["affiliations_edges"].append(
+            UpdateOne({"_id": idx}, {"$set": record_edges}, upsert=True))
+        count += 1
+        _flush(db_out, operations, batch_size)
+    _flush(db_out, operations, batch_size, force=True)
+    print(f"INFO: {count} affiliations networks created")
+
+    print("INFO: Creating authors networks")
+    table = tables["person"]
+    done = set(reg["_id"] for reg in db_out["person"].find(
+        {"coauthorship_network": {"$exists": True}}, {"_id": 1}))
+    count = 0
+    for person in db_in["person"].find({}, {"full_name": 1}):
+        idx = person["_id"]
+        if idx not in table["present"] or idx in done:
+            continue
+        graph = build_ego_network(table, idx, person["full_name"])
+        nodes_db, edges_db = graph.records()
+        operations["person"].append(
+            UpdateOne({"_id": idx}, {"$set": {"coauthorship_network": {
+                "nodes": nodes_db, "edges": edges_db}}}, upsert=True))
+        count += 1
+        _flush(db_out, operations, batch_size)
+        if verbose > 1 and count % 10000 == 0:
+            print(f"INFO: {count} authors networks created")
+    _flush(db_out, operations, batch_size, force=True)
+    print(f"INFO: {count} authors networks created")
@@ -1,21 +1,26 @@
 import sys
+from pymongo import InsertOne
 
+MAPPING_COLLECTION = "person_ids_mapping"
+MAPPING_BATCH_SIZE = 1000
 
-def process_person_id(client, person_col, product_cols, person, source):
+
+def person_persistent_id(person, source):
     """
-    Process the person ID based on the source and update the MongoDB collection.
+    Get the persistent id of a person for the given source.
+
     Parameters:
     ---------
-    client: MongoDB client
-    person_col: MongoDB collection for person
-    product_cols: list
-        MongoDB collections containing products with authors.id references
     person: dict
-        The person document to process
+        The person document
     source: str
         The source of the person ID (e.g., "mongodb_id", "scienti", etc.)
-    """
 
+    Returns:
+    -------
+    str
+        The persistent id, the process exits if the person has no id for the source
+    """
     original_id = person["_id"]
     pid = None  # person id
 
@@ -41,6 +46,26 @@ def process_person_id(client, person_col, product_cols, person, source):
             source,
         )
         sys.exit(1)
+    return pid
+
+
+def process_person_id(client, person_col, product_cols, person, source):
+    """
+    Process the person ID based on the source and update the MongoDB collection.
+    Parameters:
+    ---------
+    client: MongoDB client
+    person_col: MongoDB collection for person
+    product_cols: list
+        MongoDB collections containing products with authors.id references
+    person: dict
+        The person document to process
+    source: str
+        The source of the person ID (e.g., "mongodb_id", "scienti", etc.)
+    """
+
+    original_id = person["_id"]
+    pid = person_persistent_id(person, source)
     opid = pid
 
     # Insertar con nuevo _id
@@ -68,3 +93,175 @@ def process_person_id(client, person_col, product_cols, person, source):
             {"$set": {"authors.$[author].id": pid}},
             array_filters=[{"author.id": original_id}],
         )
+
+
+def compute_person_ids_mapping(db, sources, mapping_col, batch_size=MAPPING_BATCH_SIZE):
+    """
+    Compute the map old id -> persistent id for all the persons without persistent id and store it
+    in the mapping collection, the sources are applied in priority order.
+    A person whose persistent id is already taken is kept for the next source.
+
+    Parameters:
+    ---------
+    db: MongoDB database (kahi)
+    sources: list
+        The sources of the person ID in priority order
+    mapping_col: MongoDB collection
+        The collection where the map is stored
+    batch_size: int
+        Number of mapping documents per insert
+
+    Returns:
+    -------
+    int
+        Number of persons mapped
+    """
+    taken = set(reg["_id"] for reg in db["person"].find(
+        {"_id_old": {"$exists": True}}, {"_id": 1}))
+    mapped = set(reg["_id"] for reg in mapping_col.find({}, {"_id": 1}))
+    taken.update(reg["new_id"] for reg in mapping_col.find(
+        {"applied": False}, {"new_id": 1}))
+    count = 0
+    for source in sources:
+        print("INFO: PERSISTENT ID SOURCE  ", source)
+        if source == "mongodb_id":
+            cursor = db["person"].find(
+                {"_id_old": {"$exists": False}}, {"external_ids": 1})
+        else:
+            cursor = db["person"].find(
+                {"_id_old": {"$exists": False}, "external_ids.source": source}, {"external_ids": 1})
+        bulk_ops = []
+        for person in cursor:
+            if person["_id"] in mapped:
+                continue
+            pid = person_persistent_id(person, source)
+            if pid in taken:
+                print(
+                    f"Error insertando nuevo _id en person: duplicated id\n {source} {pid} {str(person['_id'])}")
+                continue
+            taken.add(pid)
+            mapped.add(person["_id"])
+            bulk_ops.append(InsertOne(
+                {"_id": person["_id"], "new_id": pid, "source": source, "applied": False}))
+            if len(bulk_ops) >= batch_size:
+                mapping_col.bulk_write(bulk_ops)
+                count += len(bulk_ops)
+                bulk_ops = []
+        if bulk_ops:
+            mapping_col.bulk_write(bulk_ops)
+            count += len(bulk_ops)
+    return count
+
+
+def _rewrite_authors_ids(product_col, from_ids, to_ids):
+    """
+    Replace the authors.id in from_ids by the id in the same position of to_ids with a pipeline update.
+    """
+    product_col.update_many(
+        {"authors.id": {"$in": from_ids}},
+        [{"$set": {"authors": {"$map": {
+            "input": "$authors",
+            "as": "author",
+            "in": {"$let": {
+                "vars": {"pos": {"$indexOfArray": [from_ids, "$$author.id"]}},
+                "in": {"$cond": [
+                    {"$gte": ["$$pos", 0]},
+                    {"$mergeObjects": ["$$author", {
+                        "id": {"$arrayElemAt": [to_ids, "$$pos"]}}]},
+                    "$$author"
+                ]}
+            }}
+        }}}}]
+    )
+
+
+def apply_person_ids_mapping(db, product_cols, mapping_col, batch_size=MAPPING_BATCH_SIZE):
+    """
+    Apply the pending entries of the mapping collection in chunks of batch_size:
+    the person documents are copied with the new _id (and _id_old) with an aggregation $merge,
+    the old documents are deleted and authors.id is rewritten in every product collection.
+    The entries are marked as applied after every chunk, an interrupted run is resumed applying the pending entries again.
+
+    Parameters:
+    ---------
+    db: MongoDB database (kahi)
+    product_cols: list
+        MongoDB collections containing products with authors.id references
+    mapping_col: MongoDB collection
+        The collection with the map old id -> persistent id
+    batch_size: int
+        Number of persons per chunk
+
+    Returns:
+    -------
+    int
+        Number of persons remapped
+    """
+    pending = [(reg["_id"], reg["new_id"]) for reg in mapping_col.find(
+        {"applied": False}, {"new_id": 1})]
+    for i in range(0, len(pending), batch_size):
+        chunk = pending[i:i + batch_size]
+        old_ids = [old_id for old_id, _ in chunk]
+        new_ids = [new_id for _, new_id in chunk]
+        mapping_col.aggregate([
+            {"$match": {"_id": {"$in": old_ids}}},
+            {"$lookup": {"from": "person", "localField": "_id",
+                         "foreignField": "_id", "as": "person"}},
+            {"$unwind": "$person"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+                "$person", {"_id": "$new_id", "_id_old": "$_id"}]}}},
+            {"$merge": {"into": "person", "on": "_id",
+                        "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ])
+        db["person"].delete_many({"_id": {"$in": old_ids}})
+        for product_col in product_cols:
+            _rewrite_authors_ids(product_col, old_ids, new_ids)
+        mapping_col.update_many({"_id": {"$in": old_ids}}, {
+                                "$set": {"applied": True}})
+        print(f"INFO: {i + len(chunk)} of {len(pending)} persons remapped")
+    return len(pending)
+
+
+def rollback_person_ids(db, product_cols, mapping_col, batch_size=MAPPING_BATCH_SIZE):
+    """
+    Restore the original ids of the persons remapped with apply_person_ids_mapping,
+    the restored entries are removed from the mapping collection.
+
+    Parameters:
+    ---------
+    db: MongoDB database (kahi)
+    product_cols: list
+        MongoDB collections containing products with authors.id references
+    mapping_col: MongoDB collection
+        The collection with the map old id -> persistent id
+    batch_size: int
+        Number of persons per chunk
+
+    Returns:
+    -------
+    int
+        Number of persons restored
+    """
+    entries = [(reg["_id"], reg["new_id"])
+               for reg in mapping_col.find({}, {"new_id": 1})]
+    for i in range(0, len(entries), batch_size):
+        chunk = entries[i:i + batch_size]
+        old_ids = [old_id for old_id, _ in chunk]
+        new_ids = [new_id for _, new_id in chunk]
+        mapping_col.aggregate([
+            {"$match": {"_id": {"$in": old_ids}}},
+            {"$lookup": {"from": "person", "localField": "new_id",
+                         "foreignField": "_id", "as": "person"}},
+            {"$unwind": "$person"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+                "$person", {"_id": "$_id"}]}}},
+            {"$unset": "_id_old"},
+            {"$merge": {"into": "person", "on": "_id",
+                        "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ])
+        db["person"].delete_many({"_id": {"$in": new_ids}})
+        for product_col in product_cols:
+            _rewrite_authors_ids(product_col, new_ids, old_ids)
+        mapping_col.delete_many({"_id": {"$in": old_ids}})
+        print(f"INFO: {i + len(chunk)} of {len(entries)} persons restored")
+    return len(entries)
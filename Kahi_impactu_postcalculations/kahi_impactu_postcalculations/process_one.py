@@ -1,11 +1,15 @@
-from math import log, exp
 from pymongo import MongoClient
 from spacy import load
+from kahi_impactu_postcalculations.networks import affiliation_network_records, affiliation_name
+from kahi_impactu_postcalculations.graph import CoauthorshipGraph
 
 # for multiprocessing have to be loaded global
 en_model = None
 es_model = None
 
+# number of neighbours expanded per query in the coauthorship networks, 0 to run one query per neighbour
+NEIGHBOURS_CHUNK_SIZE = 500
+
 
 def load_nlp_models():
     global en_model
@@ -53,6 +57,11 @@ def network_creation_process_one(config, client, impactu_client, idx, author_cou
         The network type, either affiliations or authors.
     backend : str
         The backend to use for the parallel processing. "mutiprocessing" or "threading".
+
+    Returns:
+    -------
+    dict or None
+        The neighbour expansion statistics of the network, None if the network was not created.
     """
     if backend != "threading":
         client = MongoClient(config["database_url"])
@@ -65,17 +74,116 @@ def network_creation_process_one(config, client, impactu_client, idx, author_cou
         print("ERROR: Invalid network type options are affiliations or authors")
         return
 
+    chunk_size = config["impactu_postcalculations"].get(
+        "neighbours_chunk_size", NEIGHBOURS_CHUNK_SIZE)
+    stats = None
     if net == "affiliations":
-        network_creation_affiliations(db_in, db_out, idx, author_count)
+        stats = network_creation_affiliations(
+            db_in, db_out, idx, author_count, chunk_size)
     if net == "person":
-        network_creation_person(db_in, db_out, idx, author_count)
+        stats = network_creation_person(
+            db_in, db_out, idx, author_count, chunk_size)
+    if stats and config["impactu_postcalculations"].get("verbose", 0) > 1:
+        print(
+            f"INFO: {net} network {idx}: {stats['neighbours']} neighbours expanded in {stats['queries']} queries "
+            f"({stats['saved']} round-trips saved)")
 
     if backend != "threading":
         client.close()
         impactu_client.close()
+    return stats
+
+
+def _work_person_ids(work):
+    """
+    Ids of the authors of a work, in order.
+    """
+    return [author["id"] for author in work["authors"]]
+
+
+def _work_affiliation_ids(work):
+    """
+    Ids of the affiliations of the authors of a work, in order.
+    """
+    return [aff["id"] for author in work["authors"] for aff in author["affiliations"]]
+
+
+def _connect_neighbour(graph, idx, pos, work_ids):
+    """
+    Add one coauthorship between the neighbour in position pos and every other neighbour in the work.
+    """
+    for node in work_ids:
+        if node == idx:
+            print("Problem found")
+            continue
+        other = graph.position(node)
+        if other is None or other == pos:
+            continue
+        graph.add_edge(pos, other)
+
+
+def expand_neighbours(db_in, graph, idx, author_count, field, work_ids, chunk_size=NEIGHBOURS_CHUNK_SIZE):
+    """
+    Function to add the connections between the neighbours of an affiliation or author,
+    using the works of every neighbour where the affiliation or author is not present.
+
+    The neighbours are expanded in chunks of chunk_size with a single $in query per chunk,
+    every work is then attributed to each neighbour of the chunk it contains,
+    which gives the same coauthorships than one query per neighbour.
 
+    The works of every neighbour are connected in natural order, as the query per neighbour and the single pass engine do:
+    the chunk query returns the works in the order of the index, then the works of every neighbour
+    are sorted by their record id, which is the natural order of the collection.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    graph : CoauthorshipGraph
+        The network with the neighbours already added.
+    idx : str
+        The affiliation or author identifier.
+    author_count : int
+        The maximum number of authors in a work to consider.
+    field : str
+        The field of the works with the nodes ids, authors.id or authors.affiliations.id.
+    work_ids : function
+        Function returning the nodes ids of a work in order.
+    chunk_size : int
+        Number of neighbours per query, 0 or None to run one query per neighbour.
 
-def network_creation_affiliations(db_in, db_out, idx, author_count):
+    Returns:
+    -------
+    dict
+        Statistics with the number of neighbours, queries and round-trips saved.
+    """
+    neighbours = len(graph) - 1
+    queries = 0
+    if not chunk_size:
+        for pos in range(1, len(graph)):
+            queries += 1
+            for work in db_in["works"].find({"$and": [{field: graph.nodes[pos]}, {field: {"$ne": idx}}], "author_count": {"$lte": author_count}},
+                                            {field: 1}):
+                _connect_neighbour(graph, idx, pos, work_ids(work))
+    else:
+        for start in range(1, len(graph), chunk_size):
+            positions = range(start, min(start + chunk_size, len(graph)))
+            neighbour_works = {pos: [] for pos in positions}
+            queries += 1
+            for work in db_in["works"].find({"$and": [{field: {"$in": [graph.nodes[pos] for pos in positions]}}, {field: {"$ne": idx}}], "author_count": {"$lte": author_count}},
+                                            {"_id": 1, field: 1}, show_record_id=True):
+                ids = work_ids(work)
+                for pos in set(graph.position(node) for node in ids):
+                    if pos in neighbour_works:
+                        neighbour_works[pos].append((work["$recordId"], ids))
+            for pos in positions:
+                neighbour_works[pos].sort(key=lambda item: item[0])
+                for _, ids in neighbour_works[pos]:
+                    _connect_neighbour(graph, idx, pos, ids)
+    return {"neighbours": neighbours, "queries": queries, "saved": neighbours - queries}
+
+
+def network_creation_affiliations(db_in, db_out, idx, author_count, chunk_size=NEIGHBOURS_CHUNK_SIZE):
     """
     Function to create the network of coauthorships for an affiliation.
 
@@ -89,154 +197,53 @@ def network_creation_affiliations(db_in, db_out, idx, author_count):
         The affiliation identifier.
     author_count : int
         The maximum number of authors in a work to consider.
+    chunk_size : int
+        Number of neighbours expanded per query, 0 to run one query per neighbour.
+
+    Returns:
+    -------
+    dict or None
+        The neighbour expansion statistics, None if the network already exists.
     """
     already = db_out["affiliations"].find_one(
         {"_id": idx, "coauthorship_network": {"$exists": True}})
     if already:
         return None
     aff_info = db_in["affiliations"].find_one({"_id": idx})
-    name = aff_info["names"][0]["name"]
-    for n in aff_info["names"]:
-        if n["lang"] == "es":
-            name = n["name"]
-            break
-        elif n["lang"] == "en":
-            name = n["name"]
-    nodes = [idx]
-    nodes_labels = [name]
-    edges = []
-    edges_coauthorships = {}
-    works_count = 0
-    for work in db_in["works"].find({"authors.affiliations.id": idx, "author_count": {"$lte": author_count}}):
-        works_count += 1
-        work_nodes = [idx]
-        work_edges = []
+    name = affiliation_name(aff_info)
+    graph = CoauthorshipGraph(idx, name)
+    for work in db_in["works"].find({"authors.affiliations.id": idx, "author_count": {"$lte": author_count}},
+                                    {"authors.affiliations.id": 1, "authors.affiliations.name": 1}):
+        # Connecting the affiliation with every coauthoring institution in the work,
+        # one coauthorship per work
+        work_nodes = set()
         for author in work["authors"]:
             for aff in author["affiliations"]:
                 if not aff["id"]:
                     continue
-                if aff["id"] == "":
-                    continue
                 if aff["id"] == idx:
                     continue
-                if not aff["id"] in nodes:
-                    nodes.append(aff["id"])
-                    name = aff["name"]
-
-                    nodes_labels.append(name)
-                if not aff["id"] in work_nodes:
-                    for node in work_nodes:
-                        edge_found = False
-                        if (idx, aff["id"]) in work_edges:
-                            edge_found = True
-                        elif (aff["id"], idx) in edges:
-                            edge_found = True
-                        if edge_found is False:
-                            work_edges.append((idx, aff["id"]))
-                    work_nodes.append(aff["id"])
-        # Connecting all the nodes in the work among them
-        # checking if the connection already exists to add one to the count of coauthorships
-        for node in work_nodes:
-            if node not in nodes:
-                nodes.append(node)
-        for nodea, nodeb in work_edges:
-            edge_found = False
-            if (nodea, nodeb) in edges:
-                edges_coauthorships[str(nodea) + str(nodeb)] += 1
-                edge_found = True
-            elif (nodeb, nodea) in edges:
-                edges_coauthorships[str(nodeb) + str(nodea)] += 1
-                edge_found = True
-            if edge_found is False:
-                edges_coauthorships[str(nodea) + str(nodeb)] = 1
-                edges.append((nodea, nodeb))
+                pos = graph.add_node(aff["id"], aff["name"])
+                if pos not in work_nodes:
+                    work_nodes.add(pos)
+                    graph.add_edge(0, pos)
     # adding the connections between the coauthoring institutions
-    for node in nodes:
-        if node == idx:
-            continue
-        for work in db_in["works"].find({"$and": [{"authors.affiliations.id": node}, {"authors.affiliations.id": {"$ne": idx}}], "author_count": {"$lte": author_count}}):
-            for author in work["authors"]:
-                for aff in author["affiliations"]:
-                    if aff["id"] == idx:
-                        print("Problem found")
-                        continue
-                    if not aff["id"] in nodes:
-                        continue
-                    if node == aff["id"]:
-                        continue
-                    if (node, aff["id"]) in edges:
-                        edges_coauthorships[str(node) + str(aff["id"])] += 1
-                    elif (aff["id"], node) in edges:
-                        edges_coauthorships[str(aff["id"]) + str(node)] += 1
-                    else:
-                        edges_coauthorships[str(node) + str(aff["id"])] = 1
-                        edges.append((node, aff["id"]))
+    stats = expand_neighbours(db_in, graph, idx, author_count,
+                              "authors.affiliations.id", _work_affiliation_ids, chunk_size)
     # Constructing the actual format to insrt in db
-    num_nodes = len(nodes)
-    nodes_db = []
-    for i, node in enumerate(nodes):
-        degree = len([1 for i, j in edges if i == node or j == node])
-        size = 50 * log(1 + degree / (num_nodes - 1),
-                        2) if num_nodes > 1 else 1
-        nodes_db.append(
-            {
-                "id": str(node),
-                "label": nodes_labels[i],
-                "degree": degree,
-                "size": size
-            }
-        )
-    edges_db = []
-    for nodea, nodeb in edges:
-        coauthorships = 0
-        if str(nodea) + str(nodeb) in edges_coauthorships.keys():
-            coauthorships = edges_coauthorships[str(nodea) + str(nodeb)]
-        elif str(nodeb) + str(nodea) in edges_coauthorships.keys():
-            coauthorships = edges_coauthorships[str(nodeb) + str(nodea)]
-        edges_db.append({
-            "source": str(nodea),
-            "target": str(nodeb),
-            "coauthorships": coauthorships,
-            "size": coauthorships,
-        })
-    top = max([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    bot = min([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    for edge in edges_db:
-        if abs(top - edge["coauthorships"]) < 0.01:
-            edge["size"] = 10
-        elif abs(bot - edge["coauthorships"]) < 0.01:
-            edge["size"] = 1
-        else:
-            size = 10 / (1 + exp(6 - 10 * edge["coauthorships"] / top))
-            edge["size"] = size if size >= 1 else 1
-    record = {
-        "coauthorship_network": {
-            "nodes": nodes_db,
-            "edges": edges_db
-        }
-    }
+    nodes_db, edges_db = graph.records()
+    record, record_edges = affiliation_network_records(nodes_db, edges_db)
     try:
-        record_edges = {
-            "coauthorship_network": {
-                "edges": edges_db
-            }
-        }
-        nedges = int(len(record["coauthorship_network"]["edges"]) / 2)
-
-        record["coauthorship_network"]["edges"] = record["coauthorship_network"]["edges"][0:nedges]
-
-        record_edges["coauthorship_network"]["edges"] = record["coauthorship_network"]["edges"][nedges:]
         db_out["affiliations"].update_one(
             {"_id": idx, }, {"$set": record}, upsert=True)
         db_out["affiliations_edges"].update_one(
             {"_id": idx, }, {"$set": record_edges}, upsert=True)
     except Exception as e:
-        print(f"too big network for id {record['_id']}", e)
+        print(f"too big network for id {idx}", e)
+    return stats
 
 
-def network_creation_person(db_in, db_out, idx, author_count):
+def network_creation_person(db_in, db_out, idx, author_count, chunk_size=NEIGHBOURS_CHUNK_SIZE):
     """
     Function to create the network of coauthorships for an author.
 
@@ -248,6 +255,15 @@ def network_creation_person(db_in, db_out, idx, author_count):
         The database where the information will be stored.
     idx : str
         The author identifier.
+    author_count : int
+        The maximum number of authors in a work to consider.
+    chunk_size : int
+        Number of neighbours expanded per query, 0 to run one query per neighbour.
+
+    Returns:
+    -------
+    dict or None
+        The neighbour expansion statistics, None if the network already exists.
     """
 
     already = db_out["person"].find_one(
@@ -256,114 +272,28 @@ def network_creation_person(db_in, db_out, idx, author_count):
         return None
     aff_info = db_in["person"].find_one({"_id": idx})
     name = aff_info["full_name"]
-    nodes = [idx]
-    nodes_labels = [name]
-    edges = []
-    edges_coauthorships = {}
-    works_count = 0
-    for work in db_in["works"].find({"authors.id": idx, "author_count": {"$lte": author_count}}):
-        works_count += 1
-        work_nodes = [idx]
-        work_edges = []
+    graph = CoauthorshipGraph(idx, name)
+    for work in db_in["works"].find({"authors.id": idx, "author_count": {"$lte": author_count}},
+                                    {"authors.id": 1, "authors.full_name": 1}):
+        # Connecting the author with every coauthor in the work, one coauthorship per work
+        work_nodes = set()
         for author in work["authors"]:
             if not author["id"]:
                 continue
-            if author["id"] == "":
-                continue
             if author["id"] == idx:
                 continue
-            if not author["id"] in nodes:
-                nodes.append(author["id"])
-                name = author["full_name"]
-                nodes_labels.append(name)
-            if not author["id"] in work_nodes:
-                for node in work_nodes:
-                    edge_found = False
-                    if (idx, author["id"]) in work_edges:
-                        edge_found = True
-                    elif (author["id"], idx) in edges:
-                        edge_found = True
-                    if edge_found is False:
-                        work_edges.append((idx, author["id"]))
-                work_nodes.append(author["id"])
-        # Connecting all the nodes in the work among them
-        # checking if the connection already exists to add one to the count of coauthorships
-        for node in work_nodes:
-            if node not in nodes:
-                nodes.append(node)
-        for nodea, nodeb in work_edges:
-            edge_found = False
-            if (nodea, nodeb) in edges:
-                edges_coauthorships[str(nodea) + str(nodeb)] += 1
-                edge_found = True
-            elif (nodeb, nodea) in edges:
-                edges_coauthorships[str(nodeb) + str(nodea)] += 1
-                edge_found = True
-            if edge_found is False:
-                edges_coauthorships[str(nodea) + str(nodeb)] = 1
-                edges.append((nodea, nodeb))
-    # adding the connections between the coauthoring institutions
-    for node in nodes:
-        if node == idx:
-            continue
-        for work in db_in["works"].find({"$and": [{"authors.id": node}, {"authors.id": {"$ne": idx}}], "author_count": {"$lte": author_count}}):
-            for author in work["authors"]:
-                if author["id"] == idx:
-                    print("Problem found")
-                    continue
-                if not author["id"] in nodes:
-                    continue
-                if node == author["id"]:
-                    continue
-                if (node, author["id"]) in edges:
-                    edges_coauthorships[str(node) + str(author["id"])] += 1
-                elif (author["id"], node) in edges:
-                    edges_coauthorships[str(author["id"]) + str(node)] += 1
-                else:
-                    edges_coauthorships[str(node) + str(author["id"])] = 1
-                    edges.append((node, author["id"]))
+            pos = graph.add_node(author["id"], author["full_name"])
+            if pos not in work_nodes:
+                work_nodes.add(pos)
+                graph.add_edge(0, pos)
+    # adding the connections between the coauthors
+    stats = expand_neighbours(db_in, graph, idx, author_count,
+                              "authors.id", _work_person_ids, chunk_size)
     # Constructing the actual format to insrt in db
-    num_nodes = len(nodes)
-    nodes_db = []
-    for i, node in enumerate(nodes):
-        degree = len([1 for i, j in edges if i == node or j == node])
-        size = 50 * log(1 + degree / (num_nodes - 1),
-                        2) if num_nodes > 1 else 1
-        nodes_db.append(
-            {
-                "id": str(node),
-                "label": nodes_labels[i],
-                "degree": degree,
-                "size": size
-            }
-        )
-    edges_db = []
-    for nodea, nodeb in edges:
-        coauthorships = 0
-        if str(nodea) + str(nodeb) in edges_coauthorships.keys():
-            coauthorships = edges_coauthorships[str(nodea) + str(nodeb)]
-        elif str(nodeb) + str(nodea) in edges_coauthorships.keys():
-            coauthorships = edges_coauthorships[str(nodeb) + str(nodea)]
-        edges_db.append({
-            "source": str(nodea),
-            "target": str(nodeb),
-            "coauthorships": coauthorships,
-            "size": coauthorships,
-        })
-    top = max([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    bot = min([e["coauthorships"]
-              for e in edges_db]) if len(edges_db) > 0 else 1
-    for edge in edges_db:
-        if abs(top - edge["coauthorships"]) < 0.01:
-            edge["size"] = 10
-        elif abs(bot - edge["coauthorships"]) < 0.01:
-            edge["size"] = 1
-        else:
-            size = 10 / (1 + exp(6 - 10 * edge["coauthorships"] / top))
-            edge["size"] = size if size >= 1 else 1
+    nodes_db, edges_db = graph.records()
     db_out["person"].update_one({"_id": idx}, {"$set": {"coauthorship_network": {
         "nodes": nodes_db, "edges": edges_db}}}, upsert=True)
+    return stats
 
 
 def top_words_process_one(config, client, impactu_client, aff, stopwords, top_words, backend):
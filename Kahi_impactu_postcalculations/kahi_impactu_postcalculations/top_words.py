@@ -0,0 +1,450 @@
+from sys import intern
+from hashlib import sha1
+from pymongo import UpdateOne, ReplaceOne
+
+LEMMAS_COLLECTION = "works_lemmas"
+TOP_WORDS_BULK_SIZE = 500
+NLP_BATCH_SIZE = 1000
+WORKS_CHUNK_SIZE = 50000
+
+
+def lemma_bag(doc, stopwords):
+    """
+    Get the filtered lemma counts of a title processed by spaCy.
+
+    Parameters:
+    ----------
+    doc : spacy.tokens.Doc
+        The processed title.
+    stopwords : set
+        The stopwords to ignore.
+
+    Returns:
+    -------
+    tuple
+        Tuples (lemma, count) in order of first appearance in the title.
+    """
+    bag = {}
+    for token in doc:
+        lemma = token.lemma_
+        if lemma.isnumeric():
+            continue
+        if lemma in stopwords:
+            continue
+        if len(lemma) < 4:
+            continue
+        if lemma in bag:
+            bag[lemma] += 1
+        else:
+            bag[intern(lemma)] = 1
+    return tuple(bag.items())
+
+
+def lemmatize_titles(titles, es_model, en_model, stopwords, batch_size=NLP_BATCH_SIZE, n_process=1):
+    """
+    Lemmatize a list of titles with nlp.pipe, spanish titles with the spanish model and the others with the english model.
+    The pipes that are not used for the lemmas (parser and ner) are disabled.
+
+    Parameters:
+    ----------
+    titles : list
+        List of tuples (title, lang).
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int
+        Number of titles per nlp.pipe batch.
+    n_process : int
+        Number of processes used by nlp.pipe.
+
+    Returns:
+    -------
+    list
+        The lemma bag of every title, in the same order of titles.
+    """
+    bags = [()] * len(titles)
+    for model, in_lang in ((es_model, True), (en_model, False)):
+        positions = [i for i, (_, lang) in enumerate(titles)
+                     if (lang == "es") == in_lang]
+        if not positions:
+            continue
+        disable = [pipe for pipe in ("parser", "ner")
+                   if pipe in model.pipe_names]
+        docs = model.pipe((titles[i][0].lower() for i in positions),
+                          batch_size=batch_size, n_process=n_process, disable=disable)
+        for i, doc in zip(positions, docs):
+            bags[i] = lemma_bag(doc, stopwords)
+    return bags
+
+
+def load_lemma_bags(db_in, es_model, en_model, stopwords, batch_size=NLP_BATCH_SIZE, n_process=1, verbose=0):
+    """
+    Stream the works collection once and lemmatize every title exactly once.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int
+        Number of titles per nlp.pipe batch.
+    n_process : int
+        Number of processes used by nlp.pipe.
+    verbose : int
+        Verbosity level.
+
+    Returns:
+    -------
+    dict
+        {"bags": list of lemma bags, "person": {id: positions}, "affiliations": {id: positions}}
+    """
+    table = {"bags": [], "person": {}, "affiliations": {}}
+    chunk = []
+
+    def process_chunk():
+        bags = lemmatize_titles([(title, lang) for title, lang, _, _ in chunk],
+                                es_model, en_model, stopwords, batch_size, n_process)
+        for bag, (_, _, authors_ids, affiliations_ids) in zip(bags, chunk):
+            if not bag:
+                continue
+            position = len(table["bags"])
+            table["bags"].append(bag)
+            for idx in authors_ids:
+                table["person"].setdefault(idx, []).append(position)
+            for idx in affiliations_ids:
+                table["affiliations"].setdefault(idx, []).append(position)
+        if verbose > 1:
+            print(f"INFO: {len(table['bags'])} titles with words lemmatized")
+        chunk.clear()
+
+    projection = {"_id": 0, "titles.title": 1, "titles.lang": 1,
+                  "authors.id": 1, "authors.affiliations.id": 1}
+    for work in db_in["works"].find({"titles.title": {"$exists": 1}}, projection):
+        authors_ids = set()
+        affiliations_ids = set()
+        for author in work.get("authors", []):
+            if "id" in author:
+                authors_ids.add(author["id"])
+            for aff in author.get("affiliations", []):
+                if "id" in aff:
+                    affiliations_ids.add(aff["id"])
+        chunk.append((work["titles"][0]["title"], work["titles"][0]["lang"],
+                      authors_ids, affiliations_ids))
+        if len(chunk) >= WORKS_CHUNK_SIZE:
+            process_chunk()
+    if chunk:
+        process_chunk()
+    return table
+
+
+def top_words_from_bags(bags, positions, size=20):
+    """
+    Aggregate the lemma bags of the works of one entity and get the top words.
+
+    Parameters:
+    ----------
+    bags : list
+        The lemma bags of the works.
+    positions : list
+        The positions of the works of the entity in bags.
+    size : int
+        The number of words to keep.
+
+    Returns:
+    -------
+    list
+        List of {"name": word, "value": count} sorted by count.
+    """
+    results = {}
+    for position in positions:
+        for lemma, count in bags[position]:
+            if lemma in results:
+                results[lemma] += count
+            else:
+                results[lemma] = count
+    topN = sorted(results.items(), key=lambda x: x[1], reverse=True)[:size]
+    return [{"name": top[0], "value": top[1]} for top in topN]
+
+
+def create_top_words(db_in, db_out, es_model, en_model, stopwords, batch_size=NLP_BATCH_SIZE, n_process=1,
+                     bulk_size=TOP_WORDS_BULK_SIZE, verbose=0):
+    """
+    Create the top words of all the affiliations and persons, lemmatizing every work title only once.
+
+    The top words already available in the calculations database are not recomputed.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the information will be stored.
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int
+        Number of titles per nlp.pipe batch.
+    n_process : int
+        Number of processes used by nlp.pipe.
+    bulk_size : int
+        Number of upserts per bulk write.
+    verbose : int
+        Verbosity level.
+    """
+    print("INFO: Lemmatizing works titles")
+    table = load_lemma_bags(db_in, es_model, en_model, stopwords,
+                            batch_size, n_process, verbose)
+    for collection_name in ["affiliations", "person"]:
+        print(f"INFO: Creating top words for {collection_name}")
+        done = set(reg["_id"] for reg in db_out[collection_name].find(
+            {"top_words": {"$exists": 1}}, {"_id": 1}))
+        index = table[collection_name]
+        bulk_ops = []
+        count = 0
+        for reg in db_in[collection_name].find({}, {"_id": 1}):
+            if reg["_id"] in done:
+                continue
+            results = top_words_from_bags(
+                table["bags"], index.get(reg["_id"], []))
+            bulk_ops.append(UpdateOne({"_id": reg["_id"]}, {
+                            "$set": {"top_words": results}}, upsert=True))
+            count += 1
+            if len(bulk_ops) >= bulk_size:
+                db_out[collection_name].bulk_write(bulk_ops, ordered=False)
+                bulk_ops = []
+        if bulk_ops:
+            db_out[collection_name].bulk_write(bulk_ops, ordered=False)
+        print(f"INFO: {count} {collection_name} top words created")
+
+
+def _title_hash(title, lang, models_version):
+    """
+    Hash of the text lemmatized for a work, it changes if the title, the language or the models change.
+    """
+    return sha1("\x00".join([models_version, lang or "", title]).encode("utf-8")).hexdigest()
+
+
+def _members_hash(authors_ids, affiliations_ids):
+    """
+    Hash of the authors and affiliations of a work.
+    """
+    members = "\x00".join(sorted(str(idx) for idx in authors_ids)) + "\x01" + \
+        "\x00".join(sorted(str(idx) for idx in affiliations_ids))
+    return sha1(members.encode("utf-8")).hexdigest()
+
+
+def update_lemma_cache(db_in, db_out, es_model, en_model, stopwords, batch_size=NLP_BATCH_SIZE, n_process=1,
+                       bulk_size=TOP_WORDS_BULK_SIZE, verbose=0):
+    """
+    Update the per-work lemma bags stored in the calculations database (works_lemmas collection).
+
+    Every cached work has the hash of its title (with the language and the spaCy models version),
+    the lemma counts and the ids of its authors and affiliations.
+    Only the works with new or changed titles are lemmatized, the works with new authors or affiliations
+    only get the ids updated and the works that are not in the kahi database anymore are removed.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the lemma bags are stored.
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int
+        Number of titles per nlp.pipe batch.
+    n_process : int
+        Number of processes used by nlp.pipe.
+    bulk_size : int
+        Number of operations per bulk write.
+    verbose : int
+        Verbosity level.
+
+    Returns:
+    -------
+    dict
+        Number of works lemmatized, updated, unchanged and removed.
+    """
+    models_version = "/".join([es_model.meta.get("name", ""), es_model.meta.get("version", ""),
+                               en_model.meta.get("name", ""), en_model.meta.get("version", "")])
+    cache = db_out[LEMMAS_COLLECTION]
+    cached = {reg["_id"]: (reg.get("hash"), reg.get("members_hash"))
+              for reg in cache.find({}, {"hash": 1, "members_hash": 1})}
+    stats = {"lemmatized": 0, "updated": 0, "unchanged": 0, "removed": 0}
+    bulk_ops = []
+    chunk = []
+
+    def write(force=False):
+        nonlocal bulk_ops
+        if bulk_ops and (force or len(bulk_ops) >= bulk_size):
+            cache.bulk_write(bulk_ops, ordered=False)
+            bulk_ops = []
+
+    def process_chunk():
+        bags = lemmatize_titles([(title, lang) for _, title, lang, _ in chunk],
+                                es_model, en_model, stopwords, batch_size, n_process)
+        for bag, (_id, _, _, record) in zip(bags, chunk):
+            record["lemmas"] = [{"name": lemma, "value": count}
+                                for lemma, count in bag]
+            bulk_ops.append(ReplaceOne({"_id": _id}, record, upsert=True))
+            write()
+        stats["lemmatized"] += len(chunk)
+        if verbose > 1:
+            print(f"INFO: {stats['lemmatized']} titles lemmatized")
+        chunk.clear()
+
+    projection = {"titles.title": 1, "titles.lang": 1,
+                  "authors.id": 1, "authors.affiliations.id": 1}
+    for work in db_in["works"].find({"titles.title": {"$exists": 1}}, projection):
+        authors_ids = set()
+        affiliations_ids = set()
+        for author in work.get("authors", []):
+            if "id" in author:
+                authors_ids.add(author["id"])
+            for aff in author.get("affiliations", []):
+                if "id" in aff:
+                    affiliations_ids.add(aff["id"])
+        title = work["titles"][0]["title"]
+        lang = work["titles"][0]["lang"]
+        title_hash = _title_hash(title, lang, models_version)
+        members_hash = _members_hash(authors_ids, affiliations_ids)
+        previous = cached.pop(work["_id"], None)
+        if previous == (title_hash, members_hash):
+            stats["unchanged"] += 1
+            continue
+        members = {"authors": list(authors_ids), "affiliations": list(
+            affiliations_ids), "members_hash": members_hash}
+        if previous is not None and previous[0] == title_hash:
+            bulk_ops.append(UpdateOne({"_id": work["_id"]}, {"$set": members}))
+            stats["updated"] += 1
+            write()
+            continue
+        record = {"hash": title_hash}
+        record.update(members)
+        chunk.append((work["_id"], title, lang, record))
+        if len(chunk) >= WORKS_CHUNK_SIZE:
+            process_chunk()
+    if chunk:
+        process_chunk()
+    write(force=True)
+
+    removed = list(cached.keys())
+    for i in range(0, len(removed), bulk_size):
+        cache.delete_many({"_id": {"$in": removed[i:i + bulk_size]}})
+    stats["removed"] = len(removed)
+    return stats
+
+
+def top_words_from_cache(db_in, db_out, collection_name, field, size=20, bulk_size=TOP_WORDS_BULK_SIZE):
+    """
+    Rebuild the top words of all the entities of a collection from the cached lemma bags
+    with a server side $unwind/$group, the entities without works get an empty list.
+    Words with the same count are sorted alphabetically.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the lemma bags are and the top words will be stored.
+    collection_name : str
+        The collection of the entities, person or affiliations.
+    field : str
+        The field of the lemma bags with the entities ids, authors or affiliations.
+    size : int
+        The number of words to keep.
+    bulk_size : int
+        Number of upserts per bulk write.
+
+    Returns:
+    -------
+    int
+        Number of entities updated.
+    """
+    pipeline = [
+        {"$project": {"_id": 0, field: 1, "lemmas": 1}},
+        {"$unwind": "$" + field},
+        {"$unwind": "$lemmas"},
+        {"$group": {"_id": {"entity": "$" + field, "name": "$lemmas.name"},
+                    "value": {"$sum": "$lemmas.value"}}},
+        {"$group": {"_id": "$_id.entity", "top_words": {"$topN": {
+            "n": size,
+            "sortBy": {"value": -1, "_id.name": 1},
+            "output": {"name": "$_id.name", "value": "$value"}
+        }}}},
+    ]
+    bulk_ops = []
+    updated = set()
+    for reg in db_out[LEMMAS_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        updated.add(reg["_id"])
+        bulk_ops.append(UpdateOne({"_id": reg["_id"]}, {
+                        "$set": {"top_words": reg["top_words"]}}, upsert=True))
+        if len(bulk_ops) >= bulk_size:
+            db_out[collection_name].bulk_write(bulk_ops, ordered=False)
+            bulk_ops = []
+    for reg in db_in[collection_name].find({}, {"_id": 1}):
+        if reg["_id"] in updated:
+            continue
+        bulk_ops.append(UpdateOne({"_id": reg["_id"]}, {
+                        "$set": {"top_words": []}}, upsert=True))
+        if len(bulk_ops) >= bulk_size:
+            db_out[collection_name].bulk_write(bulk_ops, ordered=False)
+            bulk_ops = []
+    if bulk_ops:
+        db_out[collection_name].bulk_write(bulk_ops, ordered=False)
+    return len(updated)
+
+
+def create_top_words_incremental(db_in, db_out, es_model, en_model, stopwords, batch_size=NLP_BATCH_SIZE, n_process=1,
+                                 bulk_size=TOP_WORDS_BULK_SIZE, verbose=0):
+    """
+    Create the top words of all the affiliations and persons from the lemma bags cached in the calculations database,
+    only the works with new or changed titles are lemmatized.
+
+    Parameters:
+    ----------
+    db_in : pymongo.database.Database (kahi dabatabase)
+        The database where the information is stored.
+    db_out : pymongo.database.Database (calculation database)
+        The database where the information will be stored.
+    es_model : spacy.lang.es.Spanish
+        The Spanish model for the NLP.
+    en_model : spacy.lang.en.English
+        The English model for the NLP.
+    stopwords : set
+        The stopwords to ignore.
+    batch_size : int
+        Number of titles per nlp.pipe batch.
+    n_process : int
+        Number of processes used by nlp.pipe.
+    bulk_size : int
+        Number of operations per bulk write.
+    verbose : int
+        Verbosity level.
+    """
+    print("INFO: Updating lemma bags of works titles")
+    stats = update_lemma_cache(db_in, db_out, es_model, en_model, stopwords,
+                               batch_size, n_process, bulk_size, verbose)
+    print(
+        f"INFO: lemma bags: {stats['lemmatized']} lemmatized, {stats['updated']} updated, "
+        f"{stats['unchanged']} unchanged, {stats['removed']} removed")
+    for collection_name, field in [("affiliations", "affiliations"), ("person", "authors")]:
+        print(f"INFO: Creating top words for {collection_name}")
+        count = top_words_from_cache(
+            db_in, db_out, collection_name, field, bulk_size=bulk_size)
+        print(f"INFO: {count} {collection_name} top words created")
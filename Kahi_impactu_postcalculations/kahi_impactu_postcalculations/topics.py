@@ -1,7 +1,20 @@
+import json
+from hashlib import sha1
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from joblib import Parallel, delayed
+from pymongo import UpdateOne
 
 type_url_base = "https://openalex.org/T"
 
+INFERENCE_BATCH_SIZE = 32
+INFERENCE_CONCURRENCY = 4
+INFERENCE_RETRIES = 3
+INFERENCE_BACKOFF_FACTOR = 1
+INFERENCE_TIMEOUT = 300
+PREDICTIONS_COLLECTION = "topics_predictions"
+
 
 def request_topic_inference(title, abstract={}, journal_name="", inference_endpoint="http://localhost:8080/invocations"):
     """
@@ -25,19 +38,175 @@ def request_topic_inference(title, abstract={}, journal_name="", inference_endpo
     requests.Response
         Response of the inference service
     """
-    payload = [
-        {"title": title,
-         "abstract_inverted_index": abstract,
-         "inverted": True,
-         "referenced_works": [],
-         "journal_display_name": journal_name}
-    ]
+    payload = [inference_payload(title, abstract, journal_name)]
 
     req = requests.post(inference_endpoint, json=payload)
     return req
 
 
-def get_openalex_topic(col_oa, topic_pred):
+def inference_payload(title, abstract={}, journal_name=""):
+    """
+    Build the payload item sent to the inference service for one work
+
+    Parameters
+    ----------
+    title : str
+        Title of the work
+    abstract : dict, optional
+        Abstract of the work, by default {}
+    journal_name : str, optional
+        Name of the journal where the work was published, by default ""
+
+    Returns
+    -------
+    dict
+        Payload item for the inference service
+    """
+    return {"title": title,
+            "abstract_inverted_index": abstract,
+            "inverted": True,
+            "referenced_works": [],
+            "journal_display_name": journal_name}
+
+
+def work_inference_payload(work):
+    """
+    Build the payload item sent to the inference service from a work,
+    works without abstract are not sent to the inference.
+
+    Parameters
+    ----------
+    work : dict
+        Work with titles, abstracts and source
+
+    Returns
+    -------
+    dict or None
+        Payload item for the inference service, None if the work has no abstract
+    """
+    if len(work["abstracts"]) == 0:
+        return None
+    title = work["titles"][0]["title"]
+    abstract = work["abstracts"][0]["abstract"]
+    journal_name = work["source"]["name"] if work["source"] != {} else ""
+    return inference_payload(title, abstract, journal_name)
+
+
+def payload_hash(payload, model_version=""):
+    """
+    Hash of the exact payload sent to the inference service and the version of the model,
+    works with the same title, abstract and journal share the same hash.
+
+    Parameters
+    ----------
+    payload : dict
+        Payload item of the work
+    model_version : str, optional
+        Version of the model served by the inference service
+
+    Returns
+    -------
+    str
+        Hexadecimal sha1 of the payload and the model version
+    """
+    content = json.dumps(payload, sort_keys=True,
+                         ensure_ascii=False, default=str)
+    return sha1("\x00".join([str(model_version), content]).encode("utf-8")).hexdigest()
+
+
+def create_inference_session(pool_size=INFERENCE_CONCURRENCY, retries=INFERENCE_RETRIES,
+                             backoff_factor=INFERENCE_BACKOFF_FACTOR):
+    """
+    Create a HTTP session with a connection pool and retries with exponential backoff
+    for connection errors and 429/5xx responses.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Number of connections kept in the pool, it should be the number of concurrent requests
+    retries : int, optional
+        Number of retries for every request
+    backoff_factor : float, optional
+        Backoff factor between retries, the sleep is backoff_factor * 2 ** (retry - 1) seconds
+
+    Returns
+    -------
+    requests.Session
+        Session to send the requests
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=frozenset(["POST"]),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def request_topics_inference(session, payloads, inference_endpoint="http://localhost:8080/invocations",
+                             timeout=INFERENCE_TIMEOUT):
+    """
+    Method to request the topic inference for a batch of works in a single request
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session to send the request
+    payloads : list
+        Payload items of the works
+    inference_endpoint : str, optional
+        Endpoint of the inference service, by default "http://localhost:8080/invocations"
+    timeout : int, optional
+        Timeout of the request in seconds
+
+    Returns
+    -------
+    list or None
+        Predictions for every payload item in the same order, None if the request fails
+    """
+    try:
+        req = session.post(inference_endpoint, json=payloads, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"ERROR: request for inference fails {e}")
+        return None
+    if req.status_code != 200:
+        print(
+            f"ERROR: request for inference fails status code {req.status_code} for {len(payloads)} works")
+        return None
+    predictions = req.json()
+    if len(predictions) != len(payloads):
+        print(
+            f"ERROR: inference returned {len(predictions)} predictions for {len(payloads)} works")
+        return None
+    return predictions
+
+
+def load_openalex_topics(col_oa):
+    """
+    Load the OpenAlex topics collection in a dictionary indexed by the URL of the topic.
+    The dictionary is built once per stage and shared read-only between the threads.
+
+    Parameters
+    ----------
+    col_oa : pymongo.collection.Collection
+        Collection of OpenAlex topics
+
+    Returns
+    -------
+    dict
+        Topics with the fields id, display_name, subfield, field and domain indexed by id
+    """
+    topics = {}
+    for topic in col_oa.find({}, {"id": 1, "display_name": 1, "subfield": 1, "field": 1, "domain": 1}):
+        topics[topic["id"]] = topic
+    print(f"INFO: {len(topics)} OpenAlex topics loaded")
+    return topics
+
+
+def get_openalex_topic(col_oa, topic_pred, topics=None):
     """
     Retrieve the topic from OpenAlex based on the prediction,
     and add the score of the prediction to the topic.
@@ -57,6 +226,8 @@ def get_openalex_topic(col_oa, topic_pred):
         Prediction of the topic, with the following fields:
         - topic_id: ID of the topic
         - topic_score: Score of the prediction
+    topics : dict, optional
+        Topics loaded with load_openalex_topics, if None the topic is queried in col_oa
 
     Returns
     -------
@@ -65,8 +236,13 @@ def get_openalex_topic(col_oa, topic_pred):
 
     """
     topic_url = type_url_base + str(topic_pred['topic_id'])
-    topic = col_oa.find_one({"id": topic_url}, {
-                            "id": 1, "display_name": 1, "subfield": 1, "field": 1, "domain": 1})
+    if topics is None:
+        topic = col_oa.find_one({"id": topic_url}, {
+                                "id": 1, "display_name": 1, "subfield": 1, "field": 1, "domain": 1})
+    else:
+        topic = topics.get(topic_url)
+        if topic is not None:
+            topic = dict(topic)
     if topic is None:
         topic = {"id": topic_pred['topic_id'], "display_name": "Unknown",
                  "subfield": "Unknown", "field": "Unknown", "domain": "Unknown"}
@@ -76,7 +252,7 @@ def get_openalex_topic(col_oa, topic_pred):
     return topic
 
 
-def process_topic(col, col_oa, work, inference_endpoint="http://localhost:8080/invocations"):
+def process_topic(col, col_oa, work, inference_endpoint="http://localhost:8080/invocations", topics=None):
     """
     Process the topic inference for a given work and retrieve the topics from OpenAlex.
     The work is updated with the primary topic and the list of topics.
@@ -91,6 +267,8 @@ def process_topic(col, col_oa, work, inference_endpoint="http://localhost:8080/i
         Work to process
     inference_endpoint : str, optional
         Endpoint of the inference service, by default "http://localhost:8080/invocations"
+    topics : dict, optional
+        Topics loaded with load_openalex_topics, if None the topics are queried in col_oa
     """
     title = work["titles"][0]["title"]
     if len(work["abstracts"]) == 0:
@@ -101,15 +279,213 @@ def process_topic(col, col_oa, work, inference_endpoint="http://localhost:8080/i
         title, abstract, journal_name, inference_endpoint)
     if req.status_code == 200:
         topics_ids_pred = req.json()
-
-        for topic_pred in topics_ids_pred[0]:
-            topic = get_openalex_topic(col_oa, topic_pred)
-
-            if work["primary_topic"] == {}:
-                work["primary_topic"] = topic
-            work["topics"].append(topic)
-        col.update_one({"_id": work["_id"]}, {
-                       "$set": {"primary_topic": work["primary_topic"], "topics": work["topics"]}})
+        col.bulk_write(
+            [topics_update(col_oa, work, topics_ids_pred[0], topics)])
     else:
         print(
             f"ERROR: request for inference fails status code {req.status_code}\n", work)
+
+
+def topics_update(col_oa, work, topics_pred, topics=None):
+    """
+    Build the update of a work with the primary topic and the list of topics from its predictions.
+
+    Parameters
+    ----------
+    col_oa : pymongo.collection.Collection
+        Collection of OpenAlex topics
+    work : dict
+        Work to update
+    topics_pred : list
+        Predictions of the topics for the work
+    topics : dict, optional
+        Topics loaded with load_openalex_topics, if None the topics are queried in col_oa
+
+    Returns
+    -------
+    pymongo.UpdateOne
+        Update operation for the work
+    """
+    for topic_pred in topics_pred:
+        topic = get_openalex_topic(col_oa, topic_pred, topics)
+
+        if work["primary_topic"] == {}:
+            work["primary_topic"] = topic
+        work["topics"].append(topic)
+    return UpdateOne({"_id": work["_id"]}, {
+        "$set": {"primary_topic": work["primary_topic"], "topics": work["topics"]}})
+
+
+def process_topics_batch(col, col_oa, works, session, inference_endpoint="http://localhost:8080/invocations",
+                         timeout=INFERENCE_TIMEOUT, topics=None, cache=None, model_version=""):
+    """
+    Process the topic inference for a batch of works with a single request
+    and update the works with a bulk write.
+
+    If a cache collection is given, the predictions are looked up first by the hash of the payload
+    and the model version, only the missing payloads are sent to the inference service
+    (identical payloads in the batch are sent once) and the new predictions are stored in the cache.
+
+    Parameters
+    ----------
+    col : pymongo.collection.Collection
+        Collection of the works (kahi database)
+    col_oa : pymongo.collection.Collection
+        Collection of OpenAlex topics
+    works : list
+        Works to process
+    session : requests.Session
+        Session to send the request
+    inference_endpoint : str, optional
+        Endpoint of the inference service, by default "http://localhost:8080/invocations"
+    timeout : int, optional
+        Timeout of the request in seconds
+    topics : dict, optional
+        Topics loaded with load_openalex_topics, if None the topics are queried in col_oa
+    cache : pymongo.collection.Collection, optional
+        Collection with the cached predictions, if None the cache is not used
+    model_version : str, optional
+        Version of the model served by the inference service
+
+    Returns
+    -------
+    dict
+        Number of works updated, cache hits, cache misses and the ids of the works updated
+    """
+    stats = {"updated": 0, "hits": 0, "misses": 0, "ids": []}
+    works_ = []
+    payloads = {}
+    for work in works:
+        payload = work_inference_payload(work)
+        if payload is None:
+            continue
+        key = payload_hash(payload, model_version)
+        works_.append((work, key))
+        payloads[key] = payload
+    if not payloads:
+        return stats
+
+    predictions = {}
+    if cache is not None:
+        for reg in cache.find({"_id": {"$in": list(payloads.keys())}}, {"predictions": 1}):
+            predictions[reg["_id"]] = reg["predictions"]
+    missing = [key for key in payloads.keys() if key not in predictions]
+    missed = set(missing)
+    if missing:
+        response = request_topics_inference(
+            session, [payloads[key] for key in missing], inference_endpoint, timeout)
+        if response is not None:
+            predictions.update(zip(missing, response))
+            if cache is not None:
+                cache.bulk_write([UpdateOne({"_id": key}, {"$set": {"model_version": model_version, "predictions": pred}}, upsert=True)
+                                  for key, pred in zip(missing, response)], ordered=False)
+
+    bulk_ops = []
+    for work, key in works_:
+        if key not in predictions:
+            continue
+        if key in missed:
+            stats["misses"] += 1
+        else:
+            stats["hits"] += 1
+        bulk_ops.append(topics_update(
+            col_oa, work, predictions[key], topics))
+        stats["ids"].append(work["_id"])
+    if bulk_ops:
+        col.bulk_write(bulk_ops, ordered=False)
+    stats["updated"] = len(bulk_ops)
+    return stats
+
+
+def _batches(cursor, batch_size):
+    """
+    Split a cursor in lists of batch_size documents.
+    """
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process_topics(col, col_oa, works, inference_endpoint="http://localhost:8080/invocations",
+                   batch_size=INFERENCE_BATCH_SIZE, concurrency=INFERENCE_CONCURRENCY,
+                   retries=INFERENCE_RETRIES, backoff_factor=INFERENCE_BACKOFF_FACTOR,
+                   timeout=INFERENCE_TIMEOUT, cache=None, model_version="", verbose=0):
+    """
+    Process the topic inference for the works sending batches of works per request,
+    with at most concurrency requests at the same time over a pooled session.
+    The predictions are looked up first in the cache collection if it is given,
+    the cache is only used with a non-empty model_version.
+
+    Parameters
+    ----------
+    col : pymongo.collection.Collection
+        Collection of the works (kahi database)
+    col_oa : pymongo.collection.Collection
+        Collection of OpenAlex topics
+    works : iterable
+        Works to process (cursor)
+    inference_endpoint : str, optional
+        Endpoint of the inference service, by default "http://localhost:8080/invocations"
+    batch_size : int, optional
+        Number of works per request
+    concurrency : int, optional
+        Maximum number of concurrent requests
+    retries : int, optional
+        Number of retries for every request
+    backoff_factor : float, optional
+        Backoff factor between retries
+    timeout : int, optional
+        Timeout of the requests in seconds
+    cache : pymongo.collection.Collection, optional
+        Collection with the cached predictions, if None the cache is not used
+    model_version : str, optional
+        Version of the model served by the inference service, cached predictions of other versions are not used.
+        Required to use the cache, with an empty version the cache is disabled.
+    verbose : int, optional
+        Verbosity level of the parallel execution
+
+    Returns
+    -------
+    dict
+        Number of works updated, cache hits, cache misses and the ids of the works updated
+    """
+    if cache is not None and not model_version:
+        print("WARNING: inference_model_version is not set, the topics predictions cache is disabled")
+        cache = None
+    topics = load_openalex_topics(col_oa)
+    session = create_inference_session(concurrency, retries, backoff_factor)
+    try:
+        results = Parallel(
+            n_jobs=concurrency,
+            verbose=verbose,
+            backend="threading",
+        )(
+            delayed(process_topics_batch)(
+                col,
+                col_oa,
+                batch,
+                session,
+                inference_endpoint,
+                timeout,
+                topics,
+                cache,
+                model_version,
+            )
+            for batch in _batches(works, batch_size)
+        )
+    finally:
+        session.close()
+    stats = {"updated": 0, "hits": 0, "misses": 0, "ids": []}
+    for result in results:
+        for key, value in result.items():
+            stats[key] += value
+    print(f"INFO: topics set for {stats['updated']} works")
+    if cache is not None:
+        print(
+            f"INFO: topics predictions cache hits {stats['hits']} misses {stats['misses']}")
+    return stats
@@ -1,3 +1,7 @@
+from pymongo import UpdateOne
+
+TYPES_BULK_SIZE = 500
+
 
 def get_scienti_string(work):
     """
@@ -27,8 +31,8 @@ def process_scienti(work, types, verbose=False):
     ----------
     work: dict
         The work from kahi
-    types: pandas.DataFrame
-        The types dataframe
+    types: dict
+        The impactu types compiled with compile_types
     verbose: bool
         If True, print warnings
 
@@ -38,7 +42,7 @@ def process_scienti(work, types, verbose=False):
         The impactu type or an empty dictionary if type is not found
     """
     t = get_scienti_string(work)
-    impactu_type = types[types["Tipo"] == t]["Tipo ImpactU"].values
+    impactu_type = types.get(("scienti", t), [])
     if len(impactu_type) > 1 and verbose:
         print(f"WARNING: more than one type found for {t} = {impactu_type}")
     if len(impactu_type) == 1:
@@ -54,8 +58,8 @@ def process_minciencias(work, types):
     ----------
     work: dict
         The work from kahi
-    types: pandas.DataFrame
-        The impactu types
+    types: dict
+        The impactu types compiled with compile_types
 
     Returns:
     -------
@@ -63,7 +67,7 @@ def process_minciencias(work, types):
         The impactu type or an empty dictionary if type is not found
     """
     t = work["types"][0]["type"] + ": " + work["types"][1]["type"]
-    impactu_type = types[types["Tipo"] == t]["Tipo ImpactU"].values
+    impactu_type = types.get(("minciencias", t), [])
     if len(impactu_type) > 1:
         print(f"WARNING: more than one type found for {t} = {impactu_type}")
     if len(impactu_type) == 1:
@@ -93,8 +97,8 @@ def process_others(source):
         ----------
         work: dict
             The work from kahi
-        types: pandas.DataFrame
-            The impactu types
+        types: dict
+            The impactu types compiled with compile_types
 
         Returns:
         -------
@@ -102,7 +106,7 @@ def process_others(source):
             The impactu type or an empty dictionary if type is not found
         """
         t = work["types"][0]["type"]
-        impactu_type = types[types["Tipo"] == t]["Tipo ImpactU"].values
+        impactu_type = types.get((source, t), [])
         if len(impactu_type) > 1:
             print(
                 f"WARNING: more than one type found for {t} = {impactu_type}")
@@ -123,6 +127,38 @@ functors["openalex"] = process_others("openalex")
 functors["scholar"] = process_others("scholar")
 
 
+def compile_types(types, sources=None):
+    """
+    Compile the impactu types dataframe in a dictionary to get the impactu types of a source type in O(1).
+    A row of the dataframe is assigned to every source contained in its "Fuente" column (case insensitive),
+    the same rows selected by types["Fuente"].str.contains(source, case=False).
+
+    Parameters:
+    ----------
+    types: pandas.DataFrame
+        The impactu types with the columns "Fuente", "Tipo" and "Tipo ImpactU"
+    sources: list
+        The sources to compile, by default the sources with a functor
+
+    Returns:
+    -------
+    dict
+        The impactu types found for every (source, tipo), the list has more than one
+        element if the type is mapped more than once.
+    """
+    if sources is None:
+        sources = list(functors.keys())
+    compiled = {}
+    for fuente, tipo, impactu_type in types[["Fuente", "Tipo", "Tipo ImpactU"]].itertuples(index=False):
+        if not isinstance(fuente, str):
+            continue
+        fuente = fuente.lower()
+        for source in sources:
+            if source.lower() in fuente:
+                compiled.setdefault((source, tipo), []).append(impactu_type)
+    return compiled
+
+
 def process_type(db, work, source, types, verbose=True):
     """
     Process one work to get the impactu type
@@ -135,20 +171,123 @@ def process_type(db, work, source, types, verbose=True):
         The work from kahi
     source: str
         The source of the types ex: minciencias, scienti, ciarp, openalex, scholar
-    types: pandas.DataFrame
-        The impactu types
+    types: dict
+        The impactu types compiled with compile_types
     verbose: bool
         If True, print warnings
 
     """
-    df_filtered = types[types["Fuente"].str.contains(
-        source, case=False, na=False)]
     if len(work["types"]) > 1 and (source != "minciencias" or source != "scienti") and verbose:
         print(f"WARNING: more than one type found for {source} = {work}")
 
-    impactu_type = functors[source](work, df_filtered)
+    impactu_type = functors[source](work, types)
     if impactu_type:
         db["works"].update_one({"_id": work["_id"]},
                                {"$push": {"types": impactu_type}})
     elif verbose:
         print(f"WARNING: impactu type not found for {work}")
+
+
+def _sort_by_level(types):
+    """
+    Sort the types of a source by level as {"$sortArray": {"input": "$types", "sortBy": {"level": 1}}},
+    types without level go first.
+    """
+    return sorted(types, key=lambda t: (t.get("level") is not None, t.get("level") if t.get("level") is not None else 0))
+
+
+def impactu_type_for_work(work, types, priority, verbose=0):
+    """
+    Get the impactu type of a work using the types of the first source in priority with a known impactu type.
+
+    Parameters:
+    ----------
+    work: dict
+        The work from kahi with the types
+    types: dict
+        The impactu types compiled with compile_types
+    priority: list
+        The sources in priority order, the sources without functor are ignored
+    verbose: int
+        If greater than 1, print warnings
+
+    Returns:
+    -------
+    tuple
+        (source, impactu type, sources) where sources are the sources with types in the work,
+        source is None and impactu type is {} if the type is not found
+    """
+    sources = [source for source in priority if source in functors and any(
+        t.get("source") == source for t in work["types"])]
+    for source in sources:
+        source_types = [t for t in work["types"] if t.get("source") == source]
+        source_work = {"_id": work["_id"],
+                       "types": _sort_by_level(source_types)}
+        if len(source_work["types"]) > 1 and verbose > 1:
+            print(
+                f"WARNING: more than one type found for {source} = {source_work}")
+        impactu_type = functors[source](source_work, types)
+        if impactu_type:
+            return source, impactu_type, sources
+        if verbose > 1:
+            print(f"WARNING: impactu type not found for {source_work}")
+    return None, {}, sources
+
+
+def process_types(db, types, priority, batch_size=TYPES_BULK_SIZE, dry_run=False, verbose=0):
+    """
+    Set the impactu type of the works without it in a single pass over the works collection.
+    The source priority is applied in memory and the types are pushed with unordered bulk writes.
+
+    Parameters:
+    ----------
+    db: pymongo.database.Database
+        The database
+    types: dict
+        The impactu types compiled with compile_types
+    priority: list
+        The sources in priority order ex: minciencias, scienti, ciarp, openalex, scholar
+    batch_size: int
+        Number of updates per bulk write
+    dry_run: bool
+        If True, the works are not updated, only the coverage per source is reported
+    verbose: int
+        If greater than 1, print warnings for every work
+
+    Returns:
+    -------
+    dict
+        Coverage per source, number of works with types of the source and number of works typed from the source
+    """
+    coverage = {source: {"works": 0, "typed": 0}
+                for source in priority if source in functors}
+    not_found = 0
+    bulk_ops = []
+    works = db["works"].find(
+        {"$and": [{"types.source": {"$ne": "impactu"}}, {"types.source": {"$in": list(coverage.keys())}}]}, {"types": 1})
+    for work in works:
+        source, impactu_type, sources = impactu_type_for_work(
+            work, types, priority, verbose)
+        for _source in sources:
+            coverage[_source]["works"] += 1
+        if not impactu_type:
+            not_found += 1
+            continue
+        coverage[source]["typed"] += 1
+        if dry_run:
+            continue
+        bulk_ops.append(UpdateOne({"_id": work["_id"]}, {
+                        "$push": {"types": impactu_type}}))
+        if len(bulk_ops) >= batch_size:
+            db["works"].bulk_write(bulk_ops, ordered=False)
+            bulk_ops = []
+    if bulk_ops:
+        db["works"].bulk_write(bulk_ops, ordered=False)
+
+    for source, counts in coverage.items():
+        print(
+            f"INFO: types for {source} found in {counts['works']} works, impactu type set from it in {counts['typed']} works")
+    print(f"INFO: impactu type not found for {not_found} works")
+    if dry_run:
+        print("INFO: types dry run, the works were not updated")
+    return coverage
@@ -86,6 +86,8 @@ def main():
             'joblib',
             'datetime',
             'openpyxl',
+            'numpy',
+            'requests',
         ],
     )
 
@@ -3,6 +3,7 @@ from pymongo import MongoClient, TEXT
 from pymongo.errors import ConnectionFailure
 from joblib import Parallel, delayed
 from kahi_minciencias_opendata_works.process_one import process_one
+from kahi_entity_resolver.resolver import resolver_from_config, set_resolver
 from mohan.Similarity import Similarity
 
 
@@ -32,6 +33,10 @@ class Kahi_minciencias_opendata_works(KahiBase):
                 - es_url: the URL for the Elasticsearch server
                 - es_user: the username for the Elasticsearch server
                 - es_password: the password for the Elasticsearch server
+                - resolver_cache: cache the lookups of affiliations (default False)
+                - resolver_cache_size: maximum number of cached lookups
+                - resolver_ttl: time to live of the cached lookups in seconds
+                - resolver_warm: preload the cache with the affiliations (default False)
         """
         self.config = config
 
@@ -73,6 +78,9 @@ class Kahi_minciencias_opendata_works(KahiBase):
         self.verbose = config["minciencias_opendata_works"]["verbose"] if "verbose" in config["minciencias_opendata_works"].keys(
         ) else 0
 
+        self.resolver = resolver_from_config(
+            self.db, config["minciencias_opendata_works"], ["affiliations"])
+
         # checking if the databases and collections are available
         self.check_databases_and_collections()
 
@@ -148,5 +156,9 @@ class Kahi_minciencias_opendata_works(KahiBase):
         client.close()
 
     def run(self):
+        set_resolver(self.resolver)
         self.process_opendata()
+        set_resolver(None)
+        if self.resolver:
+            self.resolver.report()
         return 0
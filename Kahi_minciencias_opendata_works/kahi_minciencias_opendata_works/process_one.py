@@ -1,4 +1,5 @@
 from kahi_minciencias_opendata_works.parser import parse_minciencias_opendata
+from kahi_entity_resolver.resolver import find_one
 from kahi_impactu_utils.Utils import compare_author
 from thefuzz import process, fuzz
 from unidecode import unidecode
@@ -28,8 +29,8 @@ def get_units_affiations(db, author_db, affiliations):
     institution_id = None
     # verifiying univeristy
     for j, aff in enumerate(affiliations):
-        aff_db = db["affiliations"].find_one(
-            {"_id": aff["id"]}, {"_id": 1, "types": 1})
+        aff_db = find_one(
+            db, "affiliations", {"_id": aff["id"]}, {"_id": 1, "types": 1})
         if aff_db:
             types = [i["type"] for i in aff_db["types"]]
             if "group" in types or "department" in types or "faculty" in types:
@@ -114,11 +115,11 @@ def process_one_update(openadata_reg, colav_reg, db, collection, empty_work, ver
                 if author_db:
                     group_id = minciencias_author["affiliations"][0]['external_ids'][0]['id']
 
-                    group_db = db["affiliations"].find_one(
-                        {"external_ids.source": "scienti", "external_ids.id": group_id})
+                    group_db = find_one(
+                        db, "affiliations", {"external_ids.source": "scienti", "external_ids.id": group_id})
                     if not group_db:
-                        group_db = db["affiliations"].find_one(
-                            {"external_ids.id": group_id})
+                        group_db = find_one(
+                            db, "affiliations", {"external_ids.id": group_id})
 
                     if group_db:
                         for i, author in enumerate(colav_reg["authors"]):
@@ -211,7 +212,7 @@ def process_one_update(openadata_reg, colav_reg, db, collection, empty_work, ver
                 colav_reg["ranking"].append(rank)
     # groups
     group_id = openadata_reg["cod_grupo_gr"]
-    rgroup = db["affiliations"].find_one({"external_ids.id": group_id})
+    rgroup = find_one(db, "affiliations", {"external_ids.id": group_id})
     if rgroup:
         found = False
         for group in colav_reg["groups"]:
@@ -311,8 +312,8 @@ def process_one_insert(openadata_reg, db, collection, empty_work, es_handler, ve
                     # Adding affiliations to author
                     if minciencias_author["affiliations"]:
                         group_id = minciencias_author["affiliations"][0]['external_ids'][0]['id']
-                        affiliations_db = db["affiliations"].find_one(
-                            {"external_ids.id": group_id})
+                        affiliations_db = find_one(
+                            db, "affiliations", {"external_ids.id": group_id})
 
                         if affiliations_db:
                             if entry['authors'][0]['external_ids'][0]['id'] == ext['id']:
@@ -345,7 +346,7 @@ def process_one_insert(openadata_reg, db, collection, empty_work, es_handler, ve
 
     # group
     group_id = openadata_reg["cod_grupo_gr"]
-    rgroup = db["affiliations"].find_one({"external_ids.id": group_id})
+    rgroup = find_one(db, "affiliations", {"external_ids.id": group_id})
     if rgroup:
         found = False
         for group in entry["groups"]:
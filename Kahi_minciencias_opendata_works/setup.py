@@ -83,6 +83,7 @@ def main():
             'kahi',
             'pymongo',
             'joblib',
+            'kahi_entity_resolver',
             'kahi_impactu_utils',
             'mohan'],
     )
@@ -3,6 +3,7 @@ from pymongo import MongoClient, TEXT
 from pymongo.errors import DuplicateKeyError, OperationFailure
 from joblib import Parallel, delayed
 from kahi_openalex_works.process_one import process_one
+from kahi_entity_resolver.resolver import resolver_from_config, set_resolver
 from mohan.Similarity import Similarity
 
 
@@ -32,6 +33,10 @@ class Kahi_openalex_works(KahiBase):
                 - es_url: The url of the elasticsearch server.
                 - es_user: The user for the elasticsearch server.
                 - es_password: The password for the elasticsearch server.
+                - resolver_cache: Cache the lookups of affiliations, sources and subjects (default False).
+                - resolver_cache_size: Maximum number of cached lookups.
+                - resolver_ttl: Time to live of the cached lookups in seconds.
+                - resolver_warm: Preload the cache with the affiliations, sources and subjects (default False).
         """
         self.config = config
 
@@ -96,6 +101,12 @@ class Kahi_openalex_works(KahiBase):
         self.backend = "threading" if "backend" not in config[
             "openalex_works"].keys() else config["openalex_works"]["backend"]
 
+        self.resolver = resolver_from_config(
+            self.db, config["openalex_works"], ["affiliations", "sources", "subjects"])
+        if self.resolver and self.backend != "threading":
+            print(
+                "WARNING: resolver cache is only shared with the threading backend")
+
     def process_openalex(self):
         # selects papers with doi according to task variable
         if self.task == "doi":
@@ -128,5 +139,9 @@ class Kahi_openalex_works(KahiBase):
         )
 
     def run(self):
+        set_resolver(self.resolver)
         self.process_openalex()
+        set_resolver(None)
+        if self.resolver:
+            self.resolver.report()
         return 0
@@ -1,5 +1,6 @@
 
 from kahi_openalex_works.parser import parse_openalex
+from kahi_entity_resolver.resolver import find_one
 from time import time
 from bson import ObjectId
 from pymongo import MongoClient
@@ -30,8 +31,8 @@ def get_units_affiations(db, author_db, affiliations):
         aff_db = None
         if "external_ids" in aff.keys():
             for ext in aff["external_ids"]:
-                aff_db = db["affiliations"].find_one(
-                    {"external_ids.id": ext["id"]}, {"_id": 1, "types": 1})
+                aff_db = find_one(
+                    db, "affiliations", {"external_ids.id": ext["id"]}, {"_id": 1, "types": 1})
                 if aff_db:
                     types = [i["type"] for i in aff_db["types"]]
                     if "group" in types or "department" in types or "faculty" in types:
@@ -121,8 +122,8 @@ def process_one_update(oa_reg, colav_reg, db, collection, empty_work, verbose=0)
     for subjects in entry["subjects"]:
         for i, subj in enumerate(subjects["subjects"]):
             for ext in subj["external_ids"]:
-                sub_db = db["subjects"].find_one(
-                    {"external_ids.id": ext["id"]})
+                sub_db = find_one(
+                    db, "subjects", {"external_ids.id": ext["id"]})
                 if sub_db:
                     name = sub_db["names"][0]["name"]
                     for n in sub_db["names"]:
@@ -206,8 +207,8 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
     if entry["source"]:
         if "external_ids" in entry["source"].keys():
             for ext in entry["source"]["external_ids"]:
-                source_db = db["sources"].find_one(
-                    {"external_ids.id": ext["id"]})
+                source_db = find_one(
+                    db, "sources", {"external_ids.id": ext["id"]})
                 if source_db:
                     break
     if source_db:
@@ -237,8 +238,8 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
     for subjects in entry["subjects"]:
         for i, subj in enumerate(subjects["subjects"]):
             for ext in subj["external_ids"]:
-                sub_db = db["subjects"].find_one(
-                    {"external_ids.id": ext["id"]})
+                sub_db = find_one(
+                    db, "subjects", {"external_ids.id": ext["id"]})
                 if sub_db:
                     name = sub_db["names"][0]["name"]
                     for n in sub_db["names"]:
@@ -336,8 +337,8 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                     continue
             if "external_ids" in aff.keys():
                 for ext in aff["external_ids"]:
-                    aff_db = db["affiliations"].find_one(
-                        {"external_ids.id": ext["id"]})
+                    aff_db = find_one(
+                        db, "affiliations", {"external_ids.id": ext["id"]})
                     if aff_db:
                         break
             if aff_db:
@@ -356,8 +357,8 @@ def process_one_insert(oa_reg, db, collection, empty_work, es_handler, verbose=0
                     "types": aff_db["types"]
                 }
             else:
-                aff_db = db["affiliations"].find_one(
-                    {"names.name": aff["name"]})
+                aff_db = find_one(
+                    db, "affiliations", {"names.name": aff["name"]})
                 if aff_db:
                     name = aff_db["names"][0]["name"]
                     for n in aff_db["names"]:
@@ -2,6 +2,8 @@ from kahi.KahiBase import KahiBase
 from pymongo import MongoClient
 from joblib import Parallel, delayed
 
+CLEANUP_BATCH_SIZE = 1000
+
 
 class Kahi_post_cleanup_entities(KahiBase):
 
@@ -25,6 +27,9 @@ class Kahi_post_cleanup_entities(KahiBase):
             post_cleanup_entities: # run this after all works plugins are done
                 num_jobs: 20
                 verbose: 4
+                mode: anti_join # anti_join (default) or per_entity
+                batch_size: 1000
+                dry_run: false
         """
         self.config = config
         self.mongodb_url = config["database_url"]
@@ -40,6 +45,12 @@ class Kahi_post_cleanup_entities(KahiBase):
         ) else 1
         self.verbose = config["post_cleanup_entities"]["verbose"] if "verbose" in config["post_cleanup_entities"].keys(
         ) else 0
+        self.mode = config["post_cleanup_entities"]["mode"] if "mode" in config["post_cleanup_entities"].keys(
+        ) else "anti_join"
+        self.batch_size = config["post_cleanup_entities"]["batch_size"] if "batch_size" in config["post_cleanup_entities"].keys(
+        ) else CLEANUP_BATCH_SIZE
+        self.dry_run = config["post_cleanup_entities"]["dry_run"] if "dry_run" in config["post_cleanup_entities"].keys(
+        ) else False
 
     def cleanup_author(self, author):
         """
@@ -72,10 +83,83 @@ class Kahi_post_cleanup_entities(KahiBase):
             return 1
         return 0
 
+    def referenced_authors(self):
+        """
+        get the set of author ids referenced in the works
+
+        Returns:
+        -------
+        set
+            ids in works authors.id
+        """
+        pipeline = [
+            {"$project": {"_id": 0, "authors.id": 1}},
+            {"$unwind": "$authors"},
+            {"$group": {"_id": "$authors.id"}},
+        ]
+        return set(reg["_id"] for reg in self.works.aggregate(pipeline, allowDiskUse=True))
+
+    def delete_ids(self, collection, ids):
+        """
+        remove the documents with the given ids in chunks of batch_size
+
+        Parameters:
+        ----------
+        collection : pymongo.collection.Collection
+            collection to remove the documents from
+        ids : list
+            ids of the documents to remove
+
+        Returns:
+        -------
+        int
+            number of documents removed
+        """
+        removed = 0
+        for i in range(0, len(ids), self.batch_size):
+            removed += collection.delete_many(
+                {"_id": {"$in": ids[i:i + self.batch_size]}}).deleted_count
+        return removed
+
+    def run_anti_join(self):
+        """
+        Run the post cleanup process for authors and affiliations computing the referenced ids only once.
+        The authors are removed if their ids are not in the works,
+        the affiliations if their ids are not in the authors that are kept.
+        """
+        referenced = self.referenced_authors()
+        orphan_authors = []
+        referenced_affiliations = set()
+        for author in self.person.find({}, {"_id": 1, "affiliations.id": 1}):
+            if author["_id"] not in referenced:
+                orphan_authors.append(author["_id"])
+                continue
+            for aff in author.get("affiliations", []):
+                referenced_affiliations.add(aff.get("id"))
+        del referenced
+
+        orphan_affiliations = [affiliation["_id"] for affiliation in self.affiliations.find({}, {"_id": 1})
+                               if affiliation["_id"] not in referenced_affiliations]
+        del referenced_affiliations
+
+        if self.dry_run:
+            print("INFO: Dry run, {} authors and {} affiliations would be removed".format(
+                len(orphan_authors), len(orphan_affiliations)))
+            return 0
+
+        print("INFO: Removed {} authors".format(
+            self.delete_ids(self.person, orphan_authors)))
+        print("INFO: Removed {} affiliations".format(
+            self.delete_ids(self.affiliations, orphan_affiliations)))
+        return 0
+
     def run(self):
         """
         Run the post cleanup process for authors and affiliations
         """
+        if self.mode != "per_entity":
+            return self.run_anti_join()
+
         authors = self.person.find({}, {"_id": 1})
         out = Parallel(
             n_jobs=self.n_jobs,
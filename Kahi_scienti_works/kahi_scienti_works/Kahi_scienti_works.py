@@ -2,6 +2,7 @@ from kahi.KahiBase import KahiBase
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
 from kahi_scienti_works.process_one import process_one
+from kahi_entity_resolver.resolver import resolver_from_config, set_resolver
 from mohan.Similarity import Similarity
 from kahi_impactu_utils.Utils import doi_processor
 import re
@@ -34,6 +35,10 @@ class Kahi_scienti_works(KahiBase):
                     - es_url: the URL for the Elasticsearch server
                     - es_user: the username for the Elasticsearch server
                     - es_password: the password for the Elasticsearch server
+                - resolver_cache: cache the lookups of affiliations and sources (default False)
+                - resolver_cache_size: maximum number of cached lookups
+                - resolver_ttl: time to live of the cached lookups in seconds
+                - resolver_warm: preload the cache with the affiliations and sources (default False)
         """
         self.config = config
 
@@ -71,6 +76,9 @@ class Kahi_scienti_works(KahiBase):
         self.verbose = config["scienti_works"]["verbose"] if "verbose" in config["scienti_works"].keys(
         ) else 0
 
+        self.resolver = resolver_from_config(
+            self.db, config["scienti_works"], ["affiliations", "sources"])
+
         # checking if the databases and collections are available
         self.check_databases_and_collections()
 
@@ -260,6 +268,7 @@ class Kahi_scienti_works(KahiBase):
         client.close()
 
     def run(self):
+        set_resolver(self.resolver)
         for config in self.config["scienti_works"]["databases"]:
             if self.verbose > 0:
                 print("Processing {}.{} database".format(
@@ -267,4 +276,7 @@ class Kahi_scienti_works(KahiBase):
             if self.verbose > 4:
                 print("Updating already inserted entries")
             self.process_scienti(self.db, self.collection, config)
+        set_resolver(None)
+        if self.resolver:
+            self.resolver.report()
         return 0
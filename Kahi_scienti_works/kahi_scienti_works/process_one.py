@@ -1,5 +1,6 @@
 from kahi_scienti_works.parser import parse_scienti
 from kahi_impactu_utils.Utils import lang_poll, doi_processor, compare_author, split_names, split_names_fix, check_date_format
+from kahi_entity_resolver.resolver import find_one
 import re
 from time import time
 from bson import ObjectId
@@ -130,8 +131,8 @@ def get_units_affiations(db, author_db, affiliations):
         aff_db = None
         if "external_ids" in aff.keys():
             for ext in aff["external_ids"]:
-                aff_db = db["affiliations"].find_one(
-                    {"external_ids.id": ext["id"]}, {"_id": 1, "types": 1})
+                aff_db = find_one(
+                    db, "affiliations", {"external_ids.id": ext["id"]}, {"_id": 1, "types": 1})
                 if aff_db:
                     types = [i["type"] for i in aff_db["types"]]
                     if "group" in types or "department" in types or "faculty" in types:
@@ -316,8 +317,8 @@ def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbo
         aff_db = None
         if "external_ids" in aff.keys():
             for ext in aff["external_ids"]:
-                aff_db = db["affiliations"].find_one(
-                    {"external_ids.id": ext["id"]})
+                aff_db = find_one(
+                    db, "affiliations", {"external_ids.id": ext["id"]})
                 if aff_db:
                     break
         if aff_db:
@@ -336,8 +337,8 @@ def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbo
                 "types": aff_db["types"]
             }
         else:
-            aff_db = db["affiliations"].find_one(
-                {"names.name": aff["name"]})
+            aff_db = find_one(
+                db, "affiliations", {"names.name": aff["name"]})
             if aff_db:
                 name = aff_db["names"][0]["name"]
                 for n in aff_db["names"]:
@@ -430,11 +431,11 @@ def process_one_update(scienti_reg, colav_reg, db, collection, empty_work, verbo
     # scienti groups
     if "group" in scienti_reg.keys():
         for group in scienti_reg["group"]:
-            group_reg = db["affiliations"].find_one(
-                {"external_ids.id": group["COD_ID_GRUPO"]})
+            group_reg = find_one(
+                db, "affiliations", {"external_ids.id": group["COD_ID_GRUPO"]})
             if group_reg is None:
-                group_reg = db["affiliations"].find_one(
-                    {"external_ids.id": group["NRO_ID_GRUPO"]})
+                group_reg = find_one(
+                    db, "affiliations", {"external_ids.id": group["NRO_ID_GRUPO"]})
             if group_reg:
                 found = False
                 for rgroup in colav_reg["groups"]:
@@ -501,8 +502,8 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
     source_db = None
     if "external_ids" in entry["source"].keys():
         for ext in entry["source"]["external_ids"]:
-            source_db = db["sources"].find_one(
-                {"external_ids.id": ext["id"]})
+            source_db = find_one(
+                db, "sources", {"external_ids.id": ext["id"]})
             if source_db:
                 break
     if source_db:
@@ -615,8 +616,8 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
                 continue
         if "external_ids" in aff.keys():
             for ext in aff["external_ids"]:
-                aff_db = db["affiliations"].find_one(
-                    {"external_ids.id": ext["id"]})
+                aff_db = find_one(
+                    db, "affiliations", {"external_ids.id": ext["id"]})
                 if aff_db:
                     break
         if aff_db:
@@ -635,8 +636,8 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
                 "types": aff_db["types"]
             }
         else:
-            aff_db = db["affiliations"].find_one(
-                {"names.name": aff["name"]})
+            aff_db = find_one(
+                db, "affiliations", {"names.name": aff["name"]})
             if aff_db:
                 name = aff_db["names"][0]["name"]
                 for n in aff_db["names"]:
@@ -722,11 +723,11 @@ def process_one_insert(scienti_reg, db, collection, empty_work, es_handler, doi=
     # scienti group
     if "group" in scienti_reg.keys():
         for group in scienti_reg["group"]:
-            group_reg = db["affiliations"].find_one(
-                {"external_ids.id": group["COD_ID_GRUPO"]})
+            group_reg = find_one(
+                db, "affiliations", {"external_ids.id": group["COD_ID_GRUPO"]})
             if group_reg is None:
-                group_reg = db["affiliations"].find_one(
-                    {"external_ids.id": group["NRO_ID_GRUPO"]})
+                group_reg = find_one(
+                    db, "affiliations", {"external_ids.id": group["NRO_ID_GRUPO"]})
             if group_reg:
                 entry["groups"].append(
                     {"id": group_reg["_id"], "name": group_reg["names"][0]["name"]})
@@ -2,6 +2,9 @@ from kahi_impactu_utils.Utils import compare_author
 from pymongo import MongoClient, TEXT
 from joblib import Parallel, delayed
 from kahi.KahiBase import KahiBase
+from kahi_unicity_person.union_find import UnionFind
+from kahi_unicity_person.names import AuthorComparator
+from kahi_unicity_person.merge_writer import MergeWriter
 from bson import ObjectId
 from time import time
 import copy
@@ -44,6 +47,17 @@ class Kahi_unicity_person(KahiBase):
         self.verbose = config["unicity_person"][
             "verbose"] if "verbose" in config["unicity_person"].keys() else 0
 
+        self.doi_engine = config["unicity_person"][
+            "doi_engine"] if "doi_engine" in config["unicity_person"].keys() else "union_find"
+        self.compare_cache_size = config["unicity_person"][
+            "compare_cache_size"] if "compare_cache_size" in config["unicity_person"].keys() else 1000000
+        self.name_blocking = config["unicity_person"][
+            "name_blocking"] if "name_blocking" in config["unicity_person"].keys() else False
+        self.merge_batch_size = config["unicity_person"][
+            "merge_batch_size"] if "merge_batch_size" in config["unicity_person"].keys() else 500
+        self.group_prefetch_size = config["unicity_person"][
+            "group_prefetch_size"] if "group_prefetch_size" in config["unicity_person"].keys() else 1000
+
     # Function to merge affiliations
 
     def merge_affiliations(self, target_doc, doc):
@@ -110,7 +124,7 @@ class Kahi_unicity_person(KahiBase):
                 target[field] = source[field]
     # Function to merge, store and delete documents
 
-    def merge_documents(self, authors_docs, target_doc):
+    def merge_documents(self, authors_docs, target_doc, writer=None):
         """
         Merges information from multiple author documents into a target document, updates the target document in the collection, and deletes other documents.
 
@@ -122,14 +136,28 @@ class Kahi_unicity_person(KahiBase):
             A list of author documents containing information to be merged into the target document.
         target_doc : dict
             The target document where information will be merged.
-        collection : Collection
-            The MongoDB collection to be used.
+        writer : MergeWriter
+            If given, the writes are accumulated in the writer instead of being executed.
+
+        Returns:
+        ----------
+        bool
+            False if the writer skipped the merge, True otherwise.
         """
         target_id = target_doc["_id"]
+        n_authors = len(authors_docs)
+        if writer is not None:
+            # the skip is decided before target_doc is modified
+            other_ids = writer.check_merge(
+                target_id, [doc["_id"] for doc in authors_docs if doc["_id"] != target_id])
+            if other_ids is None:
+                return False
+            authors_docs = [
+                doc for doc in authors_docs if doc["_id"] in other_ids]
         other_docs = []
         for doc in authors_docs:
             if doc['_id'] != target_id:
-                if not compare_author(target_doc, doc, len(authors_docs)):
+                if not compare_author(target_doc, doc, n_authors):
                     continue
                 # updated
                 target_update_sources = {profile["source"]
@@ -154,6 +182,9 @@ class Kahi_unicity_person(KahiBase):
                 # we need to think is a strategy
                 # self.merge_affiliations(target_doc, doc)
                 other_docs.append(doc)
+        if writer is not None:
+            return writer.add_merge(target_doc, [
+                other_doc for other_doc in other_docs if other_doc["_id"] != target_id])
         # Update the target document with new external ids
         for other_doc in other_docs:
             if target_id != other_doc["_id"]:  # double check
@@ -165,6 +196,7 @@ class Kahi_unicity_person(KahiBase):
                     "Error: The target document and the other document have the same id")
         # Update the target document in the collection
         self.collection.update_one({"_id": target_id}, {"$set": target_doc})
+        return True
 
     # Find the target document based on the 'provenance' of 'external_ids'
     def find_target_doc(self, author_docs, _id):
@@ -212,7 +244,7 @@ class Kahi_unicity_person(KahiBase):
 
     # Function to process authors unicity based on ORCID
 
-    def id_unicity(self, reg, _id, verbose=0):
+    def id_unicity(self, reg, _id, verbose=0, writer=None, author_docs=None):
         """
         Checks unicity by id among a group of author documents.
 
@@ -222,22 +254,29 @@ class Kahi_unicity_person(KahiBase):
             The object instance.
         reg : dict
             A dictionary containing a registry of aggregated author documents by ORCID id.
-        collection : Collection
-            The MongoDB collection to be used.
+        writer : MergeWriter
+            If given, the writes are accumulated in the writer instead of being executed.
+        author_docs : list
+            The author documents of the group if they were already fetched.
         """
         # Fetch all author documents by given IDs
-        author_ids = reg["document_ids"]
-        author_docs = list(self.collection.find(
-            {"_id": {"$in": [ObjectId(aid) for aid in author_ids]}}))
+        if author_docs is None:
+            author_ids = reg["document_ids"]
+            author_docs = list(self.collection.find(
+                {"_id": {"$in": [ObjectId(aid) for aid in author_ids]}}))
         if not author_docs:
             print("No authors found with the provided IDs.")
             return
 
         target_doc = self.find_target_doc(author_docs, "orcid")
-        if target_doc:
-            self.merge_documents(author_docs, target_doc)
-        self.collection_merged_sets.insert_one(
-            {"source": _id, _id: reg["_id"], "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": [aid["_id"] for aid in author_docs]})
+        if not target_doc or not self.merge_documents(author_docs, target_doc, writer):
+            return
+        merged_set = {"source": _id, _id: reg["_id"], "target_author": {
+            "_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": [aid["_id"] for aid in author_docs]}
+        if writer is not None:
+            writer.add_set(merged_set)
+        else:
+            self.collection_merged_sets.insert_one(merged_set)
 
     # Function to compare authors based on DOI
 
@@ -309,6 +348,191 @@ class Kahi_unicity_person(KahiBase):
             self.collection_merged_sets.insert_one(
                 {"source": "doi", "doi": reg["_id"], "target_author": {"_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": author_found})
 
+    def doi_candidate_pairs(self, reg, comparator=None):
+        """
+        Finds the pairs of authors accepted as the same person in a DOI group,
+        the author documents of the group are fetched only once and compared in memory.
+        The comparisons between authors already joined in the group are skipped.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        reg : dict
+            A dictionary containing a registry of aggregated author documents by DOI.
+        comparator : AuthorComparator
+            The memoized comparator, if None compare_author is used.
+
+        Returns:
+        ----------
+        list
+            The pairs of author ids accepted by compare_author.
+        """
+        compare = comparator.compare if comparator else compare_author
+        author_ids = reg["authors"]
+        n_authors = len(author_ids)
+        author_docs = list(self.collection.find({"_id": {"$in": author_ids}}, {
+            "first_names": 1, "last_names": 1, "full_name": 1, "updated": 1, "external_ids": 1, "initials": 1}))
+
+        joined = UnionFind()
+        pairs = []
+        for author in author_docs:
+            # Filter authors based on the source of the related_works
+            source_match = any(
+                updt["source"] in ['staff', 'scienti', 'minciencias', "scholar"] for updt in author["updated"]
+            )
+            if not source_match:
+                continue
+            for other_author in author_docs:
+                if author["_id"] == other_author["_id"]:
+                    continue
+                if joined.connected(author["_id"], other_author["_id"]):
+                    continue
+                if compare(author, other_author, n_authors):
+                    joined.union(author["_id"], other_author["_id"])
+                    pairs.append((author["_id"], other_author["_id"]))
+        return pairs
+
+    def doi_component_unicity(self, component, dois, writer=None):
+        """
+        Merges a connected component of authors found by DOI,
+        the components are disjoint then they can be merged in parallel.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        component : list
+            The ids of the authors in the component.
+        dois : list
+            The DOIs where the authors of the component were joined.
+        writer : MergeWriter
+            If given, the writes are accumulated in the writer instead of being executed.
+        """
+        author_docs = list(self.collection.find({"_id": {"$in": component}}))
+        if not author_docs:
+            return
+
+        target_doc = self.find_target_doc(author_docs, "doi")
+        if not target_doc or not self.merge_documents(author_docs, target_doc, writer):
+            return
+        merged_set = {"source": "doi", "doi": dois[0], "dois": dois, "target_author": {
+            "_id": target_doc["_id"], "full_name": target_doc["full_name"]}, "set": component}
+        if writer is not None:
+            writer.add_set(merged_set)
+        else:
+            self.collection_merged_sets.insert_one(merged_set)
+
+    def doi_unicity_union_find(self, authors_cursor):
+        """
+        Checks unicity by DOI in two phases, first the pairs of authors of every DOI group are compared in parallel
+        and joined in a global union-find, then every connected component is merged in parallel.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        authors_cursor : list
+            The registries of aggregated author documents by DOI.
+        """
+        # the authors are not modified while the pairs are found, then the comparisons can be memoized
+        comparator = AuthorComparator(
+            compare_author, self.compare_cache_size, self.name_blocking)
+        groups_pairs = Parallel(
+            n_jobs=self.n_jobs,
+            verbose=self.verbose,
+            backend="threading")(
+            delayed(self.doi_candidate_pairs)(
+                reg,
+                comparator
+            ) for reg in authors_cursor
+        )
+        stats = comparator.stats()
+        print("INFO: Authors comparisons {} memoized {} blocked {}".format(
+            stats["misses"], stats["hits"], stats["blocked"]))
+        authors_sets = UnionFind()
+        for pairs in groups_pairs:
+            for author_id, other_author_id in pairs:
+                authors_sets.union(author_id, other_author_id)
+        components = authors_sets.components()
+        dois = {}
+        for reg, pairs in zip(authors_cursor, groups_pairs):
+            for author_id, _ in pairs:
+                root = authors_sets.find(author_id)
+                if reg["_id"] not in dois.setdefault(root, []):
+                    dois[root].append(reg["_id"])
+        print("INFO: Number of sets of authors to merge: {}".format(
+            len(components)))
+        writer = self.merge_writer()
+        Parallel(
+            n_jobs=self.n_jobs,
+            verbose=self.verbose,
+            backend="threading")(
+            delayed(self.doi_component_unicity)(
+                component,
+                dois[root],
+                writer
+            ) for root, component in components.items()
+        )
+        if writer is not None:
+            writer.flush()
+            writer.report()
+
+    def prefetch_groups(self, groups, counter):
+        """
+        Consumes lazily the groups of authors by id and fetches the author documents of several groups
+        with a single query of at most group_prefetch_size ids.
+
+        Parameters:
+        ----------
+        self : object
+            The object instance.
+        groups : iterable
+            The registries of aggregated author documents by id (aggregation cursor).
+        counter : dict
+            The number of groups processed is stored in counter["groups"].
+
+        Returns:
+        ----------
+        generator
+            (reg, author_docs) for every group.
+        """
+        batch = []
+        nids = 0
+        for reg in groups:
+            batch.append(reg)
+            nids += len(reg["document_ids"])
+            counter["groups"] += 1
+            if nids >= self.group_prefetch_size:
+                yield from self._fetch_groups(batch)
+                batch = []
+                nids = 0
+        if batch:
+            yield from self._fetch_groups(batch)
+
+    def _fetch_groups(self, batch):
+        """
+        Fetches the author documents of a batch of groups and splits them by group.
+        """
+        ids = set()
+        for reg in batch:
+            ids.update(ObjectId(aid) for aid in reg["document_ids"])
+        docs = list(self.collection.find({"_id": {"$in": list(ids)}}))
+        # the documents of every group keep the order of the query, the first one can be the target
+        # every group gets its own copies, the merge of a group modifies them
+        positions = {doc["_id"]: pos for pos, doc in enumerate(docs)}
+        for reg in batch:
+            group_ids = set(ObjectId(aid) for aid in reg["document_ids"])
+            yield reg, [copy.deepcopy(docs[pos]) for pos in sorted(positions[aid] for aid in group_ids if aid in positions)]
+
+    def merge_writer(self):
+        """
+        Creates the writer for the merges, the writes are executed immediately if merge_batch_size is 0.
+        """
+        if self.merge_batch_size <= 0:
+            return None
+        return MergeWriter(self.collection, self.collection_merged, self.collection_merged_sets, self.merge_batch_size)
+
     def process_authors(self):
         """
         Processes authors' information including checking unicity by ORCID id and DOI among author documents.
@@ -333,12 +557,38 @@ class Kahi_unicity_person(KahiBase):
                             "$addToSet": "$_id"}, "count": {"$sum": 1}}},
                         {"$match": {"count": {"$gt": 1}}}
                     ]
+                    if self.group_prefetch_size > 0:
+                        print(
+                            f"INFO: {task} unicity for groups of authors is started!")
+                        counter = {"groups": 0}
+                        writer = self.merge_writer()
+                        Parallel(
+                            n_jobs=self.n_jobs,
+                            verbose=self.verbose,
+                            backend="threading",
+                            pre_dispatch="2*n_jobs")(
+                            delayed(self.id_unicity)(
+                                reg,
+                                task,
+                                self.verbose,
+                                writer,
+                                author_docs
+                            ) for reg, author_docs in self.prefetch_groups(
+                                self.collection.aggregate(pipeline, allowDiskUse=True), counter)
+                        )
+                        if writer is not None:
+                            writer.flush()
+                            writer.report()
+                        print(
+                            f"INFO: {task} unicity for {counter['groups']} groups of authors is done!")
+                        continue
                     authors_cursor = list(self.collection.aggregate(
                         pipeline, allowDiskUse=True))
                     print(
                         f"INFO: {task} unicity for groups of authors is started!")
                     print(
                         f"INFO: the number of groups are {len(authors_cursor)}")
+                    writer = self.merge_writer()
                     Parallel(
                         n_jobs=self.n_jobs,
                         verbose=self.verbose,
@@ -346,9 +596,13 @@ class Kahi_unicity_person(KahiBase):
                         delayed(self.id_unicity)(
                             reg,
                             task,
-                            self.verbose
+                            self.verbose,
+                            writer
                         ) for reg in authors_cursor
                     )
+                    if writer is not None:
+                        writer.flush()
+                        writer.report()
                     if self.verbose > 1:
                         print(
                             f"INFO: {task} unicity for {len(authors_cursor)} groups of authors is done!")
@@ -374,6 +628,12 @@ class Kahi_unicity_person(KahiBase):
             print("INFO: DOI unicity for groups of authors is started!")
             print("INFO: Number of groups of authors to process: {}".format(
                 len(authors_cursor)))
+            if self.doi_engine == "union_find":
+                self.doi_unicity_union_find(authors_cursor)
+                if self.verbose > 1:
+                    print("DOI unicity for {} groups of authors is done!".format(
+                        len(authors_cursor)))
+                return
             print("INFO: Number of jobs set to 1, this can not be parallelized!")
             # this can not be parallelized, because we need to merge the authors and delete the documents
             # different dois can have the same authors and this can produce that the target author in one doi can not be the target in another doi
@@ -0,0 +1,138 @@
+from pymongo import UpdateOne, DeleteOne, InsertOne
+from threading import Lock
+from copy import deepcopy
+from time import time
+
+
+class MergeWriter:
+    """
+    Accumulates the writes of the merge of authors and flushes them with ordered bulk writes per collection.
+
+    The writes are flushed in a crash-safe order: first the copies of the merged authors in the merged collection,
+    then the updates of the target authors, then the deletes of the merged authors and at the end the merged sets.
+    If the process is interrupted, a merged author is never deleted without its copy.
+    The authors already merged (pending or written) are not merged again by other groups, and the groups with
+    an author that was already the target of another merge are skipped: their documents were fetched before
+    that merge was written, then merging them would overwrite or delete the merged data.
+    """
+
+    def __init__(self, collection, collection_merged, collection_merged_sets, batch_size=500):
+        """
+        Parameters:
+        ----------
+        collection : Collection
+            The person collection.
+        collection_merged : Collection
+            The collection with the copies of the merged authors.
+        collection_merged_sets : Collection
+            The collection with the sets of merged authors.
+        batch_size : int
+            Number of merged authors that triggers a flush.
+        """
+        self.collection = collection
+        self.collection_merged = collection_merged
+        self.collection_merged_sets = collection_merged_sets
+        self.batch_size = batch_size
+        self.lock = Lock()
+        self.start = time()
+        self.merged_authors = 0
+        self.targets = 0
+        self.bulk_writes = 0
+        self.skipped = 0
+        self.merged_ids = set()
+        self.target_ids = set()
+        self._reset()
+
+    def _reset(self):
+        self.merged_ops = []
+        self.target_ops = []
+        self.delete_ops = []
+        self.sets_ops = []
+
+    def check_merge(self, target_id, other_ids):
+        """
+        Checks if a group can be merged before its documents are modified.
+
+        Returns:
+        ----------
+        list
+            The ids of other_ids that can be merged into target_id, None if the group has to be skipped.
+        """
+        with self.lock:
+            if target_id in self.merged_ids:
+                return None
+            other_ids = [
+                other_id for other_id in other_ids if other_id not in self.merged_ids]
+            if target_id in self.target_ids or any(other_id in self.target_ids for other_id in other_ids):
+                self.skipped += 1
+                return None
+            return other_ids
+
+    def add_merge(self, target_doc, other_docs):
+        """
+        Adds the writes of the merge of other_docs into target_doc.
+
+        Returns:
+        ----------
+        bool
+            True if the merge was added, False if it was skipped.
+        """
+        with self.lock:
+            if target_doc["_id"] in self.merged_ids:
+                return False
+            other_docs = [
+                other_doc for other_doc in other_docs if other_doc["_id"] not in self.merged_ids]
+            if target_doc["_id"] in self.target_ids or any(other_doc["_id"] in self.target_ids for other_doc in other_docs):
+                self.skipped += 1
+                return False
+            if not other_docs:
+                return False
+            for other_doc in other_docs:
+                self.merged_ids.add(other_doc["_id"])
+                self.merged_ops.append(UpdateOne({"_id": other_doc["_id"]}, {
+                    "$set": deepcopy(other_doc)}, upsert=True))
+                self.delete_ops.append(DeleteOne({"_id": other_doc["_id"]}))
+            self.target_ids.add(target_doc["_id"])
+            self.target_ops.append(UpdateOne({"_id": target_doc["_id"]}, {
+                "$set": deepcopy(target_doc)}))
+            self.merged_authors += len(other_docs)
+            self.targets += 1
+            full = len(self.delete_ops) >= self.batch_size
+        if full:
+            self.flush()
+        return True
+
+    def add_set(self, merged_set):
+        """
+        Adds the insert of a set of merged authors.
+        """
+        with self.lock:
+            self.sets_ops.append(InsertOne(merged_set))
+            full = len(self.sets_ops) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending operations.
+        """
+        with self.lock:
+            merged_ops, target_ops, delete_ops, sets_ops = self.merged_ops, self.target_ops, self.delete_ops, self.sets_ops
+            self._reset()
+            for collection, ops in [(self.collection_merged, merged_ops), (self.collection, target_ops),
+                                    (self.collection, delete_ops), (self.collection_merged_sets, sets_ops)]:
+                if ops:
+                    collection.bulk_write(ops, ordered=True)
+                    self.bulk_writes += 1
+
+    def report(self):
+        """
+        Prints the throughput of the merges.
+        """
+        elapsed = time() - self.start
+        rate = self.merged_authors / elapsed if elapsed > 0 else 0
+        print("INFO: {} authors merged into {} authors in {:.1f} s ({:.1f} authors/s, {} bulk writes)".format(
+            self.merged_authors, self.targets, elapsed, rate, self.bulk_writes))
+        if self.skipped:
+            print("INFO: {} groups skipped because an author was already the target of another merge, run the unicity again to merge them".format(
+                self.skipped))
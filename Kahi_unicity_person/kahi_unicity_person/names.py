@@ -0,0 +1,148 @@
+from collections import OrderedDict
+from threading import Lock
+from unicodedata import normalize, combining
+
+NAME_CONNECTORS = {"de", "del", "la", "las", "los", "y", "e", "da", "das", "do", "dos", "van", "von", "der", "di"}
+
+
+def fold(text):
+    """
+    Lower case text without accents, dots and hyphens.
+
+    Parameters:
+    ----------
+    text : str
+        The text to fold.
+
+    Returns:
+    ----------
+    str
+        The folded text.
+    """
+    text = normalize("NFKD", text or "")
+    text = "".join(c for c in text if not combining(c))
+    return text.lower().replace(".", " ").replace("-", " ")
+
+
+def last_name_keys(doc):
+    """
+    Computes the last-name keys of a person document: accent-folded tokens of the last names
+    without connectors and initials, used to block the comparison of authors.
+
+    Parameters:
+    ----------
+    doc : dict
+        The person document with last_names.
+
+    Returns:
+    ----------
+    frozenset
+        The last-name keys.
+    """
+    return frozenset(token for name in doc.get("last_names") or []
+                     for token in fold(name).split()
+                     if len(token) > 1 and token not in NAME_CONNECTORS)
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache with hits and misses counters.
+    """
+
+    def __init__(self, maxsize=1000000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class AuthorComparator:
+    """
+    Memoized comparison of person documents by the unordered pair of ids and the number of authors of the group
+    (compare_author uses it), the documents must not change while the comparator is used.
+
+    With blocking, the pairs of authors whose last-name keys have no token in common are not compared.
+    """
+
+    def __init__(self, compare, maxsize=1000000, blocking=False):
+        """
+        Parameters:
+        ----------
+        compare : function
+            The comparison function compare(author1, author2, n_authors) -> bool.
+        maxsize : int
+            The maximum number of comparisons and last-name keys in the caches, 0 to disable them.
+        blocking : bool
+            If True, skip the pairs of authors with different last names.
+        """
+        self.compare_function = compare
+        self.results = LRUCache(maxsize)
+        self.keys = LRUCache(maxsize)
+        self.blocking = blocking
+        self.blocked = 0
+
+    def last_name_keys(self, doc):
+        """
+        Gets the last-name keys of a person document, computed once per document id.
+        """
+        keys = self.keys.get(doc["_id"])
+        if keys is None:
+            keys = last_name_keys(doc)
+            self.keys.set(doc["_id"], keys)
+        return keys
+
+    def possible(self, author, other_author):
+        """
+        Checks if two authors can be the same person by their last-name keys.
+        """
+        keys = self.last_name_keys(author)
+        other_keys = self.last_name_keys(other_author)
+        if keys and other_keys and keys.isdisjoint(other_keys):
+            return False
+        return True
+
+    def compare(self, author, other_author, n_authors):
+        """
+        Compares two authors, the result is memoized by ({id, other id}, n_authors),
+        so (author, other_author) and (other_author, author) share the entry.
+
+        Returns:
+        ----------
+        bool
+            True if the authors are the same person.
+        """
+        if self.blocking and not self.possible(author, other_author):
+            self.blocked += 1
+            return False
+        key = (frozenset((author["_id"], other_author["_id"])), n_authors)
+        result = self.results.get(key)
+        if result is None:
+            result = bool(self.compare_function(
+                author, other_author, n_authors))
+            self.results.set(key, result)
+        return result
+
+    def stats(self):
+        """
+        Gets the counters of the comparisons.
+        """
+        return {"hits": self.results.hits, "misses": self.results.misses, "blocked": self.blocked}
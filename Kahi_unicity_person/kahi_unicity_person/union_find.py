@@ -0,0 +1,65 @@
+class UnionFind:
+    """
+    Disjoint sets of hashable items (union by size and path compression).
+    Used to join the pairs of authors accepted as the same person in different groups.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, item):
+        """
+        Get the representative of the set of item, the item is added if it is not found.
+        """
+        parent = self.parent.setdefault(item, item)
+        if parent == item:
+            self.size.setdefault(item, 1)
+            return item
+        root = parent
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, itema, itemb):
+        """
+        Join the sets of itema and itemb.
+
+        Returns:
+        ----------
+        bool
+            True if the items were in different sets.
+        """
+        roota = self.find(itema)
+        rootb = self.find(itemb)
+        if roota == rootb:
+            return False
+        if self.size[roota] < self.size[rootb]:
+            roota, rootb = rootb, roota
+        self.parent[rootb] = roota
+        self.size[roota] += self.size.pop(rootb)
+        return True
+
+    def connected(self, itema, itemb):
+        """
+        Check if itema and itemb are in the same set.
+        """
+        return self.find(itema) == self.find(itemb)
+
+    def components(self):
+        """
+        Get the sets with more than one item.
+
+        Returns:
+        ----------
+        dict
+            representative -> list of items, in the order they were added.
+        """
+        components = {}
+        for item in self.parent:
+            root = self.find(item)
+            if self.size[root] > 1:
+                components.setdefault(root, []).append(item)
+        return components